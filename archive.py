@@ -0,0 +1,345 @@
+"""Monthly partitions and cold-data archival of the metric tables.
+
+With ``PARTITION_METRICS=1`` (MySQL) the metric tables are ``RANGE``
+partitioned by month of ``recorded_at`` (see create_db.py). This command keeps
+``PARTITION_MONTHS_AHEAD`` monthly partitions ready and moves the months older
+than ``ARCHIVE_RETENTION_MONTHS`` to zstd-compressed Parquet files,
+``ARCHIVE_DIR/<table>/<YYYY-MM>.parquet``, sorted by user and time. A month is
+written to its file first, its rows are counted again and only then is the
+partition dropped; unpartitioned tables (and SQLite) have the exported rows
+deleted in chunks instead. Run it monthly, e.g. from cron:
+
+    python archive.py                         # add partitions, archive old months
+    python archive.py --retention-months 12
+
+A month's file holds every row recorded before the end of that month that was
+still in the database, so samples uploaded late for an archived month end up
+in a later file. Reads for archived ranges go through the files: the list
+endpoints merge archived rows into their pages (pagination.py), and rebuilding
+the daily rollups, cohort_stats and the quantile sketches keeps the aggregates
+of archived days instead of recomputing them. History and scores read the
+rollups and never need the files. Every API server and replica must see the
+same ``ARCHIVE_DIR`` (e.g. a shared mount).
+
+Existing tables are converted once (MySQL), then split into months by this
+command:
+
+    ALTER TABLE physical_activity DROP FOREIGN KEY <users.id foreign key>, DROP PRIMARY KEY,
+        MODIFY recorded_at DATETIME NOT NULL, ADD PRIMARY KEY (id, recorded_at),
+        PARTITION BY RANGE (TO_DAYS(recorded_at)) (PARTITION p_future VALUES LESS THAN MAXVALUE);
+"""
+import argparse
+import os
+from collections import namedtuple
+from datetime import date, datetime, time
+from functools import lru_cache
+from typing import Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from sqlalchemy import DateTime, Float, Integer, delete, func, select, text
+from sqlalchemy.orm import Session
+
+from create_db import (
+    SessionLocal, PARTITION_METRICS, FUTURE_PARTITION, PhysicalActivity, SleepActivity, BloodTests,
+)
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+RETENTION_MONTHS = int(os.getenv("ARCHIVE_RETENTION_MONTHS", "24"))
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+EXPORT_BATCH_SIZE = 50000
+DELETE_CHUNK_SIZE = 10000
+# Row groups hold consecutive users, so reads of one user skip the others by their user_id statistics
+ROW_GROUP_SIZE = 100000
+
+METRIC_MODELS = (PhysicalActivity, SleepActivity, BloodTests)
+
+
+def month_start(day) -> date:
+    return date(day.year, day.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"p{month:%Y%m}"
+
+
+def archive_path(model, month: date) -> str:
+    return os.path.join(ARCHIVE_DIR, model.__tablename__, f"{month:%Y-%m}.parquet")
+
+
+def archived_months(model) -> list:
+    try:
+        names = os.listdir(os.path.join(ARCHIVE_DIR, model.__tablename__))
+    except FileNotFoundError:
+        return []
+    return sorted(datetime.strptime(name, "%Y-%m.parquet").date() for name in names if name.endswith(".parquet"))
+
+
+def horizon(model) -> Optional[datetime]:
+    """End of the last archived month of ``model``: every archived row was recorded before it."""
+    months = archived_months(model)
+    if not months:
+        return None
+    return datetime.combine(add_months(months[-1], 1), time.min)
+
+
+def arrow_schema(model) -> pa.Schema:
+    def arrow_type(column):
+        if isinstance(column.type, DateTime):
+            return pa.timestamp("us")
+        if isinstance(column.type, Integer):
+            return pa.int64()
+        if isinstance(column.type, Float):
+            return pa.float64()
+        return pa.string()
+
+    return pa.schema([(column.name, arrow_type(column)) for column in model.__table__.columns])
+
+
+def write_parquet(table: pa.Table, path: str):
+    """Replace ``path`` atomically, sorted by user and time."""
+    table = table.sort_by([("user_id", "ascending"), ("recorded_at", "ascending"), ("id", "ascending")])
+    pq.write_table(table, path + ".tmp", compression="zstd", row_group_size=ROW_GROUP_SIZE)
+    os.replace(path + ".tmp", path)
+
+
+### Partitions (MySQL)
+
+def monthly_partitions(db: Session, model) -> list:
+    """First days of the months of ``model``'s monthly partitions, in order."""
+    names = db.execute(
+        text(
+            "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL "
+            "ORDER BY PARTITION_ORDINAL_POSITION"
+        ),
+        {"table": model.__tablename__},
+    ).scalars().all()
+    return [datetime.strptime(name, "p%Y%m").date() for name in names if name != FUTURE_PARTITION]
+
+
+def ensure_partitions(db: Session, model, months_ahead: int = PARTITION_MONTHS_AHEAD) -> int:
+    """Split monthly partitions off the catch-all one up to ``months_ahead`` months from now."""
+    months = monthly_partitions(db, model)
+    if months:
+        month = add_months(months[-1], 1)
+    else:
+        oldest = db.execute(select(func.min(model.recorded_at))).scalar()
+        month = month_start(oldest or datetime.utcnow())
+    last = add_months(month_start(datetime.utcnow()), months_ahead)
+
+    definitions = []
+    while month <= last:
+        definitions.append(
+            f"PARTITION {partition_name(month)} VALUES LESS THAN (TO_DAYS('{add_months(month, 1).isoformat()}'))"
+        )
+        month = add_months(month, 1)
+    if definitions:
+        db.execute(text(
+            f"ALTER TABLE {model.__tablename__} REORGANIZE PARTITION {FUTURE_PARTITION} INTO "
+            f"({', '.join(definitions)}, PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE)"
+        ))
+    return len(definitions)
+
+
+### Archival
+
+def archivable_months(db: Session, model, cutoff: date) -> list:
+    """Months of ``model`` ending on or before ``cutoff`` that are still in the database."""
+    if PARTITION_METRICS:
+        return [month for month in monthly_partitions(db, model) if add_months(month, 1) <= cutoff]
+    oldest = db.execute(select(func.min(model.recorded_at))).scalar()
+    months = []
+    month = month_start(oldest) if oldest is not None else cutoff
+    while add_months(month, 1) <= cutoff:
+        months.append(month)
+        month = add_months(month, 1)
+    return months
+
+
+def export_month(db: Session, model, month: date):
+    """Write the rows recorded before the end of ``month`` to its file; returns ``(rows, highest id)``."""
+    end = datetime.combine(add_months(month, 1), time.min)
+    schema = arrow_schema(model)
+    stmt = (
+        select(*model.__table__.columns)
+        .where(model.recorded_at < end)
+        .order_by(model.user_id, model.recorded_at, model.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    path = archive_path(model, month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    exported, max_id = 0, None
+    with pq.ParquetWriter(path + ".export", schema, compression="zstd") as writer:
+        for rows in db.execute(stmt).mappings().partitions():
+            batch = pa.Table.from_pylist([dict(row) for row in rows], schema=schema)
+            writer.write_table(batch, row_group_size=ROW_GROUP_SIZE)
+            exported += batch.num_rows
+            max_id = max(max_id or 0, pc.max(batch["id"]).as_py())
+    if not exported:
+        os.remove(path + ".export")
+    elif os.path.exists(path):
+        # Second export of a month (late samples, or a run interrupted before the drop):
+        # merge with the file, the database copy of a row winning
+        table = pq.read_table(path + ".export")
+        archived = pq.read_table(path, schema=schema)
+        archived = archived.filter(pc.invert(pc.is_in(archived["id"], value_set=table["id"])))
+        write_parquet(pa.concat_tables([archived, table]), path)
+        os.remove(path + ".export")
+    else:
+        os.replace(path + ".export", path)
+    return exported, max_id
+
+
+def drop_month(db: Session, model, month: date, exported: int, max_id: Optional[int]):
+    """Remove the rows of ``month`` once they are in its file."""
+    end = datetime.combine(add_months(month, 1), time.min)
+    if PARTITION_METRICS:
+        rows = db.execute(select(func.count()).select_from(model).where(model.recorded_at < end)).scalar()
+        if rows != exported:
+            raise RuntimeError(
+                f"{model.__tablename__}: {rows - exported} rows of {month:%Y-%m} arrived during the export; run again"
+            )
+        db.execute(text(f"ALTER TABLE {model.__tablename__} DROP PARTITION {partition_name(month)}"))
+        return
+    if max_id is None:
+        return
+    # Rows inserted after the export have higher ids and wait for the next run
+    while True:
+        ids = db.execute(
+            select(model.id).where(model.recorded_at < end, model.id <= max_id).limit(DELETE_CHUNK_SIZE)
+        ).scalars().all()
+        if not ids:
+            break
+        db.execute(delete(model).where(model.id.in_(ids)).execution_options(synchronize_session=False))
+        db.commit()
+
+
+def archive_month(db: Session, model, month: date) -> int:
+    exported, max_id = export_month(db, model, month)
+    drop_month(db, model, month, exported, max_id)
+    db.commit()
+    return exported
+
+
+def archive(db: Session, retention_months: int = RETENTION_MONTHS) -> dict:
+    """Archive every month older than ``retention_months``; returns the archived rows per table."""
+    cutoff = add_months(month_start(datetime.utcnow()), -retention_months)
+    archived = {}
+    for model in METRIC_MODELS:
+        archived[model.__tablename__] = sum(
+            archive_month(db, model, month) for month in archivable_months(db, model, cutoff)
+        )
+    return archived
+
+
+### Reads
+
+@lru_cache(maxsize=None)
+def archived_row_type(names: tuple):
+    # Named tuples answer ``row.id``/``row._asdict()`` like SQLAlchemy rows
+    return namedtuple("ArchivedRow", names)
+
+
+def time_condition(condition, since: Optional[datetime] = None, until: Optional[datetime] = None):
+    if since is not None:
+        condition &= pc.field("recorded_at") >= since
+    if until is not None:
+        condition &= pc.field("recorded_at") < until
+    return condition
+
+
+def dataset(model):
+    paths = [archive_path(model, month) for month in archived_months(model)]
+    return ds.dataset(paths, schema=arrow_schema(model), format="parquet") if paths else None
+
+
+def read_page(model, user_id: int, names, since: Optional[datetime] = None, until: Optional[datetime] = None,
+              after=None, limit: Optional[int] = None) -> list:
+    """One user's archived rows as tuples of the columns ``names``, ordered by ``(recorded_at, id)``.
+
+    ``after`` is the ``(recorded_at, id)`` of the last row already returned.
+    """
+    archived = dataset(model)
+    if archived is None:
+        return []
+    condition = time_condition(pc.field("user_id") == user_id, since, until)
+    if after is not None:
+        recorded_at, row_id = after
+        condition &= (pc.field("recorded_at") > recorded_at) | (
+            (pc.field("recorded_at") == recorded_at) & (pc.field("id") > row_id)
+        )
+    table = archived.to_table(columns=list(names), filter=condition)
+    table = table.sort_by([("recorded_at", "ascending"), ("id", "ascending")])
+    if limit is not None:
+        table = table.slice(0, limit)
+    row_type = archived_row_type(tuple(names))
+    return [row_type(**row) for row in table.to_pylist()]
+
+
+def scan(model, user_ids=None, excluded_user_ids=(), since: Optional[datetime] = None,
+         until: Optional[datetime] = None, batch_size: int = EXPORT_BATCH_SIZE):
+    """Stream the archived rows of ``model`` (of ``user_ids`` if given) as record batches of every column."""
+    archived = dataset(model)
+    if archived is None:
+        return
+    condition = pc.scalar(True)
+    if user_ids is not None:
+        condition = pc.field("user_id").isin(list(user_ids))
+    if excluded_user_ids:
+        condition &= ~pc.field("user_id").isin(list(excluded_user_ids))
+    condition = time_condition(condition, since, until)
+    for batch in archived.to_batches(filter=condition, batch_size=batch_size):
+        if batch.num_rows:
+            yield batch
+
+
+def delete_user(user_id: int) -> int:
+    """Rewrite the archive files holding rows of ``user_id`` without them; returns the rows removed."""
+    removed = 0
+    for model in METRIC_MODELS:
+        for month in archived_months(model):
+            path = archive_path(model, month)
+            # Row group statistics make this cheap for files without the user
+            if not pq.read_table(path, columns=["id"], filters=[("user_id", "==", user_id)]).num_rows:
+                continue
+            table = pq.read_table(path)
+            kept = table.filter(pc.field("user_id") != user_id)
+            removed += table.num_rows - kept.num_rows
+            write_parquet(kept, path)
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add monthly partitions and archive old months of the metric tables.")
+    parser.add_argument("--retention-months", type=int, default=RETENTION_MONTHS,
+                        help="months kept in the database besides the current one")
+    parser.add_argument("--months-ahead", type=int, default=PARTITION_MONTHS_AHEAD,
+                        help="monthly partitions created ahead of time")
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        if PARTITION_METRICS:
+            for model in METRIC_MODELS:
+                created = ensure_partitions(session, model, args.months_ahead)
+                print(f"📌 {model.__tablename__}: {created} partitions added")
+        print(f"🚀 Archiving metric samples older than {args.retention_months} months to {ARCHIVE_DIR}...")
+        for table, rows in archive(session, args.retention_months).items():
+            print(f"✅ {table}: {rows} rows archived")
+    except Exception as e:
+        session.rollback()
+        print(f"❌ Error archiving metric samples: {e}")
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Scaling benchmark for the cohort aggregation in ``get_health_score``.
+
+Builds one cohort in a throwaway SQLite database at increasing sizes (10
+activity and 10 sleep rows for every blood test, like production) and times
+the two paths ``get_health_score`` reads a cohort through (see cohort_stats.py)
+against the old cross-join query:
+
+* ``cohort_stats``: the all-time summary, one indexed read of the running totals;
+* ``window fallback``: a ``--window`` days summary while ``cohort_window_stats``
+  is stale, aggregated per table from the raw samples.
+
+Run from the repository root:
+
+    python -m benchmarks.cohort_aggregation_benchmark --sizes 1000 2000 4000 8000
+
+The cohort_stats read should not grow with the row count and the window
+fallback should roughly double with every doubling; the cross join grows with
+the product of the three tables, so it is only run up to ``--legacy-max-rows``.
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, func, insert
+from sqlalchemy.orm import sessionmaker
+from tabulate import tabulate
+
+from create_db import Base, User, PhysicalActivity, SleepActivity, BloodTests
+import cohort_stats
+import health_score
+
+COHORT_USERS = 20
+
+
+def build_database(rows: int):
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+
+    rng = random.Random(rows)
+    now = datetime.utcnow()
+    session.execute(insert(User), [
+        dict(gender="male", age_group="40-50", climate_zone="Temperate", chronic_conditions="no",
+             fitness_level="beginner", language="en", uuid=f"bench-{i}", registration_status="completed",
+             registration_source="Web")
+        for i in range(COHORT_USERS)
+    ])
+    user_ids = [user_id for (user_id,) in session.query(User.id)]
+
+    def recorded_at():
+        return now - timedelta(minutes=rng.randint(0, 60 * 24 * 365))
+
+    session.execute(insert(PhysicalActivity), [
+        dict(user_id=rng.choice(user_ids), steps=rng.randint(2000, 15000), calories_burned=300.0,
+             active_minutes=rng.randint(20, 120), recorded_at=recorded_at())
+        for _ in range(rows)
+    ])
+    session.execute(insert(SleepActivity), [
+        dict(user_id=rng.choice(user_ids), sleep_duration=round(rng.uniform(4, 9), 1),
+             sleep_quality=rng.randint(50, 100), recorded_at=recorded_at())
+        for _ in range(rows)
+    ])
+    session.execute(insert(BloodTests), [
+        dict(user_id=rng.choice(user_ids), glucose_level=round(rng.uniform(70, 120), 1),
+             cholesterol_level=round(rng.uniform(150, 250), 1), recorded_at=recorded_at())
+        for _ in range(max(1, rows // 10))
+    ])
+    session.commit()
+    cohort_stats.assign_cohorts(session)
+    cohort_stats.rebuild(session)
+    return session, session.get(User, user_ids[0])
+
+
+def cohort_stats_summary(session, user):
+    cohort_stats.cohort_summary(session, user)
+
+
+def window_fallback(session, user, window: int):
+    # No cohort_window_stats rows: the window is aggregated from the raw samples
+    cohort_stats.cohort_window_summary(session, user, window)
+
+
+def cross_join_aggregation(session, user):
+    member_ids = session.query(User.id).filter(*health_score.cohort_filter(user)).subquery()
+    session.query(
+        func.avg(PhysicalActivity.steps),
+        func.avg(SleepActivity.sleep_duration),
+        func.avg(BloodTests.glucose_level),
+    ).filter(
+        PhysicalActivity.user_id.in_(session.query(member_ids.c.id)),
+        SleepActivity.user_id.in_(session.query(member_ids.c.id)),
+        BloodTests.user_id.in_(session.query(member_ids.c.id)),
+    ).first()
+
+
+def best_of(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[250, 500, 1000, 2000, 4000, 8000, 16000, 32000],
+                        help="activity/sleep rows in the cohort (blood tests are a tenth of that)")
+    parser.add_argument("--legacy-max-rows", type=int, default=500,
+                        help="largest size the cross-join query is timed at")
+    parser.add_argument("--window", type=int, choices=health_score.SCORE_WINDOWS, default=90,
+                        help="score window of the fallback aggregation")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    table = []
+    previous = None
+    for rows in sorted(args.sizes):
+        session, user = build_database(rows)
+        stats_ms = best_of(lambda: cohort_stats_summary(session, user), args.repeat) * 1000
+        engine_ms = best_of(lambda: window_fallback(session, user, args.window), args.repeat) * 1000
+        legacy_ms = None
+        if rows <= args.legacy_max_rows:
+            legacy_ms = best_of(lambda: cross_join_aggregation(session, user), 1) * 1000
+        growth = None
+        if previous:
+            growth = (engine_ms / previous[1]) / (rows / previous[0])
+        table.append([rows, rows // 10, f"{stats_ms:.2f}", f"{engine_ms:.2f}", f"{growth:.2f}" if growth else "-",
+                      f"{legacy_ms:.2f}" if legacy_ms is not None else "skipped"])
+        previous = (rows, engine_ms)
+        session.close()
+
+    print(tabulate(table, headers=[
+        "activity/sleep rows", "blood rows", "cohort_stats ms", "window fallback ms", "growth vs linear", "cross-join ms",
+    ]))
+    print("\n'growth vs linear' (of the window fallback) ≈ 1.0 means latency grows linearly with the row count.")
+
+
+if __name__ == "__main__":
+    main()
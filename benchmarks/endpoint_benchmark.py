@@ -0,0 +1,254 @@
+"""Latency and throughput benchmark of the API endpoints.
+
+Seeds a dataset with ``seed_data`` (a base population plus one dedicated
+cohort per ``--cohort-sizes`` entry), then drives the endpoints with
+``--concurrency`` concurrent clients and reports p50/p95/p99 latency and
+requests per second for user CRUD, the metric list endpoints, single creates
+and ``get_health_score`` per cohort size. Run from the repository root:
+
+    python -m benchmarks.endpoint_benchmark --users 2000 --cohort-sizes 10 100 1000
+
+By default the FastAPI ``app`` is called in-process (httpx ``ASGITransport``)
+against a throwaway SQLite database. ``--url http://127.0.0.1:8000`` drives a
+running uvicorn instead; that server and this script must share
+``DATABASE_URL``/``ASYNC_DATABASE_URL``. Results are written as JSON
+(``--output``) and ``--compare`` prints the ratio to an earlier result file;
+``benchmarks/baseline.json`` is a default in-process run (SQLite). Score
+caching is disabled for the in-process run (``HEALTH_SCORE_CACHE_SIZE=0``) so
+every ``get_health_score`` call measures the scoring queries.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from tabulate import tabulate
+
+COHORT_ZONE = "Benchmark-{size}"
+
+
+def configure_environment(args):
+    """Point the app at a throwaway database; must run before ``create_db`` is imported."""
+    if args.url is None and "DATABASE_URL" not in os.environ:
+        path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+        os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+        os.environ["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{path}"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    if args.url is None and not args.cache:
+        os.environ["HEALTH_SCORE_CACHE_SIZE"] = "0"
+
+
+def seed_dataset(args) -> dict:
+    """Insert the base population and the dedicated cohorts; returns the user ids per group."""
+    from sqlalchemy import insert, select
+    from create_db import Base, engine, User
+    import seed_data
+
+    Base.metadata.create_all(bind=engine)
+    end = datetime.combine(datetime.utcnow().date() + timedelta(days=1), datetime.min.time())
+
+    def add_samples(users):
+        for start in range(0, len(users), 500):
+            seed_data.seed_users((users[start:start + 500], args.seed, args.days, args.activity_per_day, end, 5000))
+
+    population = seed_data.insert_users(args.seed, args.users, 5000)
+    add_samples(population)
+    groups = {"population": [user_id for _, user_id in population]}
+
+    offset = args.users
+    with engine.begin() as conn:
+        for size in args.cohort_sizes:
+            rows = []
+            for index in range(offset, offset + size):
+                row = seed_data.generate_user(args.seed, index)
+                row.update(climate_zone=COHORT_ZONE.format(size=size), age_group="30-40", chronic_conditions="no",
+                           fitness_level="intermediate")
+                rows.append(row)
+            conn.execute(insert(User), rows)
+            user_ids = conn.execute(
+                select(User.id).where(User.climate_zone == COHORT_ZONE.format(size=size)).order_by(User.id)
+            ).scalars().all()
+            groups[f"cohort_{size}"] = user_ids
+            offset += size
+    for size in args.cohort_sizes:
+        add_samples(list(enumerate(groups[f"cohort_{size}"], start=args.users)))
+
+    seed_data.rebuild_aggregates()
+    return groups
+
+
+def scenarios(groups: dict, rng: np.random.Generator):
+    """``(name, request factory)`` pairs; a factory returns ``(method, path, json body)``."""
+    population = groups["population"]
+
+    def any_user():
+        return int(rng.choice(population))
+
+    user = dict(gender="female", age_group="30-40", climate_zone="Temperate", chronic_conditions="no",
+                fitness_level="intermediate", language="en", registration_status="completed",
+                registration_source="Web")
+    yield "users.create", lambda: ("POST", "/users/", user)
+    yield "users.get", lambda: ("GET", f"/users/{any_user()}", None)
+    yield "users.update", lambda: ("PUT", f"/users/{any_user()}", {"language": "fr"})
+    for metric in ("physical_activity", "sleep_activity", "blood_tests"):
+        yield f"{metric}.list", lambda metric=metric: ("GET", f"/user/{any_user()}/{metric}/?limit=100", None)
+    yield "physical_activity.create", lambda: (
+        "POST", f"/user/{any_user()}/physical_activity/", dict(steps=5000, calories_burned=250.0, active_minutes=45))
+    yield "sleep_activity.create", lambda: (
+        "POST", f"/user/{any_user()}/sleep_activity/", dict(sleep_duration=7.5, sleep_quality=80))
+    yield "blood_tests.create", lambda: (
+        "POST", f"/user/{any_user()}/blood_tests/", dict(glucose_level=92.0, cholesterol_level=180.0))
+    for group, user_ids in groups.items():
+        if group.startswith("cohort_"):
+            yield f"get_health_score.{group}", lambda user_ids=user_ids: (
+                "GET", f"/user/{int(rng.choice(user_ids))}/get_health_score/", None)
+
+
+async def run_scenario(client, factory, requests: int, concurrency: int) -> dict:
+    latencies = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            method, path, body = factory()
+            start = time.perf_counter()
+            response = await client.request(method, path, json=body)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "rps": round(len(latencies) / elapsed, 1),
+    }
+
+
+async def run_benchmark(args, groups: dict) -> dict:
+    import httpx
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=60)
+    else:
+        from main import app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark", timeout=60)
+
+    rng = np.random.default_rng(args.seed)
+    results = {}
+    try:
+        async with client:
+            for name, factory in scenarios(groups, rng):
+                if args.only and not any(name.startswith(prefix) for prefix in args.only):
+                    continue
+                await run_scenario(client, factory, args.warmup, args.concurrency)
+                results[name] = await run_scenario(client, factory, args.requests, args.concurrency)
+                print(f"📌 {name}: p95 {results[name]['p95_ms']} ms, {results[name]['rps']} req/s")
+    finally:
+        if not args.url:
+            # Pooled aiosqlite/aiomysql connections must be closed on this event loop
+            from create_db import async_engine, async_read_engine
+            for db_engine in {async_engine, async_read_engine} - {None}:
+                await db_engine.dispose()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def print_results(results: dict, baseline: dict = None):
+    headers = ["scenario", "requests", "errors", "p50 ms", "p95 ms", "p99 ms", "req/s"]
+    if baseline:
+        headers += ["p95 vs base", "req/s vs base"]
+    table = []
+    for name, result in results.items():
+        row = [name, result["requests"], result["errors"], result["p50_ms"], result["p95_ms"], result["p99_ms"],
+               result["rps"]]
+        if baseline:
+            base = baseline.get(name)
+            row += [f"{result['p95_ms'] / base['p95_ms']:.2f}x", f"{result['rps'] / base['rps']:.2f}x"] if base else ["-", "-"]
+        table.append(row)
+    print(tabulate(table, headers=headers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="benchmark a running server instead of the in-process app")
+    parser.add_argument("--users", type=int, default=1000, help="base population")
+    parser.add_argument("--days", type=int, default=30, help="days of samples per metric and user")
+    parser.add_argument("--activity-per-day", type=int, default=3)
+    parser.add_argument("--cohort-sizes", type=int, nargs="+", default=[10, 100, 1000],
+                        help="members of the dedicated cohorts get_health_score is timed on")
+    parser.add_argument("--requests", type=int, default=500, help="timed requests per scenario")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--cache", action="store_true", help="keep the health score cache enabled")
+    parser.add_argument("--skip-seed", action="store_true",
+                        help="reuse a dataset seeded by an earlier run with the same arguments")
+    parser.add_argument("--only", nargs="+", help="run the scenarios starting with these prefixes")
+    parser.add_argument("--output", default=f"benchmark-{datetime.utcnow():%Y%m%d-%H%M%S}.json")
+    parser.add_argument("--compare", help="earlier result file to compare with")
+    args = parser.parse_args()
+
+    configure_environment(args)
+    if args.skip_seed:
+        from create_db import SessionLocal, User
+        session = SessionLocal()
+        try:
+            user_ids = [user_id for (user_id,) in session.query(User.id).order_by(User.id)]
+            groups = {"population": user_ids[:args.users]}
+            for size in args.cohort_sizes:
+                groups[f"cohort_{size}"] = [user_id for (user_id,) in session.query(User.id).filter(
+                    User.climate_zone == COHORT_ZONE.format(size=size))]
+        finally:
+            session.close()
+    else:
+        print("🚀 Seeding the benchmark dataset...")
+        groups = seed_dataset(args)
+
+    results = asyncio.run(run_benchmark(args, groups))
+    report = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "commit": git_commit(),
+        "target": args.url or "in-process",
+        "database": os.environ.get("DATABASE_URL"),
+        "dataset": {"users": args.users, "days": args.days, "activity_per_day": args.activity_per_day,
+                    "cohort_sizes": args.cohort_sizes, "seed": args.seed},
+        "concurrency": args.concurrency,
+        "cache": args.cache,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print()
+    print_results(results, baseline)
+    print(f"\n✅ Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+"""Incrementally maintained cohort statistics.
+
+``cohort_stats`` holds a running sum and count per cohort and metric, plus a
+``members`` row with the number of users in the cohort. The write endpoints in
+main.py apply their deltas in the same transaction as the change itself, so the
+cohort side of a health score is one indexed read instead of a scan over every
+sample of the cohort.
+
+Run this module to (re)build the table from the raw metric tables, e.g. after
+deploying it against an existing database:
+
+    python cohort_stats.py
+
+Windowed scores (last 7/30/90 days) cannot be maintained incrementally because
+samples age out of the window, so ``cohort_window_stats`` is recomputed from
+scratch by a periodic run (e.g. every 15 minutes from cron):
+
+    python cohort_stats.py --windows
+
+Users point at their row in the ``cohorts`` registry through ``cohort_id``.
+The API assigns it on every user write; users inserted otherwise (or before
+the column existed) are assigned with:
+
+    python cohort_stats.py --assign-cohorts
+"""
+import argparse
+import hashlib
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, false, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from create_db import SessionLocal, Cohort, CohortStats, CohortWindowStats, User, upsert
+import archive
+import health_score
+import shards
+
+MEMBERS = "members"
+
+# metric table -> (metric name, tracked column)
+METRIC_BY_MODEL = {model: (name, column) for name, (model, column, _) in health_score.METRICS.items()}
+
+COHORT_COLUMNS = (User.climate_zone, User.chronic_conditions, User.age_group, User.fitness_level)
+
+# Older window aggregates are ignored and the cohort is aggregated live instead
+WINDOW_STATS_MAX_AGE = timedelta(minutes=int(os.getenv("WINDOW_STATS_MAX_AGE_MINUTES", "60")))
+
+
+def cohort_key(user) -> str:
+    """Stable key of the group ``health_score.cohort_filter`` selects for ``user``."""
+    parts = (user.climate_zone, user.chronic_conditions, user.age_group, user.fitness_level)
+    raw = "\x1f".join("\x00" if part is None else part for part in parts)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def cohort_id(db: Session, user) -> int:
+    """Id of ``user``'s row in the ``cohorts`` registry, registering the cohort on first use."""
+    key = cohort_key(user)
+    existing = db.execute(select(Cohort.id).where(Cohort.cohort_key == key)).scalar()
+    if existing is not None:
+        return existing
+    cohort = Cohort(cohort_key=key, climate_zone=user.climate_zone, chronic_conditions=user.chronic_conditions,
+                    age_group=user.age_group, fitness_level=user.fitness_level)
+    if shards.SHARDED and not shards.SHARDS[0].owns(db):
+        # Registry ids are handed out by shard 0 so that they agree on every shard
+        primary = shards.SHARDS[0].SessionLocal()
+        try:
+            cohort.id = cohort_id(primary, user)
+            primary.commit()
+        finally:
+            primary.close()
+    try:
+        with db.begin_nested():
+            db.add(cohort)
+    except IntegrityError:
+        # Registered by a concurrent request
+        return db.execute(select(Cohort.id).where(Cohort.cohort_key == key)).scalar_one()
+    return cohort.id
+
+
+def assign_cohort(db: Session, user):
+    user.cohort_id = cohort_id(db, user)
+
+
+def assign_cohorts(db: Session) -> int:
+    """Register every cohort and point its users at it; returns the number of users updated."""
+    updated = 0
+    for row in db.execute(select(*COHORT_COLUMNS).distinct()).all():
+        assigned = cohort_id(db, row)
+        updated += db.execute(
+            update(User)
+            .where(*health_score.attribute_filter(row), or_(User.cohort_id.is_(None), User.cohort_id != assigned))
+            .values(cohort_id=assigned, updated_at=User.updated_at)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+    return updated
+
+
+def apply_delta(db: Session, key: str, metric: str, total: float, count: int):
+    if not total and not count:
+        return
+    upsert(
+        db, CohortStats, ["cohort_key", "metric"],
+        dict(cohort_key=key, metric=metric, total=total, count=count, updated_at=datetime.utcnow()),
+        dict(total=CohortStats.total + total, count=CohortStats.count + count, updated_at=datetime.utcnow()),
+    )
+
+
+def sample_value(model, sample):
+    _, column = METRIC_BY_MODEL[model]
+    return getattr(sample, column.key)
+
+
+def record_sample(db: Session, key: str, model, value, sign: int = 1):
+    """Add (``sign=1``) or remove (``sign=-1``) one sample value of ``model`` in cohort ``key``."""
+    if value is None:
+        return
+    name, _ = METRIC_BY_MODEL[model]
+    apply_delta(db, key, name, sign * float(value), sign)
+
+
+def record_change(db: Session, key: str, model, old_value, new_value):
+    if old_value == new_value:
+        return
+    record_sample(db, key, model, old_value, -1)
+    record_sample(db, key, model, new_value)
+
+
+def user_totals(db: Session, user_id: int) -> dict:
+    """Sum and count of every metric recorded by one user.
+
+    Days before the archive horizon (see archive.py) come from the daily
+    rollups, the rest from the raw tables.
+    """
+    columns = []
+    for name, (model, column, _) in health_score.METRICS.items():
+        raw = model.user_id == user_id
+        archived_until = archive.horizon(model)
+        if archived_until is not None:
+            raw = and_(raw, model.recorded_at >= archived_until)
+        columns.append(select(func.sum(column)).where(raw).scalar_subquery().label(f"{name}_total"))
+        columns.append(select(func.count(column)).where(raw).scalar_subquery().label(f"{name}_count"))
+        rollup = health_score.DAILY_ROLLUPS[name]
+        archived = and_(rollup.user_id == user_id, rollup.day < archived_until.date()) if archived_until else false()
+        columns.append(select(func.sum(rollup.total)).where(archived).scalar_subquery().label(f"{name}_archived_total"))
+        columns.append(select(func.sum(rollup.count)).where(archived).scalar_subquery().label(f"{name}_archived_count"))
+    row = db.execute(select(*columns)).one()._mapping
+    return {
+        name: (
+            float(row[f"{name}_total"] or 0) + float(row[f"{name}_archived_total"] or 0),
+            row[f"{name}_count"] + int(row[f"{name}_archived_count"] or 0),
+        )
+        for name in health_score.METRICS
+    }
+
+
+def add_member(db: Session, user):
+    apply_delta(db, cohort_key(user), MEMBERS, 0, 1)
+
+
+def move_user(db: Session, user_id: int, old_key: str, new_key: str):
+    """Carry a user's samples and membership over when their cohort changes."""
+    if old_key == new_key:
+        return
+    for metric, (total, count) in user_totals(db, user_id).items():
+        apply_delta(db, old_key, metric, -total, -count)
+        apply_delta(db, new_key, metric, total, count)
+    apply_delta(db, old_key, MEMBERS, 0, -1)
+    apply_delta(db, new_key, MEMBERS, 0, 1)
+
+
+def remove_user(db: Session, user):
+    key = cohort_key(user)
+    for metric, (total, count) in user_totals(db, user.id).items():
+        apply_delta(db, key, metric, -total, -count)
+    apply_delta(db, key, MEMBERS, 0, -1)
+
+
+def _summary(stats: dict):
+    averages = {}
+    for name, (_, _, default) in health_score.METRICS.items():
+        total, count = stats.get(name, (0, 0))
+        averages[name] = total / count if count else default
+    return stats.get(MEMBERS, (0, 0))[1], averages
+
+
+def cohort_totals(db: Session, keys) -> dict:
+    """``{cohort_key: {metric: (total, count)}}`` of the cohorts ``keys``, members included."""
+    stats = {key: {} for key in keys}
+    for chunk in health_score.chunked(list(stats)):
+        rows = db.execute(
+            select(CohortStats.cohort_key, CohortStats.metric, CohortStats.total, CohortStats.count)
+            .where(CohortStats.cohort_key.in_(chunk))
+        )
+        for key, metric, total, count in rows:
+            stats[key][metric] = (total, count)
+    return stats
+
+
+def cohort_summary(db: Session, user):
+    """Return ``(group_size, averages)`` for ``user``'s cohort."""
+    key = cohort_key(user)
+    return _summary(cohort_totals(db, [key])[key])
+
+
+def cohort_summaries(db: Session, keys) -> dict:
+    """``cohort_summary`` for many cohorts at once, keyed by cohort key."""
+    return {key: _summary(cohort) for key, cohort in cohort_totals(db, keys).items()}
+
+
+def window_totals(db: Session, user, window_days: int) -> dict:
+    """``{metric: (total, count)}`` of ``user``'s cohort over the last ``window_days`` days, members included.
+
+    Read from ``cohort_window_stats``, or from the raw samples when those are stale.
+    """
+    key = cohort_key(user)
+    members = db.execute(
+        select(CohortStats.count).where(CohortStats.cohort_key == key, CohortStats.metric == MEMBERS)
+    ).scalar()
+    rows = db.execute(
+        select(CohortWindowStats.metric, CohortWindowStats.total, CohortWindowStats.count, CohortWindowStats.computed_at)
+        .where(CohortWindowStats.cohort_key == key, CohortWindowStats.window_days == window_days)
+    ).all()
+    fresh_after = datetime.utcnow() - WINDOW_STATS_MAX_AGE
+    if not rows or any(computed_at < fresh_after for *_, computed_at in rows):
+        since = health_score.window_start(window_days)
+        member_ids = health_score.cohort_member_ids(user)
+        stats = health_score.metric_totals(db, lambda model: health_score.in_window(model, since, model.user_id.in_(member_ids)))
+    else:
+        stats = {metric: (total, count) for metric, total, count, _ in rows}
+    stats[MEMBERS] = (0, members or 0)
+    return stats
+
+
+def cohort_window_summary(db: Session, user, window_days: int):
+    """``cohort_summary`` restricted to samples of the last ``window_days`` days."""
+    return _summary(window_totals(db, user, window_days))
+
+
+def merge_totals(parts) -> dict:
+    """Sum ``{metric: (total, count)}`` dicts, e.g. of the same cohort on every shard."""
+    merged = {}
+    for stats in parts:
+        for metric, (total, count) in stats.items():
+            merged_total, merged_count = merged.get(metric, (0, 0))
+            merged[metric] = (merged_total + (total or 0), merged_count + (count or 0))
+    return merged
+
+
+def sharded_summary(user, window_days: int = None):
+    """``cohort_summary`` (``cohort_window_summary`` with ``window_days``) summed over every shard."""
+    if window_days:
+        return _summary(merge_totals(shards.scatter(window_totals, user, window_days)))
+    key = cohort_key(user)
+    return _summary(merge_totals(stats[key] for stats in shards.scatter(cohort_totals, [key])))
+
+
+def sharded_period_averages(user, start, end, step: str) -> dict:
+    """``health_score.series_averages`` of ``user``'s cohort summed over every shard (score history)."""
+    parts = shards.scatter(health_score.cohort_period_totals, user, start, end, step)
+    return health_score.series_averages({
+        name: merge_totals(part[name] for part in parts) for name in health_score.DAILY_ROLLUPS
+    })
+
+
+def sharded_summaries(keys) -> dict:
+    """``cohort_summaries`` summed over every shard."""
+    parts = shards.scatter(cohort_totals, list(keys))
+    return {key: _summary(merge_totals(stats[key] for stats in parts)) for key in keys}
+
+
+def grouped_totals(db: Session, since=None) -> dict:
+    """``{(cohort_key, metric): [total, count]}`` for every cohort, from the raw tables.
+
+    Archived days (see archive.py) are only left in the daily rollups and are
+    summed from there.
+    """
+    totals = defaultdict(lambda: [0.0, 0])
+    for name, (model, column, _) in health_score.METRICS.items():
+        stmts = [
+            select(*COHORT_COLUMNS, func.sum(column), func.count(column))
+            .select_from(model)
+            .join(User, User.id == model.user_id)
+            .where(health_score.ACTIVE_USERS)
+            .group_by(*COHORT_COLUMNS)
+        ]
+        if since is not None:
+            stmts[0] = stmts[0].where(model.recorded_at >= since)
+        archived_until = archive.horizon(model)
+        if archived_until is not None and (since is None or since < archived_until):
+            rollup = health_score.DAILY_ROLLUPS[name]
+            stmts[0] = stmts[0].where(model.recorded_at >= archived_until)
+            stmts.append(
+                select(*COHORT_COLUMNS, func.sum(rollup.total), func.sum(rollup.count))
+                .select_from(rollup)
+                .join(User, User.id == rollup.user_id)
+                .where(health_score.ACTIVE_USERS, rollup.day < archived_until.date())
+                .group_by(*COHORT_COLUMNS)
+            )
+            if since is not None:
+                stmts[1] = stmts[1].where(rollup.day >= since.date())
+        for stmt in stmts:
+            for row in db.execute(stmt):
+                entry = totals[(cohort_key(row), name)]
+                entry[0] += float(row[-2] or 0)
+                entry[1] += int(row[-1] or 0)
+    return totals
+
+
+def rebuild(db: Session) -> int:
+    """Recompute every cohort's statistics from scratch; returns the row count."""
+    totals = grouped_totals(db)
+    members = select(*COHORT_COLUMNS, func.count()).where(health_score.ACTIVE_USERS).group_by(*COHORT_COLUMNS)
+    for row in db.execute(members):
+        totals[(cohort_key(row), MEMBERS)][1] += row[-1]
+
+    db.execute(delete(CohortStats))
+    if totals:
+        db.execute(insert(CohortStats), [
+            dict(cohort_key=key, metric=metric, total=total, count=count)
+            for (key, metric), (total, count) in totals.items()
+        ])
+    db.commit()
+    return len(totals)
+
+
+def refresh_windows(db: Session, windows=health_score.SCORE_WINDOWS) -> int:
+    """Recompute ``cohort_window_stats`` for the standard score windows."""
+    written = 0
+    for window_days in windows:
+        computed_at = datetime.utcnow()
+        totals = grouped_totals(db, health_score.window_start(window_days))
+        db.execute(delete(CohortWindowStats).where(CohortWindowStats.window_days == window_days))
+        if totals:
+            db.execute(insert(CohortWindowStats), [
+                dict(cohort_key=key, window_days=window_days, metric=metric, total=total, count=count,
+                     computed_at=computed_at)
+                for (key, metric), (total, count) in totals.items()
+            ])
+        db.commit()
+        written += len(totals)
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the precomputed cohort statistics.")
+    parser.add_argument("--windows", action="store_true",
+                        help=f"refresh the {'/'.join(map(str, health_score.SCORE_WINDOWS))}-day window aggregates")
+    parser.add_argument("--assign-cohorts", action="store_true",
+                        help="register missing cohorts and fill users.cohort_id")
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        if args.assign_cohorts:
+            print("🚀 Assigning users to cohorts...")
+            users = assign_cohorts(session)
+            print(f"✅ {users} users assigned")
+        elif args.windows:
+            print("🚀 Refreshing cohort window statistics...")
+            rows = refresh_windows(session)
+            print(f"✅ cohort_window_stats refreshed: {rows} rows")
+        else:
+            print("🚀 Rebuilding cohort statistics...")
+            rows = rebuild(session)
+            print(f"✅ cohort_stats rebuilt: {rows} rows")
+    except Exception as e:
+        session.rollback()
+        print(f"❌ Error rebuilding cohort statistics: {e}")
+    finally:
+        session.close()
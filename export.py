@@ -0,0 +1,183 @@
+"""Streaming export of metric samples as CSV or Parquet.
+
+Exports one metric table for a user, a cohort (``cohorts.id``) or the whole
+population: the archived months first (see archive.py), then the database rows,
+read through a server-side cursor ``EXPORT_CHUNK_SIZE`` rows at a time
+(``yield_per``). Every chunk is encoded and handed on before the next one is
+read (a Parquet row group per chunk), so memory stays flat however large the
+export is. The API endpoints stream the chunks as the response body; from the
+command line:
+
+    python export.py physical_activity --user 42 --output user42.csv
+    python export.py sleep_activity --cohort 3 --format parquet --output cohort3.parquet
+    python export.py blood_tests --since 2025-01-01 --format parquet --output blood_tests.parquet
+"""
+import argparse
+import csv
+import io
+import os
+import sys
+from datetime import datetime
+from typing import Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import select
+
+from create_db import User, PhysicalActivity, SleepActivity, BloodTests
+import archive
+import health_score
+import shards
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "10000"))
+EXPORT_MODELS = {model.__tablename__: model for model in (PhysicalActivity, SleepActivity, BloodTests)}
+MEDIA_TYPES = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+
+def cohort_members(db, cohort_id: int) -> list:
+    return db.execute(select(User.id).where(User.cohort_id == cohort_id, health_score.ACTIVE_USERS)).scalars().all()
+
+
+def deleted_users(db) -> list:
+    return db.execute(select(User.id).where(User.deleted_at.isnot(None))).scalars().all()
+
+
+def archived_batches(model, user_id: Optional[int], cohort_id: Optional[int], since, until, chunk_size: int):
+    """Archived rows of the export; the archive is not per shard, its users are looked up on every shard."""
+    archived_until = archive.horizon(model)
+    if archived_until is None or (since is not None and since >= archived_until):
+        return
+    if user_id is not None:
+        user_ids, excluded = [user_id], ()
+    elif cohort_id is not None:
+        user_ids, excluded = [member for part in shards.scatter(cohort_members, cohort_id) for member in part], ()
+    else:
+        # Users whose deletion job has not reached the archive yet
+        user_ids, excluded = None, [user for part in shards.scatter(deleted_users) for user in part]
+    yield from archive.scan(model, user_ids, excluded, since, until, chunk_size)
+
+
+def record_batches(model, user_id: Optional[int] = None, cohort_id: Optional[int] = None,
+                   since: Optional[datetime] = None, until: Optional[datetime] = None,
+                   chunk_size: int = EXPORT_CHUNK_SIZE):
+    """Rows of ``model`` to export as record batches of at most ``chunk_size`` rows.
+
+    A user's rows come from their shard, a cohort's and everyone's from every
+    shard in turn (see shards.py).
+    """
+    schema = archive.arrow_schema(model)
+    yield from archived_batches(model, user_id, cohort_id, since, until, chunk_size)
+    targets = [shards.shard_of(user_id)] if user_id is not None else shards.SHARDS
+    for shard in targets:
+        session = shard.ReadSessionLocal()
+        try:
+            stmt = (
+                select(*model.__table__.columns)
+                .select_from(model)
+                .join(User, User.id == model.user_id)
+                .where(health_score.ACTIVE_USERS)
+            )
+            if user_id is not None:
+                stmt = stmt.where(model.user_id == user_id)
+            if cohort_id is not None:
+                stmt = stmt.where(User.cohort_id == cohort_id)
+            if since is not None:
+                stmt = stmt.where(model.recorded_at >= since)
+            if until is not None:
+                stmt = stmt.where(model.recorded_at < until)
+            # yield_per streams the result (server-side cursor) instead of buffering it
+            stmt = stmt.order_by(model.id).execution_options(yield_per=chunk_size)
+            for rows in session.execute(stmt).mappings().partitions():
+                yield pa.RecordBatch.from_pylist([dict(row) for row in rows], schema=schema)
+        finally:
+            session.close()
+
+
+def csv_chunks(batches, schema: pa.Schema):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(schema.names)
+    for batch in batches:
+        writer.writerows(zip(*(column.to_pylist() for column in batch.columns)))
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+class ChunkSink:
+    """Write-only file object collecting the Parquet writer's output between chunks."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def parquet_chunks(batches, schema: pa.Schema):
+    sink = ChunkSink()
+    with pq.ParquetWriter(sink, schema, compression="zstd") as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            yield sink.drain()
+    yield sink.drain()
+
+
+def export_chunks(model, fmt: str = "csv", **scope):
+    """Encoded chunks of an export; ``scope`` takes ``user_id``/``cohort_id``, ``since`` and ``until``."""
+    encode = parquet_chunks if fmt == "parquet" else csv_chunks
+    for chunk in encode(record_batches(model, **scope), archive.arrow_schema(model)):
+        if chunk:
+            yield chunk
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the samples of a user, a cohort or everyone as CSV or Parquet.")
+    parser.add_argument("metric", choices=list(EXPORT_MODELS), help="metric table to export")
+    scope = parser.add_mutually_exclusive_group()
+    scope.add_argument("--user", type=int, help="only this user")
+    scope.add_argument("--cohort", type=int, help="only this cohort (cohorts.id)")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="only samples recorded at or after this time")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="only samples recorded before this time")
+    parser.add_argument("--format", choices=list(MEDIA_TYPES), default="csv")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE, help="rows read and written at a time")
+    parser.add_argument("--output", help="file to write (default: stdout)")
+    args = parser.parse_args()
+
+    chunks = export_chunks(EXPORT_MODELS[args.metric], args.format, user_id=args.user, cohort_id=args.cohort,
+                           since=args.since, until=args.until, chunk_size=args.chunk_size)
+    try:
+        if args.output is None:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            return
+        written = 0
+        with open(args.output, "wb") as f:
+            for chunk in chunks:
+                written += f.write(chunk)
+        print(f"✅ {args.metric} exported to {args.output} ({written} bytes)")
+    except Exception as e:
+        print(f"❌ Error exporting {args.metric}: {e}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+"""ORM-free read path of the get and list endpoints.
+
+The endpoints select only the columns of their response model, as tuples, and
+hand the rows to orjson through ``ORJSONResponse``: no entity construction or
+identity map, no per-row Pydantic validation and no ``jsonable_encoder`` pass.
+The rows come straight from our own tables, so they are trusted to match the
+declared ``response_model``, which keeps documenting the payload in the
+OpenAPI schema.
+"""
+from fastapi import Response
+from fastapi.responses import ORJSONResponse
+
+
+def response_columns(model, schema) -> tuple:
+    """Columns of ``model`` named like the fields of the response ``schema``, in field order."""
+    return tuple(getattr(model, name) for name in schema.model_fields)
+
+
+def row_response(row) -> ORJSONResponse:
+    return ORJSONResponse(row._asdict())
+
+
+def rows_response(rows, response: Response) -> ORJSONResponse:
+    """JSON array of ``rows`` with the headers set on the endpoint's ``response`` (e.g. the page cursor).
+
+    FastAPI drops those headers when an endpoint returns a response of its own.
+    """
+    return ORJSONResponse([row._asdict() for row in rows], headers=dict(response.headers))
@@ -0,0 +1,284 @@
+"""Cohort aggregation engine behind ``get_health_score``.
+
+Every metric table is aggregated on its own (``user_id`` filters are served by
+the ``idx_*_user_time`` indexes) and the per-table results are combined in one
+``SELECT`` of scalar subqueries. Averaging the three tables in a single query
+without a join condition made the database walk their cartesian product.
+
+A user's own averages are read from the per-day rollup tables (see
+rollups.py), one row per day instead of every raw sample.
+"""
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import and_, func, select
+from sqlalchemy.orm import Session
+
+from create_db import (
+    User, PhysicalActivity, SleepActivity, BloodTests,
+    PhysicalActivityDaily, SleepActivityDaily, BloodTestsDaily,
+)
+
+# Upper bound on the number of ids sent in one ``IN (...)`` list
+IN_CHUNK_SIZE = 1000
+
+# Score windows in days with precomputed cohort aggregates (see cohort_stats.refresh_windows)
+SCORE_WINDOWS = (7, 30, 90)
+
+# Longest range served by /user/{user_id}/health_score/history
+MAX_HISTORY_DAYS = 731
+
+# metric name -> (table, aggregated column, value used when there are no rows)
+METRICS = {
+    "steps": (PhysicalActivity, PhysicalActivity.steps, 0.0),
+    "sleep": (SleepActivity, SleepActivity.sleep_duration, 0.0),
+    "glucose": (BloodTests, BloodTests.glucose_level, 100.0),
+}
+
+# Users not marked deleted (see user_deletion.py)
+ACTIVE_USERS = User.deleted_at.is_(None)
+
+
+def active_user(user_id: int):
+    """``EXISTS`` condition true while the user is there and not marked deleted (a primary key lookup)."""
+    return select(User.id).where(User.id == user_id, ACTIVE_USERS).exists()
+
+
+# metric name -> per-user daily rollup of its column
+DAILY_ROLLUPS = {
+    "steps": PhysicalActivityDaily,
+    "sleep": SleepActivityDaily,
+    "glucose": BloodTestsDaily,
+}
+
+
+def attribute_filter(user):
+    """Conditions matching ``user``'s four cohort attributes."""
+    return (
+        User.climate_zone == user.climate_zone,
+        User.chronic_conditions == user.chronic_conditions,
+        User.age_group == user.age_group,
+        User.fitness_level == user.fitness_level,
+    )
+
+
+def cohort_filter(user):
+    """Conditions selecting the users that share ``user``'s group.
+
+    Users registered in ``cohorts`` are matched on ``cohort_id``, a single
+    lookup on ``idx_users_cohort``; the attribute columns are the fallback for
+    rows written before ``cohort_stats.assign_cohorts`` ran.
+    """
+    if getattr(user, "cohort_id", None) is not None:
+        return User.cohort_id == user.cohort_id, ACTIVE_USERS
+    return (*attribute_filter(user), ACTIVE_USERS)
+
+
+def cohort_member_ids(user):
+    return select(User.id).where(*cohort_filter(user))
+
+
+def window_start(window_days: Optional[int]) -> Optional[datetime]:
+    """Midnight (UTC) starting the last ``window_days`` calendar days, today included.
+
+    Windows start on a day boundary so that raw samples and daily rollups agree.
+    """
+    if not window_days:
+        return None
+    return datetime.combine(datetime.utcnow().date() - timedelta(days=window_days - 1), datetime.min.time())
+
+
+def in_window(model, since: Optional[datetime], condition):
+    """Restrict ``condition`` to rows recorded at or after ``since``.
+
+    ``user_id = ? AND recorded_at >= ?`` is a range scan on ``idx_*_user_time``.
+    """
+    if since is None:
+        return condition
+    return and_(condition, model.recorded_at >= since)
+
+
+def metric_totals(db: Session, user_filter) -> dict:
+    """``{metric: (total, count)}`` over the rows matched by ``user_filter``.
+
+    ``user_filter`` maps a metric table to its ``WHERE`` clause, e.g.
+    ``lambda model: model.user_id == 1``.
+    """
+    columns = []
+    for name, (model, column, _) in METRICS.items():
+        columns.append(select(func.sum(column)).where(user_filter(model)).scalar_subquery().label(f"{name}_total"))
+        columns.append(select(func.count(column)).where(user_filter(model)).scalar_subquery().label(f"{name}_count"))
+    row = db.execute(select(*columns)).one()._mapping
+    return {name: (float(row[f"{name}_total"] or 0), row[f"{name}_count"]) for name in METRICS}
+
+
+def rollup_condition(rollup, since: Optional[datetime], condition):
+    if since is None:
+        return condition
+    return and_(condition, rollup.day >= since.date())
+
+
+def rollup_average(rollup):
+    return func.sum(rollup.total) / func.sum(rollup.count)
+
+
+def user_averages(db: Session, user_id: int, since: Optional[datetime] = None) -> dict:
+    columns = [
+        select(rollup_average(rollup)).where(rollup_condition(rollup, since, rollup.user_id == user_id))
+        .scalar_subquery().label(name)
+        for name, rollup in DAILY_ROLLUPS.items()
+    ]
+    row = db.execute(select(*columns)).one()._mapping
+    return {
+        name: float(row[name]) if row[name] is not None else default
+        for name, (_, _, default) in METRICS.items()
+    }
+
+
+def chunked(items, size: int = IN_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def user_averages_bulk(db: Session, user_ids, since: Optional[datetime] = None) -> dict:
+    """``user_averages`` for many users: one grouped query per metric table and chunk."""
+    averages = {
+        user_id: {name: default for name, (_, _, default) in METRICS.items()}
+        for user_id in user_ids
+    }
+    for chunk in chunked(list(averages)):
+        for name, rollup in DAILY_ROLLUPS.items():
+            stmt = (
+                select(rollup.user_id, rollup_average(rollup))
+                .where(rollup_condition(rollup, since, rollup.user_id.in_(chunk)))
+                .group_by(rollup.user_id)
+            )
+            for user_id, value in db.execute(stmt):
+                if value is not None:
+                    averages[user_id][name] = float(value)
+    return averages
+
+
+def calculate_health_score(user_values: dict, group_averages: dict) -> float:
+    # Если у пользователя нет данных → Health Score = 0
+    if user_values["steps"] == 0 and user_values["sleep"] == 0 and user_values["glucose"] == 100:
+        return 0
+    health_score = (
+        min(29.9, (user_values["steps"] / (group_averages["steps"] + 1)) * 30) +
+        min(39.9, (user_values["sleep"] / (group_averages["sleep"] + 1)) * 40) +
+        min(29.9, (100 / (user_values["glucose"] + 1)) * 30)
+    )
+    return round(health_score, 2)
+
+
+# metric -> (points, whether a higher value is better) of the percentile-rank score
+PERCENTILE_WEIGHTS = {"steps": (30, True), "sleep": (40, True), "glucose": (30, False)}
+
+
+def percentile_health_score(user_values: dict, ranks: dict) -> float:
+    """Score from the user's percentile rank (0-1) in the cohort on each metric instead of the ratio to its mean."""
+    # Если у пользователя нет данных → Health Score = 0
+    if user_values["steps"] == 0 and user_values["sleep"] == 0 and user_values["glucose"] == 100:
+        return 0
+    health_score = sum(
+        points * (ranks[name] if higher_is_better else 1 - ranks[name])
+        for name, (points, higher_is_better) in PERCENTILE_WEIGHTS.items()
+    )
+    return round(health_score, 2)
+
+
+def period_start(day: date, step: str) -> date:
+    """First day of the ``step`` period containing ``day`` (weeks start on Monday)."""
+    return day - timedelta(days=day.weekday()) if step == "week" else day
+
+
+def period_totals(db: Session, user_filter, start: date, end: date, step: str) -> dict:
+    """``{metric: {period_start: (total, count)}}`` over the daily rollups matched by ``user_filter``.
+
+    One query per metric returns daily sums and counts, which are folded into
+    periods here so the same code serves days and weeks on every dialect.
+    """
+    totals = {}
+    for name, rollup in DAILY_ROLLUPS.items():
+        stmt = (
+            select(rollup.day, func.sum(rollup.total), func.sum(rollup.count))
+            .where(user_filter(rollup), rollup.day >= start, rollup.day <= end)
+            .group_by(rollup.day)
+        )
+        periods = defaultdict(lambda: [0.0, 0])
+        for day, total, count in db.execute(stmt):
+            entry = periods[period_start(day, step)]
+            entry[0] += float(total or 0)
+            entry[1] += count or 0
+        totals[name] = {period: tuple(entry) for period, entry in periods.items()}
+    return totals
+
+
+def series_averages(totals: dict) -> dict:
+    """``{metric: {period_start: average}}`` of ``period_totals``; periods without samples are left out."""
+    return {
+        name: {period: total / count for period, (total, count) in periods.items() if count}
+        for name, periods in totals.items()
+    }
+
+
+def period_averages(db: Session, user_filter, start: date, end: date, step: str) -> dict:
+    """``series_averages`` of ``period_totals``."""
+    return series_averages(period_totals(db, user_filter, start, end, step))
+
+
+def cohort_period_totals(db: Session, user, start: date, end: date, step: str) -> dict:
+    """``period_totals`` of the members of ``user``'s cohort."""
+    member_ids = cohort_member_ids(user)
+    return period_totals(db, lambda rollup: rollup.user_id.in_(member_ids), start, end, step)
+
+
+def score_history(db: Session, user, start: date, end: date, step: str, cohort_series: Optional[dict] = None) -> list:
+    """Health score per period from ``start`` to ``end`` (inclusive).
+
+    Each period compares the user's averages with their cohort's averages over
+    the same period. Periods without any sample of the user are left out.
+    ``cohort_series`` (``series_averages`` of the cohort) replaces the cohort
+    read on ``db``, e.g. with the cohort summed over every shard.
+    """
+    user_series = period_averages(db, lambda rollup: rollup.user_id == user.id, start, end, step)
+    if cohort_series is None:
+        cohort_series = series_averages(cohort_period_totals(db, user, start, end, step))
+
+    points = []
+    for period in sorted(set().union(*user_series.values())):
+        user_values = {name: user_series[name].get(period, default) for name, (_, _, default) in METRICS.items()}
+        group_averages = {name: cohort_series[name].get(period, default) for name, (_, _, default) in METRICS.items()}
+        points.append({
+            "period_start": period,
+            "health_score": calculate_health_score(user_values, group_averages),
+            "user_data": {name: round(value, 2) for name, value in user_values.items()},
+            "group_averages": {name: round(value, 2) for name, value in group_averages.items()},
+        })
+    return points
+
+
+def score_report(user, user_values: dict, group_size: int, group_averages: dict) -> dict:
+    """Body of a health score response, without timing."""
+    return {
+        "user_id": user.id,
+        "health_score": calculate_health_score(user_values, group_averages),
+        "user_data": {name: round(value, 2) for name, value in user_values.items()},
+        "group_averages": {name: round(value, 2) for name, value in group_averages.items()},
+        "user_group": {
+            "group_size": group_size,
+            "age_group": user.age_group,
+            "fitness_level": user.fitness_level,
+            "climate_zone": user.climate_zone,
+            "chronic_conditions": user.chronic_conditions
+        }
+    }
+
+
+def percentile_report(user, user_values: dict, group_size: int, group_averages: dict, ranks: dict) -> dict:
+    """``score_report`` scored by percentile rank, with the ranks as ``percentiles`` (0-100)."""
+    report = score_report(user, user_values, group_size, group_averages)
+    report["health_score"] = percentile_health_score(user_values, ranks)
+    report["percentiles"] = {name: round(rank * 100, 1) for name, rank in ranks.items()}
+    return report
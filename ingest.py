@@ -0,0 +1,96 @@
+"""Bulk ingestion of metric samples for wearable sync uploads.
+
+A batch is validated item by item, every valid sample is written with
+multi-row ``INSERT`` statements, and ``cohort_stats`` and the daily rollups
+receive one delta per cohort (or user and day) and metric instead of one per
+sample; each touched cohort quantile sketch is read and written once. Nothing is committed here: the calling endpoint commits the whole
+batch as one transaction.
+"""
+from collections import defaultdict
+from datetime import datetime
+
+from pydantic import ValidationError
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from create_db import User
+import cohort_stats
+import health_score
+import quantile_sketches
+import rollups
+
+MAX_BULK_ITEMS = 10000
+INSERT_CHUNK_SIZE = 1000
+
+
+def rejected(detail) -> dict:
+    return {"status": "rejected", "detail": detail}
+
+
+def is_user_id(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def load_users(db: Session, user_ids) -> dict:
+    users = {}
+    for chunk in health_score.chunked(list(user_ids)):
+        users.update({user.id: user for user in db.query(User).filter(User.id.in_(chunk), health_score.ACTIVE_USERS)})
+    return users
+
+
+def ingest(db: Session, samples, schemas: dict):
+    """Validate and insert ``(metric, user_id, payload)`` samples.
+
+    ``schemas`` maps a metric name to its ``(table, pydantic model)``. Returns
+    one status per sample, in order, and the ``{user_id: cohort_key}`` of the
+    users whose data changed.
+    """
+    statuses = [None] * len(samples)
+    users = load_users(db, {user_id for _, user_id, _ in samples if is_user_id(user_id)})
+    now = datetime.utcnow()
+
+    rows_by_model = defaultdict(list)
+    for index, (metric, user_id, payload) in enumerate(samples):
+        if not isinstance(metric, str) or metric not in schemas:
+            statuses[index] = rejected(f"Unknown metric: {metric}")
+            continue
+        user = users.get(user_id) if is_user_id(user_id) else None
+        if user is None:
+            statuses[index] = rejected("User does not exist")
+            continue
+        model, schema = schemas[metric]
+        try:
+            item = schema.model_validate(payload)
+        except ValidationError as e:
+            statuses[index] = rejected(e.errors(include_url=False, include_context=False))
+            continue
+        row = item.model_dump()
+        row["user_id"] = user.id
+        row["recorded_at"] = row.get("recorded_at") or now
+        rows_by_model[model].append(row)
+        statuses[index] = {"status": "created"}
+
+    touched = {}
+    deltas = defaultdict(lambda: [0.0, 0])
+    sketch_samples = defaultdict(list)
+    for model, rows in rows_by_model.items():
+        for chunk in health_score.chunked(rows, INSERT_CHUNK_SIZE):
+            db.execute(insert(model), chunk)
+
+        metric, column = cohort_stats.METRIC_BY_MODEL[model]
+        rollups.add_samples(db, model, [(row["user_id"], row["recorded_at"], row.get(column.key)) for row in rows])
+        for row in rows:
+            user = users[row["user_id"]]
+            touched[user.id] = cohort_stats.cohort_key(user)
+            value = row.get(column.key)
+            sketch_samples[(touched[user.id], model)].append((row["recorded_at"], value))
+            if value is not None:
+                delta = deltas[(touched[user.id], metric)]
+                delta[0] += float(value)
+                delta[1] += 1
+
+    for (key, metric), (total, count) in deltas.items():
+        cohort_stats.apply_delta(db, key, metric, total, count)
+    for (key, model), rows in sketch_samples.items():
+        quantile_sketches.add_samples(db, key, model, rows)
+    return statuses, touched
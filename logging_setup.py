@@ -0,0 +1,142 @@
+"""Queue-based logging for the API.
+
+Request threads and the event loop only put records on an in-memory queue
+(``QueueHandler``); a ``QueueListener`` thread formats them and does the file
+and console I/O. Configuration comes from the environment:
+
+    LOG_LEVEL               level of the app and uvicorn loggers (default INFO)
+    LOG_FORMAT              json (default) or text
+    LOG_FILE                rotated daily, 7 backups (default <project>.log)
+    ACCESS_LOG_SAMPLE_RATE  share of successful uvicorn access lines kept (default 1.0)
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+ACCESS_LOG_SAMPLE_RATE = float(os.getenv("ACCESS_LOG_SAMPLE_RATE", "1.0"))
+
+TEXT_FORMAT = (
+    '%(asctime)s - [PID: %(process)d] - [Thread ID: %(thread)d] - %(module)s - %(name)s - %(levelname)s - %(funcName)s - %(message)s'
+)
+
+# Attributes every LogRecord has; anything else was passed through ``extra=``
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the record's fields and its ``extra`` values."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "function": record.funcName,
+            "process": record.process,
+            "thread": record.thread,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class StructuredQueueHandler(QueueHandler):
+    """``QueueHandler`` that keeps the traceback apart from the message.
+
+    The stock handler merges both into ``msg``, which would hide the exception
+    from ``JsonFormatter``.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class AccessLogSampler(logging.Filter):
+    """Keep a ``rate`` share of uvicorn access lines; errors (status >= 400) are always kept."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if self.rate >= 1:
+            return True
+        args = record.args if isinstance(record.args, tuple) else ()
+        status = args[-1] if args else None
+        if isinstance(status, int) and status >= 400:
+            return True
+        return random.random() < self.rate
+
+
+# (pid, listener) of the last configure_logging call: the listener thread does not survive a fork
+_configured = None
+
+
+def configure_logging(project_name: str) -> QueueListener:
+    """Route the root and uvicorn loggers through a queue; returns the started listener.
+
+    Repeated calls in the same process return the running listener, so every
+    worker can call it at startup.
+    """
+    global _configured
+    if _configured is not None and _configured[0] == os.getpid():
+        return _configured[1]
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+
+    # Create a TimedRotatingFileHandler for logging to a file with rotation at midnight
+    file_handler = TimedRotatingFileHandler(
+        filename=os.getenv("LOG_FILE", f"{project_name}.log"),
+        when='midnight',
+        interval=1,
+        backupCount=7
+    )
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(StructuredQueueHandler(log_queue))
+    root.setLevel(LOG_LEVEL)
+
+    # uvicorn's loggers propagate to the root queue instead of writing themselves
+    for name in ["uvicorn", "uvicorn.access", "uvicorn.error"]:
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers.clear()
+        uvicorn_logger.propagate = True
+        uvicorn_logger.setLevel(LOG_LEVEL)
+    logging.getLogger("uvicorn.access").addFilter(AccessLogSampler(ACCESS_LOG_SAMPLE_RATE))
+
+    # **🔹 ОТКЛЮЧАЕМ лишние DEBUG-логи от `aiormq`, `aio_pika`, `pika`**
+    for logger_name in ["aiormq", "aio_pika", "pika", "aiomysql", "aiosqlite", "aiogram"]:
+        logging.getLogger(logger_name).setLevel(logging.WARNING)
+
+    logging.info("[Logging] ✅ Конфигурация логирования завершена!")
+    _configured = (os.getpid(), listener)
+    return listener
@@ -1,74 +1,146 @@
+import asyncio
 import logging
-from logging.handlers import TimedRotatingFileHandler
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy import func
-from sqlalchemy.orm import Session
-from create_db import SessionLocal, User, PhysicalActivity, SleepActivity, BloodTests
-from datetime import datetime, UTC
+import os
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, BackgroundTasks, FastAPI, Depends, HTTPException, Body, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from create_db import DB_ASYNC, PARTITION_METRICS, READ_REPLICA, READ_REPLICA_LAG_SECONDS, engine, read_engine, async_engine, async_read_engine, ThreadedSession, check_engine, warm_up_engines, dispose_engines, User, Cohort, PhysicalActivity, SleepActivity, BloodTests, HealthScore
+from datetime import date, datetime, timedelta, UTC
 import uuid
+import json
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Literal, Optional, List
+import health_score as health_score_engine
+import cohort_stats
+import ingest
+import rollups
+import user_deletion
+import fast_read
+import export
+import quantile_sketches
+import shards
+from pagination import PageParams, fetch_page
+from score_cache import create_score_cache
+from logging_setup import configure_logging
+import metrics
 
 project_name = "Health_Tracker_API"
-app = FastAPI(title=project_name)
-
-def get_db():
-    db = SessionLocal()
+router = APIRouter()
+metrics.instrument_engines(engine, read_engine, async_engine, async_read_engine)
+metrics.instrument_engines(*(shard_engine for shard in shards.SHARDS[1:] for shard_engine in shard.engines()))
+
+async def open_session(async_factory, sync_factory):
+    if DB_ASYNC:
+        async with async_factory() as db:
+            yield db
+        return
+    db = ThreadedSession(sync_factory(expire_on_commit=False))
     try:
         yield db
     finally:
-        db.close()
-def configure_logging():
-    # Create a TimedRotatingFileHandler for logging to a file with rotation at midnight
-    file_handler = TimedRotatingFileHandler(
-        filename=f'{project_name}.log',
-        when='midnight',
-        interval=1,
-        backupCount=7
-    )
-    file_handler.setLevel(logging.DEBUG)
-    formatter = logging.Formatter(
-        '%(asctime)s - [PID: %(process)d] - [Thread ID: %(thread)d] - %(module)s - %(name)s - %(levelname)s - %(funcName)s - %(message)s'
-    )
-    file_handler.setFormatter(formatter)
-
-    # Create a StreamHandler for logging to the console
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.DEBUG)
-    console_handler.setFormatter(formatter)
+        await db.close()
 
-    # Configure the root logger
-    logging.basicConfig(handlers=[file_handler, console_handler], level=logging.DEBUG)
-
-    # Apply the logging configuration to `uvicorn`
-    uvicorn_logger = logging.getLogger("uvicorn")
-    uvicorn_logger.handlers.clear()  # Clear existing handlers
-    uvicorn_logger.addHandler(file_handler)
-    uvicorn_logger.addHandler(console_handler)
-    uvicorn_logger.setLevel(logging.DEBUG)
-
-    uvicorn_access_logger = logging.getLogger("uvicorn.access")
-    uvicorn_access_logger.handlers.clear()
-    uvicorn_access_logger.addHandler(file_handler)
-    uvicorn_access_logger.addHandler(console_handler)
-    uvicorn_access_logger.setLevel(logging.DEBUG)
-
-    uvicorn_error_logger = logging.getLogger("uvicorn.error")
-    uvicorn_error_logger.handlers.clear()
-    uvicorn_error_logger.addHandler(file_handler)
-    uvicorn_error_logger.addHandler(console_handler)
-    uvicorn_error_logger.setLevel(logging.DEBUG)
+async def request_route(request: Request):
+    """Shard (and target shard of a move) of the ``user_id`` path parameter; shard 0 without one (see shards.py)."""
+    user_id = request.path_params.get("user_id")
+    if not shards.SHARDED or user_id is None:
+        return 0, None
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return 0, None
+    return await run_in_threadpool(shards.route, user_id)
+
+async def get_db(request: Request):
+    """Session on the primary database of the user's shard, for endpoints that write."""
+    index, moving_to = await request_route(request)
+    if moving_to is not None:
+        raise HTTPException(status_code=503, detail="User is being moved to another shard, retry shortly",
+                            headers={"Retry-After": str(shards.SHARD_CACHE_SECONDS)})
+    shard = shards.SHARDS[index]
+    async for db in open_session(shard.AsyncSessionLocal, shard.SessionLocal):
+        yield db
 
-    # **🔹 ОТКЛЮЧАЕМ лишние DEBUG-логи от `aiormq`, `aio_pika`, `pika`**
-    for logger_name in ["aiormq", "aio_pika", "pika", "aiomysql", "aiogram"]:
-        logging.getLogger(logger_name).setLevel(logging.WARNING)  # ⬅ Теперь не спамят в логи
+async def get_read_db(request: Request):
+    """Session on the read replica of the user's shard (its primary if none is configured) for read-only endpoints."""
+    index, _ = await request_route(request)
+    shard = shards.SHARDS[index]
+    async for db in open_session(shard.AsyncReadSessionLocal, shard.ReadSessionLocal):
+        yield db
 
-    logging.info("[Logging] ✅ Конфигурация логирования завершена!")
+async def group_summary(db: AsyncSession, user, window: Optional[int] = None):
+    """Size and averages of the user's cohort, summed over every shard when sharded."""
+    if shards.SHARDED:
+        return await run_in_threadpool(cohort_stats.sharded_summary, user, window)
+    if window:
+        return await db.run_sync(cohort_stats.cohort_window_summary, user, window)
+    return await db.run_sync(cohort_stats.cohort_summary, user)
 
 
-configure_logging()
 logger = logging.getLogger(project_name)
-logger.info(f' {project_name} Started')
+# Scores and cohort averages are read from the replica: see score_cache on its lag
+score_cache = create_score_cache(READ_REPLICA_LAG_SECONDS if READ_REPLICA else 0)
+
+# Lean writes: no write re-reads its row after the commit, the responses are
+# built from the written values. LEAN_WRITES=0 restores the refresh.
+LEAN_WRITES = os.getenv("LEAN_WRITES", "1") == "1"
+# With a shared cache (Redis) metric inserts also take the user's cohort key from
+# it and let the users.id foreign key reject deleted users (404) instead of
+# looking the user up; a per-process LRU would keep a key that another worker
+# dropped on a user update or delete. Partitioned metric tables have no foreign
+# keys to back a cached key up. Otherwise every insert selects the user first.
+CACHED_MEMBERS = LEAN_WRITES and not PARTITION_METRICS and score_cache.shared
+
+async def member_cohort_key(db: AsyncSession, user_id: int) -> Optional[str]:
+    """Cohort key of a user, ``None`` if there is no such user."""
+    if CACHED_MEMBERS:
+        cohort_key = await score_cache.get_member_cohort(user_id)
+        if cohort_key is not None:
+            return cohort_key
+    user = (await db.execute(select(*cohort_stats.COHORT_COLUMNS).where(User.id == user_id, health_score_engine.ACTIVE_USERS))).first()
+    if user is None:
+        return None
+    cohort_key = cohort_stats.cohort_key(user)
+    if CACHED_MEMBERS:
+        await score_cache.set_member_cohort(user_id, cohort_key)
+    return cohort_key
+
+async def active_cohort_key(db: AsyncSession, user_id: int) -> str:
+    """``member_cohort_key`` of a user the sample endpoints may write for; 404 for unknown and deleted users."""
+    cohort_key = await member_cohort_key(db, user_id)
+    if cohort_key is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return cohort_key
+
+async def create_sample(db: AsyncSession, model, sample):
+    """Insert one metric sample with its rollup and cohort deltas and commit it.
+
+    The response is built from the inserted object: the generated id and
+    ``recorded_at`` are set on it by the flush.
+    """
+    cohort_key = await active_cohort_key(db, sample.user_id)
+    db.add(sample)
+    try:
+        await db.flush()
+    except IntegrityError:
+        # users.id foreign key: the user was deleted after its cohort key was cached
+        await db.rollback()
+        await score_cache.forget_member(sample.user_id)
+        raise HTTPException(status_code=404, detail="User not found")
+    await db.run_sync(rollups.record_sample, model, sample)
+    await db.run_sync(cohort_stats.record_sample, cohort_key, model, cohort_stats.sample_value(model, sample))
+    await db.run_sync(quantile_sketches.add_samples, cohort_key, model,
+                      [(sample.recorded_at, cohort_stats.sample_value(model, sample))])
+    await db.commit()
+    await score_cache.invalidate_user(sample.user_id, cohort_key)
+    if not LEAN_WRITES:
+        await db.refresh(sample)
+    return sample
 ### 🔹 USER CRUD
 
 class UserUpdate(BaseModel):
@@ -107,69 +179,145 @@ class UserResponse(BaseModel):
     class Config:
         from_attributes = True
 
-@app.post("/users/", response_model=dict)
-def create_user(user_data: UserCreate, db: Session = Depends(get_db)):
+# Columns read by the get and list endpoints (see fast_read.py)
+USER_COLUMNS = fast_read.response_columns(User, UserResponse)
+
+async def insert_user(db: AsyncSession, new_user: User):
+    await db.run_sync(cohort_stats.assign_cohort, new_user)
+    db.add(new_user)
+    await db.run_sync(cohort_stats.add_member, new_user)
+    cohort_key = cohort_stats.cohort_key(new_user)
+    await db.commit()
+    await score_cache.invalidate_cohort(cohort_key)
+    if not LEAN_WRITES:
+        await db.refresh(new_user)
+
+@router.post("/users/", response_model=dict)
+async def create_user(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
     try:
-        existing_user = db.query(User).filter(User.uuid == user_data.uuid).first()
+        existing_user = (await db.execute(select(User).where(User.uuid == user_data.uuid))).scalars().first()
         if existing_user:
             raise HTTPException(status_code=400, detail="User with this UUID already exists")
         new_user = User(**user_data.dict())
-        db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        if not shards.SHARDED:
+            await insert_user(db, new_user)
+        else:
+            # Id and shard come from the directory on shard 0, the row goes to the user's shard
+            entry = await run_in_threadpool(shards.register, new_user.uuid)
+            if entry is None:
+                raise HTTPException(status_code=400, detail="User with this UUID already exists")
+            new_user.id, index = entry
+            shard = shards.SHARDS[index]
+            try:
+                async for shard_db in open_session(shard.AsyncSessionLocal, shard.SessionLocal):
+                    await insert_user(shard_db, new_user)
+            except Exception:
+                await run_in_threadpool(shards.unregister, new_user.id)
+                raise
         return {"message": "User created successfully", "user_id": new_user.id, "uuid": new_user.uuid}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
 
-@app.get("/users/{user_id}", response_model=UserResponse)
-def get_user(user_id: int, db: Session = Depends(get_db)):
+@router.get("/users/{user_id}", response_model=UserResponse)
+async def get_user(user_id: int, db: AsyncSession = Depends(get_read_db)):
     try:
-        user = db.query(User).filter(User.id == user_id).first()
+        user = (await db.execute(select(*USER_COLUMNS).where(User.id == user_id, health_score_engine.ACTIVE_USERS))).first()
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
-        return user  # ✅ Теперь FastAPI корректно сериализует ответ через Pydantic
+        return fast_read.row_response(user)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
 
-@app.put("/users/{user_id}", response_model=dict)
-def update_user(user_id: int, user_data: UserUpdate, db: Session = Depends(get_db)):
+@router.put("/users/{user_id}", response_model=dict)
+async def update_user(user_id: int, user_data: UserUpdate, db: AsyncSession = Depends(get_db)):
     try:
-        user = db.query(User).filter(User.id == user_id).first()
+        user = (await db.execute(select(User).where(User.id == user_id, health_score_engine.ACTIVE_USERS))).scalars().first()
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
+        old_cohort_key = cohort_stats.cohort_key(user)
         for key, value in user_data.dict(exclude_unset=True).items():
             setattr(user, key, value)
+        new_cohort_key = cohort_stats.cohort_key(user)
+        if new_cohort_key != old_cohort_key or user.cohort_id is None:
+            await db.run_sync(cohort_stats.assign_cohort, user)
+        await db.run_sync(cohort_stats.move_user, user.id, old_cohort_key, new_cohort_key)
 
         user.updated_at = datetime.now(UTC)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        if old_cohort_key != new_cohort_key:
+            await score_cache.forget_member(user_id)
+            await score_cache.invalidate_user(user_id, old_cohort_key, new_cohort_key)
+        else:
+            await score_cache.invalidate_user(user_id)
+        if not LEAN_WRITES:
+            await db.refresh(user)
 
         return {"message": "User updated successfully", "user_id": user.id}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
 
-@app.delete("/users/{user_id}", response_model=dict)
-def delete_user(user_id: int, db: Session = Depends(get_db)):
+@router.delete("/users/{user_id}", response_model=dict, status_code=202)
+async def delete_user(user_id: int, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db)):
+    """Hide the user at once and delete their data in the background (see user_deletion.py)."""
     try:
-        user = db.query(User).filter(User.id == user_id).first()
+        user = (await db.execute(select(User).where(User.id == user_id, health_score_engine.ACTIVE_USERS))).scalars().first()
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        db.query(BloodTests).filter(BloodTests.user_id == user_id).delete()
-        db.query(SleepActivity).filter(SleepActivity.user_id == user_id).delete()
-        db.query(PhysicalActivity).filter(PhysicalActivity.user_id == user_id).delete()
+        job = await db.run_sync(user_deletion.mark_deleted, user)
+        cohort_key = cohort_stats.cohort_key(user)
+        await db.commit()
+        await score_cache.forget_member(user_id)
+        await score_cache.invalidate_user(user_id, cohort_key)
+        background_tasks.add_task(user_deletion.process_job, job.id, shards.shard_of(user_id).SessionLocal)
 
-        db.delete(user)
-        db.commit()
+        return {"message": "User deletion started", "job_id": job.id, "rows_total": job.rows_total}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
-        return {"message": "User deleted successfully"}
+
+@router.get("/user/{user_id}/deletion", response_model=dict)
+async def get_user_deletion(user_id: int, db: AsyncSession = Depends(get_read_db)):
+    """Progress of the user's deletion job."""
+    try:
+        if shards.SHARDED:
+            # Done jobs have removed the user from the directory, which then routes to shard 0
+            job = await run_in_threadpool(user_deletion.sharded_latest_job, user_id)
+        else:
+            job = await db.run_sync(user_deletion.latest_job, user_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="No deletion job for this user")
+        progress = 1.0 if job.status == "done" else round(min(1.0, job.rows_deleted / job.rows_total), 4) if job.rows_total else 0.0
+        return {
+            "job_id": job.id,
+            "user_id": job.user_id,
+            "status": job.status,
+            "rows_total": job.rows_total,
+            "rows_deleted": job.rows_deleted,
+            "progress": progress,
+            "error": job.error,
+            "created_at": job.created_at,
+            "updated_at": job.updated_at,
+            "finished_at": job.finished_at,
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
@@ -197,88 +345,105 @@ class PhysicalActivityResponse(BaseModel):
     class Config:
         from_attributes = True
 
-@app.post("/user/{user_id}/physical_activity/", response_model=PhysicalActivityResponse)
-def create_physical_activity(user_id: int, activity_data: PhysicalActivityCreate, db: Session = Depends(get_db)):
-    try:
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=400, detail="User does not exist")
+# Columns read by the get and list endpoints (see fast_read.py)
+PHYSICAL_ACTIVITY_COLUMNS = fast_read.response_columns(PhysicalActivity, PhysicalActivityResponse)
 
-        new_activity = PhysicalActivity(**activity_data.dict(), user_id=user_id)
-        db.add(new_activity)
-        db.commit()
-        db.refresh(new_activity)
-        return new_activity
+@router.post("/user/{user_id}/physical_activity/", response_model=PhysicalActivityResponse)
+async def create_physical_activity(user_id: int, activity_data: PhysicalActivityCreate, db: AsyncSession = Depends(get_db)):
+    try:
+        return await create_sample(db, PhysicalActivity, PhysicalActivity(**activity_data.dict(), user_id=user_id))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
 
-@app.get("/user/{user_id}/physical_activity/{activity_id}", response_model=PhysicalActivityResponse)
-def get_physical_activity(user_id: int, activity_id: int, db: Session = Depends(get_db)):
+@router.get("/user/{user_id}/physical_activity/{activity_id}", response_model=PhysicalActivityResponse)
+async def get_physical_activity(user_id: int, activity_id: int, db: AsyncSession = Depends(get_read_db)):
     try:
-        activity = db.query(PhysicalActivity).filter(
-            PhysicalActivity.id == activity_id, PhysicalActivity.user_id == user_id
-        ).first()
+        activity = (await db.execute(select(*PHYSICAL_ACTIVITY_COLUMNS).where(
+            PhysicalActivity.id == activity_id, PhysicalActivity.user_id == user_id, health_score_engine.active_user(user_id)
+        ))).first()
 
         if not activity:
             raise HTTPException(status_code=404, detail="Activity not found or access denied")
 
-        return activity
+        return fast_read.row_response(activity)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
 
-@app.get("/user/{user_id}/physical_activity/", response_model=List[PhysicalActivityResponse])
-def get_all_physical_activities(user_id: int, db: Session = Depends(get_db)):
+@router.get("/user/{user_id}/physical_activity/", response_model=List[PhysicalActivityResponse])
+async def get_all_physical_activities(user_id: int, response: Response, page: PageParams = Depends(), db: AsyncSession = Depends(get_read_db)):
     try:
-        activities = db.query(PhysicalActivity).filter(PhysicalActivity.user_id == user_id).all()
+        activities = await fetch_page(db, PhysicalActivity, user_id, page, response, PHYSICAL_ACTIVITY_COLUMNS)
         if not activities:
             raise HTTPException(status_code=404, detail="Activity not found or access denied")
-        return activities
+        return fast_read.rows_response(activities, response)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
 
-@app.put("/user/{user_id}/physical_activity/{activity_id}", response_model=PhysicalActivityResponse)
-def update_physical_activity(user_id: int, activity_id: int, activity_data: PhysicalActivityUpdate, db: Session = Depends(get_db)):
+@router.put("/user/{user_id}/physical_activity/{activity_id}", response_model=PhysicalActivityResponse)
+async def update_physical_activity(user_id: int, activity_id: int, activity_data: PhysicalActivityUpdate, db: AsyncSession = Depends(get_db)):
     try:
-        activity = db.query(PhysicalActivity).filter(
+        cohort_key = await active_cohort_key(db, user_id)
+        activity = (await db.execute(select(PhysicalActivity).where(
             PhysicalActivity.id == activity_id,
             PhysicalActivity.user_id == user_id
-        ).first()
+        ))).scalars().first()
 
         if not activity:
             raise HTTPException(status_code=404, detail="Activity not found or access denied")
 
         # 🔹 Исправленный отступ
+        old_value = cohort_stats.sample_value(PhysicalActivity, activity)
+        old_entry = rollups.sample_entry(PhysicalActivity, activity)
         for key, value in activity_data.dict(exclude_unset=True).items():
             setattr(activity, key, value)
+        await db.run_sync(rollups.refresh_days, PhysicalActivity, user_id, [old_entry], [rollups.sample_entry(PhysicalActivity, activity)])
+        await db.run_sync(cohort_stats.record_change, cohort_key, PhysicalActivity, old_value, cohort_stats.sample_value(PhysicalActivity, activity))
 
-        db.commit()
-        db.refresh(activity)
+        await db.commit()
+        await score_cache.invalidate_user(user_id, cohort_key)
+        if not LEAN_WRITES:
+            await db.refresh(activity)
         return activity
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
 
-@app.delete("/user/{user_id}/physical_activity/{activity_id}", status_code=204)
-def delete_physical_activity(user_id: int, activity_id: int, db: Session = Depends(get_db)):
+@router.delete("/user/{user_id}/physical_activity/{activity_id}", status_code=204)
+async def delete_physical_activity(user_id: int, activity_id: int, db: AsyncSession = Depends(get_db)):
     try:
-        activity = db.query(PhysicalActivity).filter(
+        cohort_key = await active_cohort_key(db, user_id)
+        activity = (await db.execute(select(PhysicalActivity).where(
             PhysicalActivity.id == activity_id, PhysicalActivity.user_id == user_id
-        ).first()
+        ))).scalars().first()
 
         if not activity:
             raise HTTPException(status_code=404, detail="Activity not found or access denied")
 
-        db.delete(activity)
-        db.commit()
+        await db.run_sync(cohort_stats.record_sample, cohort_key, PhysicalActivity, cohort_stats.sample_value(PhysicalActivity, activity), -1)
+        entry = rollups.sample_entry(PhysicalActivity, activity)
+        await db.delete(activity)
+        await db.run_sync(rollups.refresh_days, PhysicalActivity, user_id, [entry])
+        await db.commit()
+        await score_cache.invalidate_user(user_id, cohort_key)
         return None
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
@@ -302,81 +467,98 @@ class SleepActivityResponse(BaseModel):
     class Config:
         from_attributes = True
 
-@app.post("/user/{user_id}/sleep_activity/", response_model=SleepActivityResponse)
-def create_sleep_activity(user_id: int, sleep_data: SleepActivityCreate, db: Session = Depends(get_db)):
-    try:
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=400, detail="User does not exist")
+# Columns read by the get and list endpoints (see fast_read.py)
+SLEEP_ACTIVITY_COLUMNS = fast_read.response_columns(SleepActivity, SleepActivityResponse)
 
-        new_sleep = SleepActivity(**sleep_data.dict(), user_id=user_id)
-        db.add(new_sleep)
-        db.commit()
-        db.refresh(new_sleep)
-        return new_sleep
+@router.post("/user/{user_id}/sleep_activity/", response_model=SleepActivityResponse)
+async def create_sleep_activity(user_id: int, sleep_data: SleepActivityCreate, db: AsyncSession = Depends(get_db)):
+    try:
+        return await create_sample(db, SleepActivity, SleepActivity(**sleep_data.dict(), user_id=user_id))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
-@app.get("/user/{user_id}/sleep_activity/{sleep_id}", response_model=SleepActivityResponse)
-def get_sleep_activity(user_id: int, sleep_id: int, db: Session = Depends(get_db)):
+@router.get("/user/{user_id}/sleep_activity/{sleep_id}", response_model=SleepActivityResponse)
+async def get_sleep_activity(user_id: int, sleep_id: int, db: AsyncSession = Depends(get_read_db)):
     try:
-        sleep = db.query(SleepActivity).filter(
-        SleepActivity.id == sleep_id, SleepActivity.user_id == user_id
-    ).first()
+        sleep = (await db.execute(select(*SLEEP_ACTIVITY_COLUMNS).where(
+        SleepActivity.id == sleep_id, SleepActivity.user_id == user_id, health_score_engine.active_user(user_id)
+    ))).first()
 
         if not sleep:
             raise HTTPException(status_code=404, detail="Sleep activity not found or access denied")
 
-        return sleep
+        return fast_read.row_response(sleep)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
-@app.get("/user/{user_id}/sleep_activity/", response_model=List[SleepActivityResponse])
-def get_all_sleep_activities(user_id: int, db: Session = Depends(get_db)):
+@router.get("/user/{user_id}/sleep_activity/", response_model=List[SleepActivityResponse])
+async def get_all_sleep_activities(user_id: int, response: Response, page: PageParams = Depends(), db: AsyncSession = Depends(get_read_db)):
     try:
-        sleeps = db.query(SleepActivity).filter(SleepActivity.user_id == user_id).all()
+        sleeps = await fetch_page(db, SleepActivity, user_id, page, response, SLEEP_ACTIVITY_COLUMNS)
         if not sleeps:
             raise HTTPException(status_code=404, detail="Sleep activity not found or access denied")
-        return sleeps
+        return fast_read.rows_response(sleeps, response)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
-@app.put("/user/{user_id}/sleep_activity/{sleep_id}", response_model=SleepActivityResponse)
-def update_sleep_activity(user_id: int, sleep_id: int, sleep_data: SleepActivityUpdate, db: Session = Depends(get_db)):
+@router.put("/user/{user_id}/sleep_activity/{sleep_id}", response_model=SleepActivityResponse)
+async def update_sleep_activity(user_id: int, sleep_id: int, sleep_data: SleepActivityUpdate, db: AsyncSession = Depends(get_db)):
     try:
-        sleep = db.query(SleepActivity).filter(
+        cohort_key = await active_cohort_key(db, user_id)
+        sleep = (await db.execute(select(SleepActivity).where(
         SleepActivity.id == sleep_id, SleepActivity.user_id == user_id
-    ).first()
+    ))).scalars().first()
 
         if not sleep:
             raise HTTPException(status_code=404, detail="Sleep activity not found or access denied")
 
+        old_value = cohort_stats.sample_value(SleepActivity, sleep)
+        old_entry = rollups.sample_entry(SleepActivity, sleep)
         for key, value in sleep_data.dict(exclude_unset=True).items():
             setattr(sleep, key, value)
+        await db.run_sync(rollups.refresh_days, SleepActivity, user_id, [old_entry], [rollups.sample_entry(SleepActivity, sleep)])
+        await db.run_sync(cohort_stats.record_change, cohort_key, SleepActivity, old_value, cohort_stats.sample_value(SleepActivity, sleep))
 
-        db.commit()
-        db.refresh(sleep)
+        await db.commit()
+        await score_cache.invalidate_user(user_id, cohort_key)
+        if not LEAN_WRITES:
+            await db.refresh(sleep)
         return sleep
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
-@app.delete("/user/{user_id}/sleep_activity/{sleep_id}", status_code=204)
-def delete_sleep_activity(user_id: int, sleep_id: int, db: Session = Depends(get_db)):
+@router.delete("/user/{user_id}/sleep_activity/{sleep_id}", status_code=204)
+async def delete_sleep_activity(user_id: int, sleep_id: int, db: AsyncSession = Depends(get_db)):
     try:
-        sleep = db.query(SleepActivity).filter(
+        cohort_key = await active_cohort_key(db, user_id)
+        sleep = (await db.execute(select(SleepActivity).where(
         SleepActivity.id == sleep_id, SleepActivity.user_id == user_id
-    ).first()
+    ))).scalars().first()
 
         if not sleep:
             raise HTTPException(status_code=404, detail="Sleep activity not found or access denied")
 
-        db.delete(sleep)
-        db.commit()
+        await db.run_sync(cohort_stats.record_sample, cohort_key, SleepActivity, cohort_stats.sample_value(SleepActivity, sleep), -1)
+        entry = rollups.sample_entry(SleepActivity, sleep)
+        await db.delete(sleep)
+        await db.run_sync(rollups.refresh_days, SleepActivity, user_id, [entry])
+        await db.commit()
+        await score_cache.invalidate_user(user_id, cohort_key)
         return None
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
@@ -401,83 +583,217 @@ class BloodTestResponse(BaseModel):
     class Config:
         from_attributes = True
 
-@app.post("/user/{user_id}/blood_tests/", response_model=BloodTestResponse)
-def create_blood_test(user_id: int, blood_data: BloodTestCreate, db: Session = Depends(get_db)):
-    try:
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=400, detail="User does not exist")
+# Columns read by the get and list endpoints (see fast_read.py)
+BLOOD_TEST_COLUMNS = fast_read.response_columns(BloodTests, BloodTestResponse)
 
-        new_blood_test = BloodTests(**blood_data.dict(), user_id=user_id)
-        db.add(new_blood_test)
-        db.commit()
-        db.refresh(new_blood_test)
-        return new_blood_test
+@router.post("/user/{user_id}/blood_tests/", response_model=BloodTestResponse)
+async def create_blood_test(user_id: int, blood_data: BloodTestCreate, db: AsyncSession = Depends(get_db)):
+    try:
+        return await create_sample(db, BloodTests, BloodTests(**blood_data.dict(), user_id=user_id))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
-@app.get("/user/{user_id}/blood_tests/{blood_test_id}", response_model=BloodTestResponse)
-def get_blood_test(user_id: int, blood_test_id: int, db: Session = Depends(get_db)):
+@router.get("/user/{user_id}/blood_tests/{blood_test_id}", response_model=BloodTestResponse)
+async def get_blood_test(user_id: int, blood_test_id: int, db: AsyncSession = Depends(get_read_db)):
     try:
-        blood_test = db.query(BloodTests).filter(
-        BloodTests.id == blood_test_id, BloodTests.user_id == user_id
-    ).first()
+        blood_test = (await db.execute(select(*BLOOD_TEST_COLUMNS).where(
+        BloodTests.id == blood_test_id, BloodTests.user_id == user_id, health_score_engine.active_user(user_id)
+    ))).first()
 
         if not blood_test:
             raise HTTPException(status_code=404, detail="Blood test not found or access denied")
 
-        return blood_test
+        return fast_read.row_response(blood_test)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
-@app.get("/user/{user_id}/blood_tests/", response_model=List[BloodTestResponse])
-def get_all_blood_tests(user_id: int, db: Session = Depends(get_db)):
+@router.get("/user/{user_id}/blood_tests/", response_model=List[BloodTestResponse])
+async def get_all_blood_tests(user_id: int, response: Response, page: PageParams = Depends(), db: AsyncSession = Depends(get_read_db)):
     try:
-        blood_tests = db.query(BloodTests).filter(BloodTests.user_id == user_id).all()
+        blood_tests = await fetch_page(db, BloodTests, user_id, page, response, BLOOD_TEST_COLUMNS)
 
         if not blood_tests:
             raise HTTPException(status_code=404, detail="No blood test records found")
 
-        return blood_tests
+        return fast_read.rows_response(blood_tests, response)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
-@app.put("/user/{user_id}/blood_tests/{blood_test_id}", response_model=BloodTestResponse)
-def update_blood_test(user_id: int, blood_test_id: int, blood_data: BloodTestUpdate, db: Session = Depends(get_db)):
+@router.put("/user/{user_id}/blood_tests/{blood_test_id}", response_model=BloodTestResponse)
+async def update_blood_test(user_id: int, blood_test_id: int, blood_data: BloodTestUpdate, db: AsyncSession = Depends(get_db)):
     try:
-        blood_test = db.query(BloodTests).filter(
+        cohort_key = await active_cohort_key(db, user_id)
+        blood_test = (await db.execute(select(BloodTests).where(
             BloodTests.id == blood_test_id, BloodTests.user_id == user_id
-        ).first()
+        ))).scalars().first()
 
         if not blood_test:
             raise HTTPException(status_code=404, detail="Blood test not found or access denied")
 
+        old_value = cohort_stats.sample_value(BloodTests, blood_test)
+        old_entry = rollups.sample_entry(BloodTests, blood_test)
         for key, value in blood_data.dict(exclude_unset=True).items():
             setattr(blood_test, key, value)
+        await db.run_sync(rollups.refresh_days, BloodTests, user_id, [old_entry], [rollups.sample_entry(BloodTests, blood_test)])
+        await db.run_sync(cohort_stats.record_change, cohort_key, BloodTests, old_value, cohort_stats.sample_value(BloodTests, blood_test))
 
-        db.commit()
-        db.refresh(blood_test)
+        await db.commit()
+        await score_cache.invalidate_user(user_id, cohort_key)
+        if not LEAN_WRITES:
+            await db.refresh(blood_test)
         return blood_test
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
-@app.delete("/user/{user_id}/blood_tests/{blood_test_id}", status_code=204)
-def delete_blood_test(user_id: int, blood_test_id: int, db: Session = Depends(get_db)):
+@router.delete("/user/{user_id}/blood_tests/{blood_test_id}", status_code=204)
+async def delete_blood_test(user_id: int, blood_test_id: int, db: AsyncSession = Depends(get_db)):
     try:
-        blood_test = db.query(BloodTests).filter(
+        cohort_key = await active_cohort_key(db, user_id)
+        blood_test = (await db.execute(select(BloodTests).where(
         BloodTests.id == blood_test_id, BloodTests.user_id == user_id
-    ).first()
+    ))).scalars().first()
 
         if not blood_test:
             raise HTTPException(status_code=404, detail="Blood test not found or access denied")
 
-        db.delete(blood_test)
-        db.commit()
+        await db.run_sync(cohort_stats.record_sample, cohort_key, BloodTests, cohort_stats.sample_value(BloodTests, blood_test), -1)
+        entry = rollups.sample_entry(BloodTests, blood_test)
+        await db.delete(blood_test)
+        await db.run_sync(rollups.refresh_days, BloodTests, user_id, [entry])
+        await db.commit()
+        await score_cache.invalidate_user(user_id, cohort_key)
         return None
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+
+### 🔹 BULK INGEST
+
+class PhysicalActivityBulkItem(PhysicalActivityCreate):
+    recorded_at: Optional[datetime] = None
+
+class SleepActivityBulkItem(SleepActivityCreate):
+    recorded_at: Optional[datetime] = None
+
+class BloodTestBulkItem(BloodTestCreate):
+    recorded_at: Optional[datetime] = None
+
+BULK_SCHEMAS = {
+    "physical_activity": (PhysicalActivity, PhysicalActivityBulkItem),
+    "sleep_activity": (SleepActivity, SleepActivityBulkItem),
+    "blood_tests": (BloodTests, BloodTestBulkItem),
+}
+
+async def ingest_batch(db: AsyncSession, samples):
+    """Insert a batch in one transaction; returns a status per item."""
+    statuses, touched = await db.run_sync(ingest.ingest, samples, BULK_SCHEMAS)
+    await db.commit()
+    for user_id, cohort_key in touched.items():
+        await score_cache.invalidate_user(user_id, cohort_key)
+    return statuses
+
+async def sharded_ingest(samples):
+    """``ingest_batch`` of a cross-user batch: one transaction per shard, statuses in the original order."""
+    user_ids = [user_id for _, user_id, _ in samples if ingest.is_user_id(user_id)]
+    routes = await run_in_threadpool(shards.routes, user_ids)
+    statuses, groups = [None] * len(samples), defaultdict(list)
+    for index, (_, user_id, _) in enumerate(samples):
+        shard, moving_to = routes.get(user_id, (0, None))
+        if moving_to is not None:
+            statuses[index] = ingest.rejected("User is being moved to another shard, retry shortly")
+        else:
+            groups[shard].append(index)
+    for shard_index, indexes in groups.items():
+        shard = shards.SHARDS[shard_index]
+        async for db in open_session(shard.AsyncSessionLocal, shard.SessionLocal):
+            for index, status in zip(indexes, await ingest_batch(db, [samples[index] for index in indexes])):
+                statuses[index] = status
+    return statuses
+
+async def bulk_ingest(db: AsyncSession, samples):
+    """Insert a batch in one transaction (one per shard when sharded) and report a status per item."""
+    statuses = await (sharded_ingest(samples) if shards.SHARDED else ingest_batch(db, samples))
+
+    created = sum(1 for status in statuses if status["status"] == "created")
+    logger.info(f'Bulk ingest: {created} created, {len(statuses) - created} rejected')
+    return {
+        "created": created,
+        "rejected": len(statuses) - created,
+        "items": [{"index": index, **status} for index, status in enumerate(statuses)],
+    }
+
+@router.post("/user/{user_id}/physical_activity/bulk", response_model=dict)
+async def create_physical_activities_bulk(user_id: int, items: List[dict] = Body(..., max_length=ingest.MAX_BULK_ITEMS), db: AsyncSession = Depends(get_db)):
+    try:
+        return await bulk_ingest(db, [("physical_activity", user_id, item) for item in items])
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+
+@router.post("/user/{user_id}/sleep_activity/bulk", response_model=dict)
+async def create_sleep_activities_bulk(user_id: int, items: List[dict] = Body(..., max_length=ingest.MAX_BULK_ITEMS), db: AsyncSession = Depends(get_db)):
+    try:
+        return await bulk_ingest(db, [("sleep_activity", user_id, item) for item in items])
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+
+@router.post("/user/{user_id}/blood_tests/bulk", response_model=dict)
+async def create_blood_tests_bulk(user_id: int, items: List[dict] = Body(..., max_length=ingest.MAX_BULK_ITEMS), db: AsyncSession = Depends(get_db)):
+    try:
+        return await bulk_ingest(db, [("blood_tests", user_id, item) for item in items])
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+
+@router.post("/ingest/ndjson", response_model=dict)
+async def ingest_ndjson(request: Request, db: AsyncSession = Depends(get_db)):
+    """Cross-user upload: one JSON object per line with ``user_id``, ``metric`` and the sample fields."""
+    try:
+        body = await request.body()
+        lines = [line for line in body.splitlines() if line.strip()]
+        if len(lines) > ingest.MAX_BULK_ITEMS:
+            raise HTTPException(status_code=413, detail=f"At most {ingest.MAX_BULK_ITEMS} lines per upload")
+
+        samples, parse_errors = [], {}
+        for index, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                record = None
+                parse_errors[index] = f"Invalid JSON line: {e}"
+            if not isinstance(record, dict):
+                parse_errors.setdefault(index, "Expected a JSON object")
+                samples.append((None, None, None))
+                continue
+            samples.append((record.pop("metric", None), record.pop("user_id", None), record))
+
+        result = await bulk_ingest(db, samples)
+        for index, error in parse_errors.items():
+            result["items"][index] = {"index": index, **ingest.rejected(error)}
+        return result
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
@@ -486,95 +802,315 @@ def delete_blood_test(user_id: int, blood_test_id: int, db: Session = Depends(ge
 
 
 
-@app.get("/user/{user_id}/get_health_score/", response_model=dict)
-def get_health_score(user_id: int, db: Session = Depends(get_db)):
+@router.get("/user/{user_id}/get_health_score/", response_model=dict)
+async def get_health_score(
+    user_id: int,
+    window: Optional[int] = Query(None, description="Score only the last 7, 30 or 90 days"),
+    mode: Literal["mean", "percentile"] = Query("mean", description="Score against the cohort mean or by percentile rank in the cohort"),
+    db: AsyncSession = Depends(get_read_db),
+):
     try:
         start_time = datetime.now()
-        user = db.query(User).filter(User.id == user_id).first()
+        if window is not None and window not in health_score_engine.SCORE_WINDOWS:
+            raise HTTPException(status_code=400, detail=f"window must be one of {health_score_engine.SCORE_WINDOWS}")
+
+        cached = await score_cache.get_score(user_id, window, mode)
+        if cached:
+            # The in-process LRU hands out its stored dict: answer with a copy
+            return {**cached, "microseconds": int((datetime.now() - start_time).total_seconds() * 1_000_000)}
+
+        user = (await db.execute(select(User).where(User.id == user_id, health_score_engine.ACTIVE_USERS))).scalars().first()
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        # Определяем группу пользователя
-        user_group_query = db.query(User.id).filter(
-            User.climate_zone == user.climate_zone,
-            User.chronic_conditions == user.chronic_conditions,
-            User.age_group == user.age_group,
-            User.fitness_level == user.fitness_level
-        ).subquery()
-
-        group_size = db.query(func.count()).select_from(user_group_query).scalar()
-
-        # Средние показатели группы
-        avg_values = db.query(
-            func.avg(PhysicalActivity.steps).label("avg_steps"),
-            func.avg(SleepActivity.sleep_duration).label("avg_sleep"),
-            func.avg(BloodTests.glucose_level).label("avg_glucose"),
-        ).filter(
-            PhysicalActivity.user_id.in_(db.query(user_group_query.c.id)),
-            SleepActivity.user_id.in_(db.query(user_group_query.c.id)),
-            BloodTests.user_id.in_(db.query(user_group_query.c.id))
-        ).first()
-
-        # Данные пользователя
-        user_values = db.query(
-            func.avg(PhysicalActivity.steps).label("user_steps"),
-            func.avg(SleepActivity.sleep_duration).label("user_sleep"),
-            func.avg(BloodTests.glucose_level).label("user_glucose"),
-        ).filter(
-            PhysicalActivity.user_id == user_id,
-            SleepActivity.user_id == user_id,
-            BloodTests.user_id == user_id
-        ).first()
-
-        # Конвертация значений и установка дефолтных значений
-        avg_steps = float(avg_values.avg_steps or 0)
-        avg_sleep = float(avg_values.avg_sleep or 0)
-        avg_glucose = float(avg_values.avg_glucose or 100)
-
-        user_steps = float(user_values.user_steps or 0)
-        user_sleep = float(user_values.user_sleep or 0)
-        user_glucose = float(user_values.user_glucose or 100)
-
-        # Если у пользователя нет данных → Health Score = 0
-        if user_steps == 0 and user_sleep == 0 and user_glucose == 100:
-            health_score = 0
+        # Размер и средние показатели группы читаются из кэша или cohort_stats
+        cohort_key = cohort_stats.cohort_key(user)
+        generation = await score_cache.generation(cohort_key)
+        cohort = await score_cache.get_cohort(cohort_key, generation, window)
+        if cohort is None:
+            cohort = await group_summary(db, user, window)
+            await score_cache.set_cohort(cohort_key, generation, *cohort, window=window)
+        group_size, avg_values = cohort
+        since = health_score_engine.window_start(window)
+        user_values = await db.run_sync(health_score_engine.user_averages, user_id, since)
+
+        if mode == "percentile":
+            # Ранги по скетчам когорты (приблизительные, см. quantile_sketches)
+            ranks = await db.run_sync(quantile_sketches.cohort_ranks, cohort_key, user_values, since)
+            report = health_score_engine.percentile_report(user, user_values, group_size, avg_values, ranks)
+            report["mode"] = mode
         else:
-            health_score = (
-                min(29.9, (user_steps / (avg_steps + 1)) * 30) +
-                min(39.9, (user_sleep / (avg_sleep + 1)) * 40) +
-                min(29.9, (100 / (user_glucose + 1)) * 30)
-            )
+            report = health_score_engine.score_report(user, user_values, group_size, avg_values)
+        if window:
+            report["window_days"] = window
 
-        health_score = round(health_score, 2)
+        logger.info(f'Calculated health score for user_id {user_id} is {report["health_score"]}')
 
-        logger.info(f'Calculated health score for user_id {user_id} is {health_score}')
+        response = {"microseconds": int((datetime.now() - start_time).total_seconds() * 1_000_000), **report}
+        await score_cache.set_score(user_id, cohort_key, generation, response, window, mode)
+        return response
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
+@router.get("/user/{user_id}/health_score/history", response_model=dict)
+async def get_health_score_history(
+    user_id: int,
+    start: Optional[date] = Query(None, alias="from", description="First day (default: a year before `to`)"),
+    end: Optional[date] = Query(None, alias="to", description="Last day, inclusive (default: today)"),
+    step: Literal["day", "week"] = Query("day"),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """Health score series for charts, computed from the daily rollups in one pass."""
+    try:
+        start_time = datetime.now()
+        end = end or datetime.utcnow().date()
+        start = start or end - timedelta(days=364)
+        if start > end:
+            raise HTTPException(status_code=400, detail="`from` must not be after `to`")
+        if (end - start).days >= health_score_engine.MAX_HISTORY_DAYS:
+            raise HTTPException(status_code=400, detail=f"At most {health_score_engine.MAX_HISTORY_DAYS} days per request")
+
+        user = (await db.execute(select(User).where(User.id == user_id, health_score_engine.ACTIVE_USERS))).scalars().first()
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+
+        group_size, _ = await group_summary(db, user)
+        cohort_series = None
+        if shards.SHARDED:
+            # Ряды когорты суммируются по всем шардам
+            cohort_series = await run_in_threadpool(cohort_stats.sharded_period_averages, user, start, end, step)
+        points = await db.run_sync(health_score_engine.score_history, user, start, end, step, cohort_series)
+
+        return {
+            "microseconds": int((datetime.now() - start_time).total_seconds() * 1_000_000),
+            "user_id": user_id,
+            "from": start,
+            "to": end,
+            "step": step,
+            "group_size": group_size,
+            "points": points,
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+
+@router.get("/user/{user_id}/health_score/precomputed", response_model=dict)
+async def get_precomputed_health_score(user_id: int, db: AsyncSession = Depends(get_read_db)):
+    """Score stored by the nightly ``score_population.py`` run."""
+    try:
+        row = (await db.execute(
+            select(HealthScore, User).join(User, User.id == HealthScore.user_id).where(HealthScore.user_id == user_id)
+        )).first()
+        if not row:
+            raise HTTPException(status_code=404, detail="No precomputed health score for this user")
+
+        score, user = row
         return {
-            "microseconds": (datetime.now() - start_time).microseconds,
+            "computed_at": score.computed_at,
             "user_id": user_id,
-            "health_score": health_score,
+            "health_score": score.health_score,
             "user_data": {
-                "steps": round(user_steps, 2),
-                "sleep": round(user_sleep, 2),
-                "glucose": round(user_glucose, 2),
+                "steps": round(score.steps, 2),
+                "sleep": round(score.sleep, 2),
+                "glucose": round(score.glucose, 2),
             },
             "group_averages": {
-                "steps": round(avg_steps, 2),
-                "sleep": round(avg_sleep, 2),
-                "glucose": round(avg_glucose, 2),
+                "steps": round(score.group_steps, 2),
+                "sleep": round(score.group_sleep, 2),
+                "glucose": round(score.group_glucose, 2),
             },
             "user_group": {
-                "group_size": group_size,
+                "group_size": score.group_size,
                 "age_group": user.age_group,
                 "fitness_level": user.fitness_level,
                 "climate_zone": user.climate_zone,
                 "chronic_conditions": user.chronic_conditions
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
 
-@app.get("/")
-def get_hp():
-    return {"message": "Health Score API"}
\ No newline at end of file
+def load_batch(db, user_ids):
+    """Active users among ``user_ids`` and their metric averages."""
+    users = list(ingest.load_users(db, user_ids).values())
+    return users, health_score_engine.user_averages_bulk(db, [user.id for user in users])
+
+class HealthScoreBatchRequest(BaseModel):
+    user_ids: List[int] = Field(..., min_length=1, max_length=10000)
+
+@router.post("/health_scores/batch", response_model=dict)
+async def get_health_scores_batch(batch: HealthScoreBatchRequest, db: AsyncSession = Depends(get_read_db)):
+    try:
+        start_time = datetime.now()
+        user_ids = list(dict.fromkeys(batch.user_ids))
+
+        if shards.SHARDED:
+            # Пользователи читаются на своих шардах, средние когорт суммируются по всем шардам
+            routes = await run_in_threadpool(shards.routes, user_ids)
+            groups = defaultdict(list)
+            for user_id in user_ids:
+                groups[routes[user_id][0]].append(user_id)
+            parts = await run_in_threadpool(shards.each, load_batch, groups)
+            users = [user for part_users, _ in parts.values() for user in part_users]
+            user_values = {user_id: values for _, part_values in parts.values() for user_id, values in part_values.items()}
+            cohort_keys = {user.id: cohort_stats.cohort_key(user) for user in users}
+            cohorts = await run_in_threadpool(cohort_stats.sharded_summaries, set(cohort_keys.values()))
+        else:
+            # Средние группы считаются один раз на когорту, данные пользователей — сгруппированными запросами
+            users, user_values = await db.run_sync(load_batch, user_ids)
+            cohort_keys = {user.id: cohort_stats.cohort_key(user) for user in users}
+            cohorts = await db.run_sync(cohort_stats.cohort_summaries, set(cohort_keys.values()))
+
+        scores = []
+        for user in users:
+            group_size, avg_values = cohorts[cohort_keys[user.id]]
+            scores.append(health_score_engine.score_report(user, user_values[user.id], group_size, avg_values))
+
+        found = {user.id for user in users}
+        logger.info(f'Calculated {len(scores)} health scores in batch ({len(cohorts)} cohorts)')
+
+        return {
+            "microseconds": int((datetime.now() - start_time).total_seconds() * 1_000_000),
+            "scores": scores,
+            "missing_user_ids": [user_id for user_id in user_ids if user_id not in found],
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+
+### 🔹 EXPORT
+
+ExportMetric = Literal["physical_activity", "sleep_activity", "blood_tests"]
+
+class ExportParams:
+    """Query parameters shared by the export endpoints."""
+
+    def __init__(
+        self,
+        format: Literal["csv", "parquet"] = Query("csv"),
+        since: Optional[datetime] = Query(None, description="Only samples recorded at or after this time"),
+        until: Optional[datetime] = Query(None, description="Only samples recorded before this time"),
+    ):
+        self.format = format
+        self.since = since
+        self.until = until
+
+def export_response(metric: str, name: str, params: ExportParams, **scope) -> StreamingResponse:
+    """Stream an export (see export.py); the rows are read and encoded chunk by chunk as the client reads."""
+    chunks = export.export_chunks(export.EXPORT_MODELS[metric], params.format, since=params.since, until=params.until, **scope)
+    return StreamingResponse(
+        chunks,
+        media_type=export.MEDIA_TYPES[params.format],
+        headers={"Content-Disposition": f'attachment; filename="{metric}-{name}.{params.format}"'},
+    )
+
+@router.get("/user/{user_id}/export/{metric}")
+async def export_user(user_id: int, metric: ExportMetric, params: ExportParams = Depends(), db: AsyncSession = Depends(get_read_db)):
+    try:
+        user = (await db.execute(select(User.id).where(User.id == user_id, health_score_engine.ACTIVE_USERS))).first()
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        logger.info(f"Exporting {metric} of user {user_id} as {params.format}")
+        return export_response(metric, f"user-{user_id}", params, user_id=user_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+
+@router.get("/cohorts/{cohort_id}/export/{metric}")
+async def export_cohort(cohort_id: int, metric: ExportMetric, params: ExportParams = Depends(), db: AsyncSession = Depends(get_read_db)):
+    try:
+        cohort = (await db.execute(select(Cohort.id).where(Cohort.id == cohort_id))).first()
+        if not cohort:
+            raise HTTPException(status_code=404, detail="Cohort not found")
+        logger.info(f"Exporting {metric} of cohort {cohort_id} as {params.format}")
+        return export_response(metric, f"cohort-{cohort_id}", params, cohort_id=cohort_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+
+@router.get("/export/{metric}")
+async def export_population(metric: ExportMetric, params: ExportParams = Depends()):
+    logger.info(f"Exporting {metric} of all users as {params.format}")
+    return export_response(metric, "all", params)
+
+@router.get("/")
+async def get_hp():
+    return {"message": "Health Score API"}
+
+### 🔹 HEALTH
+
+# Seconds the readiness check waits for each database
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT_SECONDS", "2"))
+
+@router.get("/health", response_model=dict)
+async def get_health():
+    """Liveness: the worker serves requests (nothing else is checked)."""
+    return {"status": "ok", "pid": os.getpid()}
+
+@router.get("/ready", response_model=dict)
+async def get_ready(request: Request, response: Response):
+    """Readiness: the worker has finished starting up and every database of every shard answers."""
+    databases = {}
+    for shard in shards.SHARDS:
+        for shard_engine in shard.engines():
+            name = f"shard {shard.index}: {shard_engine.url.render_as_string()}"
+            try:
+                await asyncio.wait_for(check_engine(shard_engine), READY_TIMEOUT)
+                databases[name] = "ok"
+            except Exception as e:
+                databases[name] = f"error: {e!r}"
+    started = getattr(request.app.state, "ready", False)
+    ready = started and all(status == "ok" for status in databases.values())
+    if not ready:
+        response.status_code = 503
+    return {"status": "ready" if ready else "not ready", "started": started, "pid": os.getpid(), "databases": databases}
+
+### 🔹 APP
+
+def log_resume_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Resuming user deletion jobs failed: {future.exception()!r}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs in every worker process, after the fork: nothing here is inherited from the parent
+    configure_logging(project_name)
+    logger.info(f' {project_name} Started (pid {os.getpid()})')
+    try:
+        await warm_up_engines()
+    except Exception as e:
+        # Not ready until the databases answer (see /ready); requests connect on demand meanwhile
+        logger.error(f"Database warm-up failed: {e}")
+    # Deletion jobs interrupted by a restart or a crash continue in the background
+    for shard in shards.SHARDS:
+        resumed = asyncio.get_running_loop().run_in_executor(None, user_deletion.resume_jobs, shard.SessionLocal)
+        resumed.add_done_callback(log_resume_failure)
+    app.state.ready = True
+    yield
+    app.state.ready = False
+    await score_cache.close()
+    await dispose_engines()
+    logger.info(f' {project_name} Stopped (pid {os.getpid()})')
+
+def create_app() -> FastAPI:
+    """Application factory: ``uvicorn main:create_app --factory`` (or the module-level ``app``)."""
+    app = FastAPI(title=project_name, lifespan=lifespan)
+    metrics.instrument_app(app)
+    app.include_router(router)
+    return app
+
+app = create_app()
\ No newline at end of file
@@ -0,0 +1,132 @@
+"""Request latency and database query instrumentation, exported for Prometheus.
+
+``instrument_engines`` hooks SQLAlchemy's cursor events to count the queries
+and the database time of the current request (tracked in a context variable),
+and the HTTP middleware installed by ``instrument_app`` records them together
+with the request latency per route template. Requests running more than
+``DB_QUERY_BUDGET`` queries are counted and logged. Everything is served in
+the Prometheus text format at ``/metrics``.
+
+The metrics live in the memory of each process. With several workers set
+``PROMETHEUS_MULTIPROC_DIR`` to an empty directory shared by them (cleared
+before every start): prometheus_client then writes the samples there and
+``/metrics`` serves the sum over all workers, whichever worker answers.
+Without it a scrape only sees the worker that served it.
+"""
+import logging
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi import FastAPI, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from sqlalchemy import event
+
+QUERY_BUDGET = int(os.getenv("DB_QUERY_BUDGET", "20"))
+# Read by prometheus_client itself when the metrics below are created
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+REQUEST_QUERIES = Histogram(
+    "http_request_db_queries", "Database queries run per HTTP request", ["method", "route"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 250, 1000),
+)
+REQUEST_DB_TIME = Histogram(
+    "http_request_db_duration_seconds", "Time spent in database queries per HTTP request", ["method", "route"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+OVER_BUDGET = Counter(
+    "http_requests_over_query_budget_total", f"HTTP requests that ran more than {QUERY_BUDGET} queries",
+    ["method", "route"],
+)
+
+logger = logging.getLogger(__name__)
+
+
+def registry():
+    """Registry to serve: the default one, or every worker's samples in multiprocess mode."""
+    if not MULTIPROC_DIR:
+        return REGISTRY
+    collected = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collected)
+    return collected
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_start"].pop()
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += time.perf_counter() - started
+
+
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
+
+
+def instrument_engines(*engines):
+    """Count the queries of the given sync or async engines (``None`` is skipped)."""
+    for engine in engines:
+        if engine is None:
+            continue
+        engine = getattr(engine, "sync_engine", engine)
+        if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+            event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+            event.listen(engine, "handle_error", _handle_error)
+
+
+def route_template(request: Request) -> str:
+    """Path template of the matched route, so ``/user/1`` and ``/user/2`` share a series."""
+    route = request.scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+def instrument_app(app: FastAPI):
+    @app.middleware("http")
+    async def record_request_metrics(request: Request, call_next):
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            _request_stats.reset(token)
+            method, route = request.method, route_template(request)
+            REQUEST_LATENCY.labels(method, route, str(status)).observe(elapsed)
+            REQUEST_QUERIES.labels(method, route).observe(stats.queries)
+            REQUEST_DB_TIME.labels(method, route).observe(stats.db_seconds)
+            if stats.queries > QUERY_BUDGET:
+                OVER_BUDGET.labels(method, route).inc()
+                logger.warning(
+                    f"{method} {request.url.path} ran {stats.queries} queries (budget {QUERY_BUDGET})",
+                    extra={"route": route, "queries": stats.queries, "db_seconds": round(stats.db_seconds, 6)},
+                )
+
+    @app.get("/metrics", include_in_schema=False)
+    async def get_metrics():
+        return Response(generate_latest(registry()), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,102 @@
+"""Keyset pagination for the per-user metric lists.
+
+Pages are ordered by ``(recorded_at, id)`` and continue after the last row of
+the previous page, so every page is a bounded range scan on the
+``idx_*_user_time`` index no matter how deep into a user's history it is. The
+position is handed to clients as an opaque cursor in the ``X-Next-Cursor``
+response header. Pages reaching back before the archive horizon merge in the
+archived rows of the range (see archive.py).
+"""
+import base64
+import binascii
+from datetime import datetime
+from typing import Optional
+
+from fastapi import HTTPException, Query
+from sqlalchemy import and_, or_, select
+from starlette.concurrency import run_in_threadpool
+
+import archive
+import health_score
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+class PageParams:
+    """Query parameters shared by the list endpoints."""
+
+    def __init__(
+        self,
+        since: Optional[datetime] = Query(None, description="Only samples recorded at or after this time"),
+        until: Optional[datetime] = Query(None, description="Only samples recorded before this time"),
+        cursor: Optional[str] = Query(None, description=f"Value of {NEXT_CURSOR_HEADER} from the previous page"),
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    ):
+        self.since = since
+        self.until = until
+        self.cursor = cursor
+        self.limit = limit
+
+
+def encode_cursor(recorded_at: datetime, row_id: int) -> str:
+    raw = f"{recorded_at.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        recorded_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(recorded_at), int(row_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def page_query(model, user_id: int, params: PageParams, columns=None):
+    """``SELECT`` of one page (plus one look-ahead row) of ``model`` rows, or of their ``columns``."""
+    stmt = select(*columns) if columns else select(model)
+    stmt = stmt.where(model.user_id == user_id, health_score.active_user(user_id))
+    if params.since is not None:
+        stmt = stmt.where(model.recorded_at >= params.since)
+    if params.until is not None:
+        stmt = stmt.where(model.recorded_at < params.until)
+    if params.cursor:
+        recorded_at, row_id = decode_cursor(params.cursor)
+        stmt = stmt.where(or_(
+            model.recorded_at > recorded_at,
+            and_(model.recorded_at == recorded_at, model.id > row_id),
+        ))
+    return stmt.order_by(model.recorded_at, model.id).limit(params.limit + 1)
+
+
+def archived_page(model, user_id: int, params: PageParams, columns) -> list:
+    """Archived rows of one page (plus one look-ahead row); none if the page starts past the archive."""
+    archived_until = archive.horizon(model)
+    after = decode_cursor(params.cursor) if params.cursor else None
+    if archived_until is None or (params.since is not None and params.since >= archived_until) \
+            or (after is not None and after[0] >= archived_until):
+        return []
+    names = [column.key for column in columns]
+    return archive.read_page(model, user_id, names, params.since, params.until, after, params.limit + 1)
+
+
+async def fetch_page(db, model, user_id: int, params: PageParams, response, columns=None):
+    """Return one page of rows and set the next-page cursor header if there is more.
+
+    The rows are entities, or tuples of ``columns`` (which must include ``id``
+    and ``recorded_at``) when given.
+    """
+    result = await db.execute(page_query(model, user_id, params, columns))
+    rows = result.all() if columns else result.scalars().all()
+    if columns:
+        archived = await run_in_threadpool(archived_page, model, user_id, params, columns)
+        if archived and not rows:
+            # Deleted users keep their archived rows until their deletion job has run
+            archived = archived if (await db.execute(select(health_score.active_user(user_id)))).scalar() else []
+        if archived:
+            rows = sorted([*archived, *rows], key=lambda row: (row.recorded_at, row.id))[:params.limit + 1]
+    if len(rows) > params.limit:
+        rows = rows[:params.limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(rows[-1].recorded_at, rows[-1].id)
+    return rows
@@ -0,0 +1,273 @@
+"""Per-cohort quantile sketches behind the percentile-rank health score.
+
+``cohort_sketches`` holds one KLL sketch per cohort, metric and day: about
+``3 * SKETCH_K`` float32 values (a few KB) summarizing every sample of that
+day however many there are. New samples are added in the same transaction as
+the insert. Sketches merge, so a score window is the merge of its days and a
+wider group the merge of its cohorts; merged sketches are kept in an
+in-process cache as sorted rank tables, which makes a rank lookup a binary
+search.
+
+Sketches only grow: updated and deleted samples, users who change cohort and
+deleted users stay in them until the next rebuild from the raw tables (e.g.
+nightly from cron):
+
+    python quantile_sketches.py
+"""
+import argparse
+import math
+import os
+import random
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from itertools import accumulate
+from typing import Optional
+
+from sqlalchemy import and_, delete, insert, select
+from sqlalchemy.orm import Session
+
+from create_db import SessionLocal, CohortSketch, User, upsert
+import archive
+import cohort_stats
+import health_score
+import shards
+
+# Accuracy parameter: rank error is about 1.7 / SKETCH_K
+SKETCH_K = int(os.getenv("SKETCH_K", "128"))
+RANK_CACHE_SECONDS = int(os.getenv("SKETCH_CACHE_SECONDS", "300"))
+RANK_CACHE_SIZE = int(os.getenv("SKETCH_CACHE_SIZE", "1000"))
+
+# version, k, n, number of levels
+HEADER = struct.Struct("<BHQB")
+FORMAT_VERSION = 1
+
+
+class RankTable:
+    """Sorted sketch values with cumulative weights, for rank lookups."""
+
+    def __init__(self, values, weights):
+        self.values = values
+        self.cumulative = list(accumulate(weights, initial=0))
+        self.total = self.cumulative[-1]
+
+    def rank(self, value: float) -> float:
+        """Share of the values below ``value``, counting ties as half; 0.5 when empty."""
+        if not self.total:
+            return 0.5
+        below = self.cumulative[bisect_left(self.values, value)]
+        at_or_below = self.cumulative[bisect_right(self.values, value)]
+        return (below + at_or_below) / 2 / self.total
+
+
+class KLLSketch:
+    """KLL quantile sketch (Karnin, Lang & Liberty) over float values.
+
+    Level ``h`` holds values of weight ``2**h``. A full level is sorted and
+    every other value, from a random offset, moves up a level, so the sketch
+    stays at about ``3 * k`` values. Merging concatenates the levels and
+    compacts again.
+    """
+
+    def __init__(self, k: int = SKETCH_K):
+        self.k = k
+        self.n = 0
+        self.levels = [[]]
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.levels) - level - 1
+        return int(math.ceil(self.k * (2 / 3) ** depth)) + 1
+
+    def _size(self) -> int:
+        return sum(map(len, self.levels))
+
+    def _max_size(self) -> int:
+        return sum(self._capacity(level) for level in range(len(self.levels)))
+
+    def _compress(self):
+        while self._size() >= self._max_size():
+            for level, values in enumerate(self.levels):
+                if len(values) < self._capacity(level):
+                    continue
+                if level + 1 == len(self.levels):
+                    self.levels.append([])
+                values.sort()
+                # With an odd count the smallest value stays behind
+                kept, pairs = values[:len(values) % 2], values[len(values) % 2:]
+                self.levels[level + 1].extend(pairs[random.getrandbits(1)::2])
+                self.levels[level] = kept
+                break
+
+    def update(self, value: float):
+        self.levels[0].append(float(value))
+        self.n += 1
+        if len(self.levels[0]) >= self._capacity(0):
+            self._compress()
+
+    def merge(self, other: "KLLSketch"):
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for level, values in enumerate(other.levels):
+            self.levels[level].extend(values)
+        self.n += other.n
+        self._compress()
+
+    def rank_table(self) -> RankTable:
+        pairs = sorted((value, 1 << level) for level, values in enumerate(self.levels) for value in values)
+        return RankTable([value for value, _ in pairs], [weight for _, weight in pairs])
+
+    def to_bytes(self) -> bytes:
+        values = array("f", (value for values in self.levels for value in values))
+        lengths = struct.pack(f"<{len(self.levels)}H", *map(len, self.levels))
+        return HEADER.pack(FORMAT_VERSION, self.k, self.n, len(self.levels)) + lengths + values.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "KLLSketch":
+        version, k, n, level_count = HEADER.unpack_from(data)
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported sketch format {version}")
+        lengths = struct.unpack_from(f"<{level_count}H", data, HEADER.size)
+        values = array("f")
+        values.frombytes(data[HEADER.size + 2 * level_count:])
+        sketch = cls(k)
+        sketch.n = n
+        sketch.levels, start = [], 0
+        for length in lengths:
+            sketch.levels.append(values[start:start + length].tolist())
+            start += length
+        return sketch
+
+
+def add_values(db: Session, key: str, metric: str, day, values):
+    """Add ``values`` to the sketch of cohort ``key``, ``metric`` and ``day``; the caller commits."""
+    locked = (
+        select(CohortSketch)
+        .where(CohortSketch.cohort_key == key, CohortSketch.metric == metric, CohortSketch.day == day)
+        .with_for_update()
+    )
+    row = db.execute(locked).scalars().first()
+    if row is None:
+        # FOR UPDATE locks nothing while the row is missing: create it empty first (a concurrent
+        # creator makes this a no-op), then lock it like an existing one
+        upsert(db, CohortSketch, ["cohort_key", "metric", "day"],
+               dict(cohort_key=key, metric=metric, day=day, count=0, sketch=KLLSketch().to_bytes()))
+        row = db.execute(locked).scalars().first()
+    sketch = KLLSketch.from_bytes(row.sketch)
+    for value in values:
+        sketch.update(value)
+    row.count = sketch.n
+    row.sketch = sketch.to_bytes()
+
+
+def add_samples(db: Session, key: str, model, samples):
+    """Add ``(recorded_at, value)`` samples of ``model`` to cohort ``key``'s daily sketches."""
+    metric, _ = cohort_stats.METRIC_BY_MODEL[model]
+    by_day = defaultdict(list)
+    for recorded_at, value in samples:
+        if value is not None:
+            by_day[recorded_at.date()].append(float(value))
+    for day, values in by_day.items():
+        add_values(db, key, metric, day, values)
+
+
+def merged_sketch(db: Session, keys, metric: str, since_day=None) -> KLLSketch:
+    """Merge of the daily sketches of cohorts ``keys`` from ``since_day`` on (all days if ``None``)."""
+    stmt = select(CohortSketch.sketch).where(CohortSketch.cohort_key.in_(keys), CohortSketch.metric == metric)
+    if since_day is not None:
+        stmt = stmt.where(CohortSketch.day >= since_day)
+    sketch = KLLSketch()
+    for (data,) in db.execute(stmt):
+        sketch.merge(KLLSketch.from_bytes(data))
+    return sketch
+
+
+_rank_tables = OrderedDict()
+_rank_tables_lock = threading.Lock()
+
+
+def rank_table(db: Session, key: str, metric: str, since_day=None) -> RankTable:
+    """Rank table of one cohort and metric, cached for ``RANK_CACHE_SECONDS``."""
+    cache_key = (key, metric, since_day)
+    with _rank_tables_lock:
+        entry = _rank_tables.get(cache_key)
+        if entry is not None and entry[0] > time.monotonic():
+            _rank_tables.move_to_end(cache_key)
+            return entry[1]
+
+    if shards.SHARDED:
+        # Each shard sketches its own users; the merge covers the whole cohort
+        sketch = KLLSketch()
+        for part in shards.scatter(merged_sketch, [key], metric, since_day):
+            sketch.merge(part)
+    else:
+        sketch = merged_sketch(db, [key], metric, since_day)
+    table = sketch.rank_table()
+    with _rank_tables_lock:
+        _rank_tables[cache_key] = (time.monotonic() + RANK_CACHE_SECONDS, table)
+        _rank_tables.move_to_end(cache_key)
+        while len(_rank_tables) > RANK_CACHE_SIZE:
+            _rank_tables.popitem(last=False)
+    return table
+
+
+def cohort_ranks(db: Session, key: str, user_values: dict, since: Optional[datetime] = None) -> dict:
+    """Percentile rank (0-1) of each of the user's metric values within cohort ``key``."""
+    since_day = since.date() if since is not None else None
+    return {name: rank_table(db, key, name, since_day).rank(value) for name, value in user_values.items()}
+
+
+def rebuild(db: Session) -> int:
+    """Recompute every sketch from the raw tables; returns the number of sketches.
+
+    Days before the archive horizon (see archive.py) keep their sketches.
+    """
+    sketches = defaultdict(KLLSketch)
+    keys = {}
+    for name, (model, column, _) in health_score.METRICS.items():
+        stmt = (
+            select(*cohort_stats.COHORT_COLUMNS, model.recorded_at, column)
+            .join(User, User.id == model.user_id)
+            .where(health_score.ACTIVE_USERS, column.isnot(None), model.recorded_at.isnot(None))
+            .execution_options(yield_per=10000)
+        )
+        stale = CohortSketch.metric == name
+        archived_until = archive.horizon(model)
+        if archived_until is not None:
+            stmt = stmt.where(model.recorded_at >= archived_until)
+            stale = and_(stale, CohortSketch.day >= archived_until.date())
+        for row in db.execute(stmt):
+            attributes = tuple(row[:4])
+            key = keys.get(attributes) or keys.setdefault(attributes, cohort_stats.cohort_key(row))
+            sketches[(key, name, row.recorded_at.date())].update(row[-1])
+        db.execute(delete(CohortSketch).where(stale))
+
+    rows = [
+        dict(cohort_key=key, metric=metric, day=day, count=sketch.n, sketch=sketch.to_bytes())
+        for (key, metric, day), sketch in sketches.items()
+    ]
+    for chunk in health_score.chunked(rows):
+        db.execute(insert(CohortSketch), chunk)
+    db.commit()
+    with _rank_tables_lock:
+        _rank_tables.clear()
+    return len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the per-cohort quantile sketches from the raw metric tables.")
+    parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        print("🚀 Rebuilding cohort quantile sketches...")
+        rows = rebuild(session)
+        print(f"✅ cohort_sketches rebuilt: {rows} sketches")
+    except Exception as e:
+        session.rollback()
+        print(f"❌ Error rebuilding cohort quantile sketches: {e}")
+    finally:
+        session.close()
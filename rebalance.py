@@ -0,0 +1,210 @@
+"""Move users between database shards (see shards.py).
+
+A move copies the user's rows (the user, the samples, the daily rollups and
+the precomputed score) to the target shard and carries their totals over in
+cohort_stats, then points the directory at the target and deletes the rows
+from the source. While ``user_shards.moving_to`` is set the API refuses writes
+for the user with 503; the waits of ``SHARD_CACHE_SECONDS`` let every API
+process see the flag before the copy and the new shard before the delete, so
+reads keep working throughout. Samples get new ids on the target shard.
+
+The quantile sketches of both shards keep the user's samples where they were
+until the next ``python quantile_sketches.py`` on each shard.
+
+    python rebalance.py --register-existing   # once, before the first extra shard goes live
+    python rebalance.py --move 42 --to 1
+    python rebalance.py --status              # users per shard
+"""
+import argparse
+import time
+from datetime import datetime
+
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.orm import Session
+
+from create_db import User, UserShard, HealthScore
+import cohort_stats
+import health_score
+import rollups
+import shards
+import user_deletion
+
+COPY_CHUNK_SIZE = 1000
+
+# Tables copied after the user row, children of users.id; their own ids are not kept
+USER_TABLES = (*user_deletion.SAMPLE_MODELS, *rollups.ROLLUP_BY_MODEL.values(), HealthScore)
+
+
+def register_existing(db: Session) -> int:
+    """Add the users of shard 0 missing from the directory; returns how many were added.
+
+    Run before users are created on other shards: the directory hands out the
+    user ids from then on and has to start above the existing ones.
+    """
+    registered = set(db.execute(select(UserShard.user_id)).scalars().all())
+    rows = [
+        dict(user_id=user_id, uuid=uuid, shard=0)
+        for user_id, uuid in db.execute(select(User.id, User.uuid).order_by(User.id))
+        if user_id not in registered
+    ]
+    for chunk in health_score.chunked(rows, COPY_CHUNK_SIZE):
+        db.execute(insert(UserShard), chunk)
+    db.commit()
+    return len(rows)
+
+
+def in_directory(user_id: int) -> bool:
+    session = shards.SHARDS[0].SessionLocal()
+    try:
+        return session.execute(select(UserShard.user_id).where(UserShard.user_id == user_id)).first() is not None
+    finally:
+        session.close()
+
+
+def set_moving(user_id: int, moving_to):
+    session = shards.SHARDS[0].SessionLocal()
+    try:
+        session.execute(
+            update(UserShard).where(UserShard.user_id == user_id).values(moving_to=moving_to, updated_at=datetime.utcnow())
+        )
+        session.commit()
+    finally:
+        session.close()
+    shards.forget(user_id)
+
+
+def switch_shard(user_id: int, shard: int):
+    session = shards.SHARDS[0].SessionLocal()
+    try:
+        session.execute(
+            update(UserShard).where(UserShard.user_id == user_id)
+            .values(shard=shard, moving_to=None, updated_at=datetime.utcnow())
+        )
+        session.commit()
+    finally:
+        session.close()
+    shards.forget(user_id)
+
+
+def copy_rows(source: Session, target: Session, model, condition, keep_id: bool) -> int:
+    columns = [column for column in model.__table__.columns if keep_id or column.key != "id"]
+    copied = 0
+    result = source.execute(select(*columns).where(condition).execution_options(yield_per=COPY_CHUNK_SIZE))
+    for rows in result.mappings().partitions():
+        target.execute(insert(model), [dict(row) for row in rows])
+        copied += len(rows)
+    return copied
+
+
+def copy_user(source: Session, target: Session, user) -> int:
+    """Copy the user's rows to ``target`` and move their cohort totals; the caller commits both."""
+    # Cohort ids are global (handed out by shard 0), the target only needs the registry row
+    cohort_stats.assign_cohort(target, user)
+    copied = copy_rows(source, target, User, User.id == user.id, keep_id=True)
+    target.execute(update(User).where(User.id == user.id).values(cohort_id=user.cohort_id, updated_at=User.updated_at))
+    for model in USER_TABLES:
+        copied += copy_rows(source, target, model, model.user_id == user.id, keep_id=False)
+
+    key = cohort_stats.cohort_key(user)
+    for metric, (total, count) in cohort_stats.user_totals(target, user.id).items():
+        cohort_stats.apply_delta(target, key, metric, total, count)
+    cohort_stats.add_member(target, user)
+    cohort_stats.remove_user(source, user)
+    return copied
+
+
+def delete_user_rows(db: Session, user_id: int):
+    """Delete what ``copy_user`` copied from a shard (the cohort totals excepted)."""
+    for model in user_deletion.SAMPLE_MODELS:
+        while user_deletion.delete_chunk(db, model, user_id, user_deletion.DELETION_CHUNK_SIZE):
+            db.commit()
+    rollups.delete_user(db, user_id)
+    db.execute(delete(HealthScore).where(HealthScore.user_id == user_id))
+    db.execute(delete(User).where(User.id == user_id))
+    db.commit()
+
+
+def move_user(user_id: int, to: int, wait: int = shards.SHARD_CACHE_SECONDS) -> int:
+    """Move one user to shard ``to``; returns the number of rows copied."""
+    if not 0 <= to < len(shards.SHARDS):
+        raise ValueError(f"No shard {to}: there are {len(shards.SHARDS)}")
+    shards.forget(user_id)
+    index, moving_to = shards.route(user_id)
+    if moving_to is not None:
+        raise ValueError(f"User {user_id} is already being moved to shard {moving_to}")
+    if index == to:
+        return 0
+
+    if not in_directory(user_id):
+        raise ValueError(f"User {user_id} is not in the shard directory, run --register-existing first")
+    source = shards.SHARDS[index].SessionLocal()
+    target = shards.SHARDS[to].SessionLocal()
+    try:
+        user = source.execute(select(User).where(User.id == user_id, health_score.ACTIVE_USERS)).scalars().first()
+        if user is None:
+            raise ValueError(f"User {user_id} not found on shard {index}")
+
+        set_moving(user_id, to)
+        try:
+            time.sleep(wait)
+            copied = copy_user(source, target, user)
+            target.commit()
+            try:
+                source.commit()
+            except Exception:
+                source.rollback()
+                cohort_stats.remove_user(target, user)
+                delete_user_rows(target, user_id)
+                raise
+        except Exception:
+            target.rollback()
+            set_moving(user_id, None)
+            raise
+
+        switch_shard(user_id, to)
+        time.sleep(wait)
+        delete_user_rows(source, user_id)
+        return copied
+    finally:
+        source.close()
+        target.close()
+
+
+def shard_counts(db: Session) -> dict:
+    return dict(db.execute(select(UserShard.shard, func.count()).group_by(UserShard.shard)).all())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move users between database shards.")
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument("--register-existing", action="store_true", help="add the users of shard 0 to the directory")
+    action.add_argument("--move", type=int, metavar="USER_ID", help="user to move (with --to)")
+    action.add_argument("--status", action="store_true", help="print the number of users per shard")
+    parser.add_argument("--to", type=int, help="target shard of --move")
+    parser.add_argument("--wait", type=int, default=shards.SHARD_CACHE_SECONDS,
+                        help="seconds the API processes need to see a directory change")
+    args = parser.parse_args()
+    if args.move is not None and args.to is None:
+        parser.error("--move needs --to")
+
+    session = shards.SHARDS[0].SessionLocal()
+    try:
+        if args.register_existing:
+            print("🚀 Registering existing users in the shard directory...")
+            print(f"✅ {register_existing(session)} users registered on shard 0")
+        elif args.status:
+            for shard, count in sorted(shard_counts(session).items()):
+                print(f"📊 shard {shard}: {count} users")
+        else:
+            print(f"🚀 Moving user {args.move} to shard {args.to}...")
+            copied = move_user(args.move, args.to, args.wait)
+            print(f"✅ User {args.move} moved to shard {args.to} ({copied} rows copied)")
+    except Exception as e:
+        session.rollback()
+        print(f"❌ Error rebalancing shards: {e}")
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""Per-user daily rollups of the scored metrics.
+
+``physical_activity_daily``, ``sleep_activity_daily`` and ``blood_tests_daily``
+hold one row per user and day with the sum, count, min and max of the metric
+column, so reads that only need daily or longer aggregates touch one row per
+day instead of every raw sample.
+
+New samples are added incrementally. Updates and deletes cannot be undone from
+a min/max, so the affected days are recomputed from the raw rows, which is a
+short range scan on ``idx_*_user_time``; days before the archive horizon get
+the difference instead (see ``refresh_days``). Run this module to backfill the
+tables from the raw data, e.g. after deploying them against an existing
+database:
+
+    python rollups.py --chunk-size 1000
+"""
+import argparse
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, case, delete, func, insert, select, update
+from sqlalchemy.orm import Session
+
+from create_db import SessionLocal, User, upsert
+import archive
+import cohort_stats
+import health_score
+
+# raw table -> daily rollup table
+ROLLUP_BY_MODEL = {
+    model: health_score.DAILY_ROLLUPS[name]
+    for name, (model, _, _) in health_score.METRICS.items()
+}
+
+
+def sample_day(sample):
+    return sample.recorded_at.date() if sample.recorded_at is not None else None
+
+
+def sample_row(model, sample):
+    """``(user_id, recorded_at, value)`` of an ORM sample, stamping ``recorded_at`` if unset."""
+    if sample.recorded_at is None:
+        sample.recorded_at = datetime.utcnow()
+    return sample.user_id, sample.recorded_at, cohort_stats.sample_value(model, sample)
+
+
+def apply_day(db: Session, rollup, user_id: int, day, total: float, count: int, low: float, high: float):
+    """Merge one day's partial aggregate into the rollup row."""
+    now = datetime.utcnow()
+    upsert(
+        db, rollup, ["user_id", "day"],
+        dict(user_id=user_id, day=day, total=total, count=count, min_value=low, max_value=high, updated_at=now),
+        dict(
+            total=rollup.total + total,
+            count=rollup.count + count,
+            min_value=case((rollup.min_value <= low, rollup.min_value), else_=low),
+            max_value=case((rollup.max_value >= high, rollup.max_value), else_=high),
+            updated_at=now,
+        ),
+    )
+
+
+def add_samples(db: Session, model, samples):
+    """Add ``(user_id, recorded_at, value)`` samples of ``model`` to its rollup."""
+    days = {}
+    for user_id, recorded_at, value in samples:
+        if value is None:
+            continue
+        value = float(value)
+        key = (user_id, recorded_at.date())
+        if key not in days:
+            days[key] = [0.0, 0, value, value]
+        entry = days[key]
+        entry[0] += value
+        entry[1] += 1
+        entry[2] = min(entry[2], value)
+        entry[3] = max(entry[3], value)
+
+    rollup = ROLLUP_BY_MODEL[model]
+    for (user_id, day), (total, count, low, high) in days.items():
+        apply_day(db, rollup, user_id, day, total, count, low, high)
+
+
+def record_sample(db: Session, model, sample):
+    add_samples(db, model, [sample_row(model, sample)])
+
+
+def sample_entry(model, sample):
+    """``(day, value)`` of an ORM sample, as ``refresh_days`` takes them."""
+    return sample_day(sample), cohort_stats.sample_value(model, sample)
+
+
+def refresh_days(db: Session, model, user_id: int, removed=(), added=()):
+    """Bring a user's rollup rows up to date after samples were updated or deleted.
+
+    ``removed`` and ``added`` are the ``(day, value)`` of the changed samples
+    before and after the change. Days from the archive horizon on are
+    recomputed from the raw samples. Earlier days also count archived samples
+    that are no longer in the raw tables, so they only get the difference
+    (their min and max can widen but not shrink).
+    """
+    db.flush()
+    rollup = ROLLUP_BY_MODEL[model]
+    _, column = cohort_stats.METRIC_BY_MODEL[model]
+    archived_until = archive.horizon(model)
+    live, archived = set(), {}
+    for sign, entries in ((-1, removed), (1, added)):
+        for day, value in entries:
+            if day is None:
+                continue
+            if archived_until is None or day >= archived_until.date():
+                live.add(day)
+            elif value is not None:
+                entry = archived.setdefault(day, [0.0, 0, None, None])
+                entry[0] += sign * float(value)
+                entry[1] += sign
+                if sign > 0:
+                    entry[2] = float(value) if entry[2] is None else min(entry[2], float(value))
+                    entry[3] = float(value) if entry[3] is None else max(entry[3], float(value))
+
+    for day, (total, count, low, high) in archived.items():
+        if low is not None:
+            apply_day(db, rollup, user_id, day, total, count, low, high)
+        else:
+            db.execute(
+                update(rollup).where(rollup.user_id == user_id, rollup.day == day)
+                .values(total=rollup.total + total, count=rollup.count + count, updated_at=datetime.utcnow())
+            )
+
+    for day in live:
+        start = datetime.combine(day, datetime.min.time())
+        total, count, low, high = db.execute(
+            select(func.sum(column), func.count(column), func.min(column), func.max(column))
+            .where(model.user_id == user_id, model.recorded_at >= start, model.recorded_at < start + timedelta(days=1))
+        ).one()
+        db.execute(delete(rollup).where(rollup.user_id == user_id, rollup.day == day))
+        if count:
+            db.add(rollup(user_id=user_id, day=day, total=float(total), count=count, min_value=low, max_value=high))
+
+
+def delete_user(db: Session, user_id: int):
+    for rollup in ROLLUP_BY_MODEL.values():
+        db.execute(delete(rollup).where(rollup.user_id == user_id))
+
+
+def backfill(db: Session, chunk_size: int) -> int:
+    """Rebuild every rollup from the raw tables, ``chunk_size`` users per transaction.
+
+    Days before the archive horizon (see archive.py) keep their rollups.
+    """
+    user_ids = db.execute(select(User.id).where(health_score.ACTIVE_USERS).order_by(User.id)).scalars().all()
+    for model, rollup in ROLLUP_BY_MODEL.items():
+        _, column = cohort_stats.METRIC_BY_MODEL[model]
+        day = func.date(model.recorded_at)
+        archived_until = archive.horizon(model)
+        for chunk in health_score.chunked(user_ids, chunk_size):
+            stale, source = rollup.user_id.in_(chunk), model.user_id.in_(chunk)
+            if archived_until is not None:
+                stale = and_(stale, rollup.day >= archived_until.date())
+                source = and_(source, model.recorded_at >= archived_until)
+            db.execute(delete(rollup).where(stale))
+            db.execute(insert(rollup).from_select(
+                ["user_id", "day", "total", "count", "min_value", "max_value", "updated_at"],
+                select(model.user_id, day, func.sum(column), func.count(column), func.min(column), func.max(column),
+                       func.now())
+                .where(source, column.isnot(None))
+                .group_by(model.user_id, day),
+            ))
+            db.commit()
+    return len(user_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill the daily rollup tables from the raw metric tables.")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="users rebuilt per transaction")
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        print("🚀 Backfilling daily rollups...")
+        users = backfill(session, args.chunk_size)
+        print(f"✅ Daily rollups rebuilt for {users} users!")
+    except Exception as e:
+        session.rollback()
+        print(f"❌ Error backfilling daily rollups: {e}")
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""Cache for health scores and cohort averages.
+
+Entries live in Redis when ``REDIS_URL`` is set and in an in-process LRU
+otherwise. Every entry expires after ``HEALTH_SCORE_CACHE_TTL`` seconds and is
+tagged with its cohort's *generation*, a random token that writes replace:
+invalidating a cohort therefore drops the cohort averages and the scores of all
+its members without enumerating them. Windowed scores (``window`` in days) are
+cached under their own keys next to the all-time ones.
+
+A generation records when the write that replaced it happened. When the scores
+are read from a lagging replica (``settle_seconds``, see
+``READ_REPLICA_LAG_SECONDS`` in create_db.py) nothing is cached under a
+generation younger than that lag: the replica may not have the write yet, and
+its stale values would otherwise stay cached until the next write.
+
+The cohort key of each user (``member`` entries) is cached as well so metric
+writes can skip the user lookup; user updates and deletes drop it. The API
+only relies on these when the cache is ``shared`` across worker processes.
+
+``HEALTH_SCORE_CACHE_SIZE`` bounds the in-process LRU; 0 turns the in-process
+cache off (every lookup misses), e.g. for benchmarks of the scoring queries.
+The LRU is also off when the API runs several workers (``WEB_CONCURRENCY``):
+a write only invalidates the LRU of the worker that served it, the others
+would keep serving the old scores until the TTL. Use Redis there.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+import redis
+import redis.asyncio
+
+REDIS_URL = os.getenv("REDIS_URL")
+CACHE_TTL_SECONDS = int(os.getenv("HEALTH_SCORE_CACHE_TTL", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("HEALTH_SCORE_CACHE_SIZE", "10000"))
+# Worker processes of the API: uvicorn (--workers) and gunicorn default to it
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+KEY_PREFIX = "health_score"
+# Windows with their own entries besides the all-time one (None)
+CACHED_WINDOWS = (None, 7, 30, 90)
+# Score modes of get_health_score; "mean" entries carry no suffix
+CACHED_MODES = ("mean", "percentile")
+
+logger = logging.getLogger(__name__)
+
+
+class NullCacheBackend:
+    """Backend that stores nothing: every lookup misses."""
+
+    shared = False
+
+    async def get(self, key: str):
+        return None
+
+    async def set(self, key: str, value, ttl: Optional[int] = None):
+        pass
+
+    async def add(self, key: str, value):
+        return value
+
+    async def delete(self, *keys: str):
+        pass
+
+    async def close(self):
+        pass
+
+
+class LRUCacheBackend:
+    """Thread-safe in-process stand-in for Redis.
+
+    The methods are coroutines only to share the interface of the Redis backend.
+    """
+
+    # Private to the process: other workers do not see its entries or deletions
+    shared = False
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        if max_entries < 1:
+            raise ValueError(f"LRUCacheBackend needs at least 1 entry, got {max_entries}")
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    async def set(self, key: str, value, ttl: Optional[int] = None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    async def add(self, key: str, value):
+        """Store ``value`` unless ``key`` is present; return the stored value."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._store(key, value, None)
+                return value
+            return entry[0]
+
+    async def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    async def close(self):
+        pass
+
+    def _store(self, key, value, ttl):
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class RedisCacheBackend:
+    """Redis backend; connection errors degrade to cache misses."""
+
+    shared = True
+
+    def __init__(self, url: str):
+        self.client = redis.asyncio.Redis.from_url(url, decode_responses=True)
+
+    async def get(self, key: str):
+        try:
+            value = await self.client.get(key)
+        except redis.RedisError as e:
+            logger.warning(f"Redis get failed for {key}: {e}")
+            return None
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key: str, value, ttl: Optional[int] = None):
+        try:
+            await self.client.set(key, json.dumps(value), ex=ttl)
+        except redis.RedisError as e:
+            logger.warning(f"Redis set failed for {key}: {e}")
+
+    async def add(self, key: str, value):
+        try:
+            await self.client.set(key, json.dumps(value), nx=True)
+        except redis.RedisError as e:
+            logger.warning(f"Redis set failed for {key}: {e}")
+            return value
+        return await self.get(key) or value
+
+    async def delete(self, *keys: str):
+        try:
+            await self.client.delete(*keys)
+        except redis.RedisError as e:
+            logger.warning(f"Redis delete failed for {keys}: {e}")
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class HealthScoreCache:
+    def __init__(self, backend, ttl: int = CACHE_TTL_SECONDS, settle_seconds: float = 0):
+        self.backend = backend
+        self.ttl = ttl
+        self.settle_seconds = settle_seconds
+
+    @property
+    def shared(self) -> bool:
+        """Whether every worker process sees the same entries."""
+        return self.backend.shared
+
+    @staticmethod
+    def _window_suffix(window: Optional[int]) -> str:
+        return f":{window}d" if window else ""
+
+    @classmethod
+    def _score_key(cls, user_id: int, window: Optional[int] = None, mode: str = "mean") -> str:
+        mode_suffix = f":{mode}" if mode != "mean" else ""
+        return f"{KEY_PREFIX}:user:{user_id}{cls._window_suffix(window)}{mode_suffix}"
+
+    @classmethod
+    def _cohort_key(cls, cohort_key: str, window: Optional[int] = None) -> str:
+        return f"{KEY_PREFIX}:cohort:{cohort_key}{cls._window_suffix(window)}"
+
+    @staticmethod
+    def _generation_key(cohort_key: str) -> str:
+        return f"{KEY_PREFIX}:generation:{cohort_key}"
+
+    @staticmethod
+    def _member_key(user_id: int) -> str:
+        return f"{KEY_PREFIX}:member:{user_id}"
+
+    async def close(self):
+        """Release the backend's connections (API shutdown)."""
+        await self.backend.close()
+
+    @staticmethod
+    def _new_generation(written_at: float) -> str:
+        return f"{written_at:.3f}:{uuid.uuid4().hex}"
+
+    def settled(self, generation: str) -> bool:
+        """Whether the write that started ``generation`` is older than ``settle_seconds``."""
+        written_at, _, token = generation.partition(":")
+        if not token:
+            return True
+        return float(written_at) + self.settle_seconds <= time.time()
+
+    async def generation(self, cohort_key: str) -> str:
+        """Current generation of a cohort; read it *before* computing a value to cache."""
+        # A generation started by a read follows no write and is settled from the start
+        return await self.backend.add(self._generation_key(cohort_key), self._new_generation(0))
+
+    async def get_score(self, user_id: int, window: Optional[int] = None, mode: str = "mean") -> Optional[dict]:
+        entry = await self.backend.get(self._score_key(user_id, window, mode))
+        if entry is None or entry["generation"] != await self.generation(entry["cohort_key"]):
+            return None
+        return entry["score"]
+
+    async def set_score(self, user_id: int, cohort_key: str, generation: str, score: dict,
+                        window: Optional[int] = None, mode: str = "mean"):
+        if not self.settled(generation):
+            return
+        entry = {"cohort_key": cohort_key, "generation": generation, "score": score}
+        await self.backend.set(self._score_key(user_id, window, mode), entry, self.ttl)
+
+    async def get_cohort(self, cohort_key: str, generation: str, window: Optional[int] = None):
+        """Return cached ``(group_size, averages)`` for the cohort or ``None``."""
+        entry = await self.backend.get(self._cohort_key(cohort_key, window))
+        if entry is None or entry["generation"] != generation:
+            return None
+        return entry["group_size"], entry["averages"]
+
+    async def set_cohort(self, cohort_key: str, generation: str, group_size: int, averages: dict,
+                         window: Optional[int] = None):
+        if not self.settled(generation):
+            return
+        entry = {"generation": generation, "group_size": group_size, "averages": averages}
+        await self.backend.set(self._cohort_key(cohort_key, window), entry, self.ttl)
+
+    async def get_member_cohort(self, user_id: int) -> Optional[str]:
+        return await self.backend.get(self._member_key(user_id))
+
+    async def set_member_cohort(self, user_id: int, cohort_key: str):
+        await self.backend.set(self._member_key(user_id), cohort_key, self.ttl)
+
+    async def forget_member(self, user_id: int):
+        """Drop a user's cached cohort key; call it when the user's cohort changes or the user is deleted."""
+        await self.backend.delete(self._member_key(user_id))
+
+    async def invalidate_cohort(self, *cohort_keys: str):
+        for cohort_key in cohort_keys:
+            await self.backend.set(self._generation_key(cohort_key), self._new_generation(time.time()))
+            await self.backend.delete(*(self._cohort_key(cohort_key, window) for window in CACHED_WINDOWS))
+
+    async def invalidate_user(self, user_id: int, *cohort_keys: str):
+        """Drop a user's scores and the cohorts their data contributes to."""
+        await self.backend.delete(*(
+            self._score_key(user_id, window, mode) for window in CACHED_WINDOWS for mode in CACHED_MODES
+        ))
+        await self.invalidate_cohort(*cohort_keys)
+
+
+def create_score_cache(settle_seconds: float = 0) -> HealthScoreCache:
+    if REDIS_URL:
+        return HealthScoreCache(RedisCacheBackend(REDIS_URL), settle_seconds=settle_seconds)
+    if CACHE_MAX_ENTRIES < 0:
+        raise ValueError(f"HEALTH_SCORE_CACHE_SIZE must not be negative, got {CACHE_MAX_ENTRIES}")
+    if CACHE_MAX_ENTRIES == 0:
+        return HealthScoreCache(NullCacheBackend(), settle_seconds=settle_seconds)
+    if WORKERS > 1:
+        logger.warning(f"Health score cache disabled: {WORKERS} workers need a shared cache (REDIS_URL)")
+        return HealthScoreCache(NullCacheBackend(), settle_seconds=settle_seconds)
+    return HealthScoreCache(LRUCacheBackend(), settle_seconds=settle_seconds)
@@ -0,0 +1,149 @@
+"""Score every user in one offline pass and persist the results.
+
+Per-user sums and counts are streamed out of the database with one grouped
+query per metric table (plus one per daily rollup for archived months), the ``get_health_score`` formula is evaluated over
+NumPy arrays for the whole population, and the results are bulk-written to
+``health_scores`` in chunks. Run it next to the other database scripts:
+
+    python score_population.py --chunk-size 5000
+"""
+import argparse
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import Session
+
+from create_db import SessionLocal, HealthScore, User
+import archive
+import cohort_stats
+import health_score
+
+STREAM_BATCH_SIZE = 10000
+
+
+def load_users(db: Session):
+    """Return sorted user ids and an integer cohort code per user."""
+    user_ids, codes, cohort_codes = [], [], {}
+    stmt = select(User.id, *cohort_stats.COHORT_COLUMNS).where(health_score.ACTIVE_USERS).order_by(User.id)
+    for partition in db.execute(stmt.execution_options(yield_per=STREAM_BATCH_SIZE)).partitions():
+        for row in partition:
+            user_ids.append(row.id)
+            codes.append(cohort_codes.setdefault(cohort_stats.cohort_key(row), len(cohort_codes)))
+    return np.array(user_ids, dtype=np.int64), np.array(codes, dtype=np.int64)
+
+
+def load_metric_totals(db: Session, user_ids: np.ndarray, name: str):
+    """Stream ``SUM``/``COUNT`` of one metric per user into arrays aligned with ``user_ids``.
+
+    Days before the archive horizon (see archive.py) come from the daily
+    rollups, the rest from the raw table.
+    """
+    model, column, _ = health_score.METRICS[name]
+    rollup = health_score.DAILY_ROLLUPS[name]
+    raw = select(model.user_id, func.sum(column), func.count(column)).group_by(model.user_id)
+    statements = [raw]
+    archived_until = archive.horizon(model)
+    if archived_until is not None:
+        statements = [
+            raw.where(model.recorded_at >= archived_until),
+            select(rollup.user_id, func.sum(rollup.total), func.sum(rollup.count))
+            .where(rollup.day < archived_until.date())
+            .group_by(rollup.user_id),
+        ]
+
+    totals = np.zeros(len(user_ids))
+    counts = np.zeros(len(user_ids))
+    for stmt in statements:
+        for partition in db.execute(stmt.execution_options(yield_per=STREAM_BATCH_SIZE)).partitions():
+            rows = np.array([(user_id, float(total or 0), count or 0) for user_id, total, count in partition])
+            ids = rows[:, 0].astype(np.int64)
+            positions = np.searchsorted(user_ids, ids)
+            # Drop samples of users that no longer exist
+            known = positions < len(user_ids)
+            known[known] = user_ids[positions[known]] == ids[known]
+            np.add.at(totals, positions[known], rows[known, 1])
+            np.add.at(counts, positions[known], rows[known, 2])
+    return totals, counts
+
+
+def calculate_health_scores(values: dict, group_averages: dict) -> np.ndarray:
+    """Vectorized ``health_score.calculate_health_score``."""
+    score = (
+        np.minimum(29.9, (values["steps"] / (group_averages["steps"] + 1)) * 30) +
+        np.minimum(39.9, (values["sleep"] / (group_averages["sleep"] + 1)) * 40) +
+        np.minimum(29.9, (100 / (values["glucose"] + 1)) * 30)
+    )
+    no_data = (values["steps"] == 0) & (values["sleep"] == 0) & (values["glucose"] == 100)
+    return np.round(np.where(no_data, 0, score), 2)
+
+
+def score_population(db: Session):
+    """Return ``(user_ids, scores, values, group_averages, group_sizes)`` arrays."""
+    user_ids, codes = load_users(db)
+    cohorts = int(codes.max()) + 1 if len(codes) else 0
+    group_sizes = np.bincount(codes, minlength=cohorts)[codes]
+
+    values, group_averages = {}, {}
+    for name, (_, _, default) in health_score.METRICS.items():
+        totals, counts = load_metric_totals(db, user_ids, name)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            values[name] = np.where(counts > 0, totals / counts, default)
+            cohort_totals = np.bincount(codes, weights=totals, minlength=cohorts)
+            cohort_counts = np.bincount(codes, weights=counts, minlength=cohorts)
+            cohort_means = np.where(cohort_counts > 0, cohort_totals / cohort_counts, default)
+        group_averages[name] = cohort_means[codes]
+
+    return user_ids, calculate_health_scores(values, group_averages), values, group_averages, group_sizes
+
+
+def write_scores(db: Session, results, chunk_size: int) -> int:
+    user_ids, scores, values, group_averages, group_sizes = results
+    computed_at = datetime.utcnow()
+    for start in range(0, len(user_ids), chunk_size):
+        end = start + chunk_size
+        rows = [
+            dict(
+                user_id=int(user_ids[i]),
+                health_score=float(scores[i]),
+                steps=float(values["steps"][i]),
+                sleep=float(values["sleep"][i]),
+                glucose=float(values["glucose"][i]),
+                group_steps=float(group_averages["steps"][i]),
+                group_sleep=float(group_averages["sleep"][i]),
+                group_glucose=float(group_averages["glucose"][i]),
+                group_size=int(group_sizes[i]),
+                computed_at=computed_at,
+            )
+            for i in range(start, min(end, len(user_ids)))
+        ]
+        db.execute(delete(HealthScore).where(HealthScore.user_id.in_([row["user_id"] for row in rows])))
+        db.execute(insert(HealthScore), rows)
+        db.commit()
+    # Users deleted since the previous run
+    db.execute(delete(HealthScore).where(HealthScore.computed_at < computed_at))
+    db.commit()
+    return len(user_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score every user and store the results in health_scores.")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="rows written per transaction")
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        print("🚀 Scoring the whole population...")
+        results = score_population(session)
+        print(f"📌 Scored {len(results[0])} users, writing results...")
+        written = write_scores(session, results, args.chunk_size)
+        print(f"✅ {written} health scores stored!")
+    except Exception as e:
+        session.rollback()
+        print(f"❌ Error scoring population: {e}")
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
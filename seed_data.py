@@ -1,119 +1,195 @@
-from sqlalchemy.orm import Session
-from create_db import SessionLocal, User, PhysicalActivity, SleepActivity, BloodTests
-from datetime import datetime, UTC, timedelta
-import uuid
+"""Synthetic data generator for development and load testing.
+
+Creates ``--users`` users spread over realistic cohorts (athletes, average,
+sedentary, elderly) and ``--days`` days of samples per metric and user. Every
+user's attributes and samples come from a random generator seeded with
+``--seed`` and the user's position, so a run is reproducible whatever the
+number of workers. Samples are written with multi-row ``INSERT`` statements
+from ``--workers`` processes, after which the derived tables (cohort_stats,
+daily rollups, window aggregates, quantile sketches) are rebuilt.
+
+    python seed_data.py --users 100000 --days 30 --activity-per-day 3 --workers 8
+"""
+import argparse
+import os
 import random
+import time
+import uuid
+from datetime import datetime, timedelta
+from multiprocessing import Pool
 
-def seed_data():
-    session: Session = SessionLocal()
+from sqlalchemy import func, insert, select
 
-    try:
-        print("\n🚀 *** Start filling test data ***\n")
-        user_groups = {
-            "Athletes": [],
-            "Average": [],
-            "Sedentary": [],
-            "Elderly": []
-        }
-
-        users = [
-            User(gender="male", age_group="20-30", climate_zone="Temperate", chronic_conditions="no",
-                 fitness_level="advanced", language="en", uuid=str(uuid.uuid4()), registration_status="completed",
-                 registration_source="Web"),
-            User(gender="female", age_group="20-30", climate_zone="Temperate", chronic_conditions="no",
-                 fitness_level="advanced", language="fr", uuid=str(uuid.uuid4()), registration_status="completed",
-                 registration_source="App"),
-            User(gender="male", age_group="30-40", climate_zone="Tropical", chronic_conditions="no",
-                 fitness_level="intermediate", language="es", uuid=str(uuid.uuid4()), registration_status="completed",
-                 registration_source="Telegram"),
-            User(gender="female", age_group="30-40", climate_zone="Tropical", chronic_conditions="yes",
-                 fitness_level="intermediate", language="de", uuid=str(uuid.uuid4()), registration_status="pending",
-                 registration_source="Web"),
-            User(gender="male", age_group="40-50", climate_zone="Arctic", chronic_conditions="yes",
-                 fitness_level="beginner", language="en", uuid=str(uuid.uuid4()), registration_status="completed",
-                 registration_source="Web"),
-            User(gender="female", age_group="40-50", climate_zone="Arctic", chronic_conditions="yes",
-                 fitness_level="beginner", language="ru", uuid=str(uuid.uuid4()), registration_status="pending",
-                 registration_source="App"),
-            User(gender="male", age_group="50-60", climate_zone="Desert", chronic_conditions="yes",
-                 fitness_level="low", language="it", uuid=str(uuid.uuid4()), registration_status="completed",
-                 registration_source="Telegram"),
-            User(gender="female", age_group="50-60", climate_zone="Desert", chronic_conditions="yes",
-                 fitness_level="low", language="nl", uuid=str(uuid.uuid4()), registration_status="completed",
-                 registration_source="Web"),
-            User(gender="male", age_group="60-70", climate_zone="Temperate", chronic_conditions="yes",
-                 fitness_level="very low", language="en", uuid=str(uuid.uuid4()), registration_status="pending",
-                 registration_source="App"),
-            User(gender="female", age_group="60-70", climate_zone="Temperate", chronic_conditions="yes",
-                 fitness_level="very low", language="es", uuid=str(uuid.uuid4()), registration_status="completed",
-                 registration_source="Web"),
-        ]
-
-        session.add_all(users)
-        session.commit()
-        print("✅ Users added!\n")
-        users_data = session.query(User).all()
-        user_ids = [user.id for user in users_data]
-
-        user_groups["Athletes"] = user_ids[:2]
-        user_groups["Average"] = user_ids[2:5]
-        user_groups["Sedentary"] = user_ids[5:8]
-        user_groups["Elderly"] = user_ids[8:]
-
-        print("📌 **User groups:**")
-        for group, ids in user_groups.items():
-            print(f"🔹 {group}: {ids}")
-
-        physical_activities = []
-        for user_id in user_ids:
-            steps = random.randint(2000, 15000)
-            calories = round(steps * 0.05, 1)
-            active_minutes = random.randint(20, 120)
-            recorded_at = datetime.now(UTC) - timedelta(days=random.randint(0, 30))
-
-            physical_activities.append(PhysicalActivity(
-                user_id=user_id, steps=steps, calories_burned=calories,
-                active_minutes=active_minutes, recorded_at=recorded_at
-            ))
+from create_db import SessionLocal, engine, User, PhysicalActivity, SleepActivity, BloodTests
+import cohort_stats
+import quantile_sketches
+import rollups
 
-        session.add_all(physical_activities)
-        session.commit()
-        print("✅ Physical activity data added!\n")
-        sleep_data = []
-        for user_id in user_ids:
-            sleep_duration = round(random.uniform(4, 9), 1)
-            sleep_quality = random.randint(50, 100)
-            recorded_at = datetime.now(UTC) - timedelta(days=random.randint(0, 30))
-
-            sleep_data.append(SleepActivity(
-                user_id=user_id, sleep_duration=sleep_duration,
-                sleep_quality=sleep_quality, recorded_at=recorded_at
-            ))
+CLIMATE_ZONES = ["Temperate", "Tropical", "Arctic", "Desert"]
+LANGUAGES = ["en", "fr", "es", "de", "ru", "it", "nl"]
+REGISTRATION_SOURCES = ["Web", "App", "Telegram"]
+
+# weight, age groups, fitness levels, share with chronic conditions,
+# (mean, sd) of daily steps, sleep hours and glucose
+PROFILES = {
+    "Athletes": dict(weight=0.15, age_groups=["20-30", "30-40"], fitness_levels=["advanced"], chronic=0.05,
+                     steps=(12000, 2500), sleep=(8.0, 0.7), glucose=(85, 8)),
+    "Average": dict(weight=0.45, age_groups=["20-30", "30-40", "40-50"], fitness_levels=["intermediate", "beginner"],
+                    chronic=0.2, steps=(7500, 2000), sleep=(7.0, 1.0), glucose=(95, 10)),
+    "Sedentary": dict(weight=0.25, age_groups=["30-40", "40-50", "50-60"], fitness_levels=["beginner", "low"],
+                      chronic=0.4, steps=(3500, 1200), sleep=(6.3, 1.2), glucose=(105, 12)),
+    "Elderly": dict(weight=0.15, age_groups=["60-70"], fitness_levels=["low", "very low"], chronic=0.7,
+                    steps=(3000, 1000), sleep=(6.5, 1.0), glucose=(110, 14)),
+}
+
+
+def user_rng(seed: int, index: int, stream: str) -> random.Random:
+    """Generator of one user's ``stream`` ("user" or "samples"), independent of all others."""
+    return random.Random(f"{seed}:{index}:{stream}")
 
-        session.add_all(sleep_data)
-        session.commit()
-        print("✅ Sleep data added!\n")
 
-        blood_tests = []
-        for user_id in user_ids:
-            glucose_level = round(random.uniform(70, 120), 1)
-            cholesterol_level = round(random.uniform(150, 250), 1)
-            recorded_at = datetime.now(UTC) - timedelta(days=random.randint(0, 30))
+def user_profile(rng: random.Random) -> str:
+    return rng.choices(list(PROFILES), weights=[profile["weight"] for profile in PROFILES.values()])[0]
 
-            blood_tests.append(BloodTests(
-                user_id=user_id, glucose_level=glucose_level,
-                cholesterol_level=cholesterol_level, recorded_at=recorded_at
+
+def generate_user(seed: int, index: int) -> dict:
+    rng = user_rng(seed, index, "user")
+    profile = PROFILES[user_profile(rng)]
+    return dict(
+        gender=rng.choice(["male", "female"]),
+        age_group=rng.choice(profile["age_groups"]),
+        climate_zone=rng.choice(CLIMATE_ZONES),
+        chronic_conditions="yes" if rng.random() < profile["chronic"] else "no",
+        fitness_level=rng.choice(profile["fitness_levels"]),
+        language=rng.choice(LANGUAGES),
+        uuid=str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+        registration_status="completed" if rng.random() < 0.8 else "pending",
+        registration_source=rng.choice(REGISTRATION_SOURCES),
+    )
+
+
+def generate_samples(seed: int, index: int, user_id: int, days: int, activity_per_day: int, end: datetime):
+    """Rows of the three metric tables for one user."""
+    profile = PROFILES[user_profile(user_rng(seed, index, "user"))]
+    rng = user_rng(seed, index, "samples")
+
+    activity, sleep, blood = [], [], []
+    for day in range(days):
+        day_start = end - timedelta(days=day + 1)
+        for _ in range(activity_per_day):
+            steps = max(0, int(rng.gauss(*profile["steps"]) / activity_per_day))
+            activity.append(dict(
+                user_id=user_id, steps=steps, calories_burned=round(steps * 0.05, 1),
+                active_minutes=max(0, int(steps / 100 + rng.gauss(0, 10))),
+                recorded_at=day_start + timedelta(seconds=rng.randrange(86400)),
             ))
+        sleep.append(dict(
+            user_id=user_id, sleep_duration=round(min(12.0, max(2.0, rng.gauss(*profile["sleep"]))), 1),
+            sleep_quality=rng.randint(50, 100), recorded_at=day_start + timedelta(hours=7),
+        ))
+        blood.append(dict(
+            user_id=user_id, glucose_level=round(max(50.0, rng.gauss(*profile["glucose"])), 1),
+            cholesterol_level=round(rng.uniform(150, 250), 1), recorded_at=day_start + timedelta(hours=8),
+        ))
+    return {PhysicalActivity: activity, SleepActivity: sleep, BloodTests: blood}
 
-        session.add_all(blood_tests)
-        session.commit()
-        print("✅ Blood test data added!\n")
-    except Exception as e:
-        session.rollback()
-        print(f"❌ Error filling data: {e}")
+
+def insert_users(seed: int, users: int, chunk_size: int):
+    """Insert the users in order; returns ``[(index, user_id)]``."""
+    with engine.begin() as conn:
+        first_id = (conn.execute(select(func.max(User.id))).scalar() or 0) + 1
+        now = datetime.utcnow()
+        for start in range(0, users, chunk_size):
+            rows = [
+                dict(generate_user(seed, index), created_at=now, updated_at=now)
+                for index in range(start, min(users, start + chunk_size))
+            ]
+            conn.execute(insert(User), rows)
+        user_ids = conn.execute(select(User.id).where(User.id >= first_id).order_by(User.id)).scalars().all()
+    return list(enumerate(user_ids))
+
+
+def init_worker():
+    # Connections inherited from the parent process must not be reused
+    engine.dispose(close=False)
+
+
+def seed_users(task):
+    """Worker: generate and insert the samples of a slice of users; returns the row count."""
+    users, seed, days, activity_per_day, end, chunk_size = task
+    rows_by_model = {PhysicalActivity: [], SleepActivity: [], BloodTests: []}
+    for index, user_id in users:
+        for model, rows in generate_samples(seed, index, user_id, days, activity_per_day, end).items():
+            rows_by_model[model].extend(rows)
+
+    with engine.begin() as conn:
+        for model, rows in rows_by_model.items():
+            for start in range(0, len(rows), chunk_size):
+                conn.execute(insert(model), rows[start:start + chunk_size])
+    return sum(len(rows) for rows in rows_by_model.values())
+
+
+def rebuild_aggregates():
+    session = SessionLocal()
+    try:
+        cohort_stats.assign_cohorts(session)
+        cohort_stats.rebuild(session)
+        rollups.backfill(session, 1000)
+        cohort_stats.refresh_windows(session)
+        quantile_sketches.rebuild(session)
     finally:
         session.close()
-        print("🔄 Database session closed.")
+
+
+def seed_data(args):
+    started = time.monotonic()
+    end = datetime.combine(datetime.utcnow().date() + timedelta(days=1), datetime.min.time())
+
+    print(f"\n🚀 *** Generating {args.users} users, {args.days} days of samples (seed {args.seed}) ***\n")
+    users = insert_users(args.seed, args.users, args.chunk_size)
+    if args.skip_aggregates:
+        session = SessionLocal()
+        try:
+            cohort_stats.assign_cohorts(session)
+        finally:
+            session.close()
+    print(f"✅ {len(users)} users added!\n")
+
+    tasks = [
+        (users[start:start + args.users_per_task], args.seed, args.days, args.activity_per_day, end, args.chunk_size)
+        for start in range(0, len(users), args.users_per_task)
+    ]
+    written = 0
+    with Pool(args.workers, initializer=init_worker) as pool:
+        for rows in pool.imap_unordered(seed_users, tasks):
+            written += rows
+            print(f"📌 {written} samples written...")
+    print(f"✅ {written} samples added in {time.monotonic() - started:.1f}s!\n")
+
+    if not args.skip_aggregates:
+        print("🚀 Rebuilding cohort statistics and daily rollups...")
+        rebuild_aggregates()
+        print("✅ Aggregates rebuilt!\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the database with reproducible synthetic data.")
+    parser.add_argument("--users", type=int, default=10, help="number of users to create")
+    parser.add_argument("--days", type=int, default=30, help="days of samples per metric and user")
+    parser.add_argument("--activity-per-day", type=int, default=1, help="physical activity samples per day")
+    parser.add_argument("--seed", type=int, default=42, help="random seed; same seed, same data")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--users-per-task", type=int, default=500, help="users handed to a worker at a time")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="rows per INSERT statement")
+    parser.add_argument("--skip-aggregates", action="store_true",
+                        help="do not rebuild cohort_stats and the rollups afterwards")
+    args = parser.parse_args()
+
+    try:
+        seed_data(args)
+    except Exception as e:
+        print(f"❌ Error filling data: {e}")
+
 
 if __name__ == "__main__":
-    seed_data()
\ No newline at end of file
+    main()
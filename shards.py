@@ -0,0 +1,232 @@
+"""User-id sharding over several databases.
+
+Shard 0 is the database of create_db.py (``DATABASE_URL`` and its replica).
+``SHARD_DATABASE_URLS`` (comma-separated, with ``ASYNC_SHARD_DATABASE_URLS``
+for the async driver) adds shards 1, 2, ... with the same schema; several
+local SQLite files do for testing:
+
+    SHARD_DATABASE_URLS=sqlite:///./shard1.db ASYNC_SHARD_DATABASE_URLS=sqlite+aiosqlite:///./shard1.db
+
+The ``user_shards`` directory on shard 0 hands out the user ids and maps each
+user (and uuid) to a shard. New users go to the shard their uuid hashes to;
+users missing from the directory (created before sharding) are on shard 0.
+Lookups are cached in-process for ``SHARD_CACHE_SECONDS``.
+
+The per-user endpoints get a session on the user's shard (main.get_db and
+main.get_read_db route by the ``user_id`` path parameter). Each shard keeps
+the cohort aggregates of its own users; get_health_score, the score history
+and batch scoring sum them over all shards (``scatter``). Ids of the ``cohorts`` registry come from
+shard 0, so a cohort has the same id on every shard. Users move between shards
+with rebalance.py. The other maintenance commands work on one database: run
+them once per shard with ``DATABASE_URL`` pointing at it; archive.py is the
+exception, its Parquet files are not per shard yet.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, delete, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+
+from create_db import (
+    DB_ASYNC, SessionLocal, ReadSessionLocal, AsyncSessionLocal, AsyncReadSessionLocal, UserShard,
+    engine_options, enable_foreign_keys, register_engines,
+)
+
+SHARD_DATABASE_URLS = [url for url in os.getenv("SHARD_DATABASE_URLS", "").split(",") if url]
+ASYNC_SHARD_DATABASE_URLS = [url for url in os.getenv("ASYNC_SHARD_DATABASE_URLS", "").split(",") if url]
+SHARD_CACHE_SECONDS = int(os.getenv("SHARD_CACHE_SECONDS", "30"))
+SHARD_CACHE_SIZE = int(os.getenv("SHARD_CACHE_SIZE", "100000"))
+LOOKUP_CHUNK_SIZE = 1000
+
+
+class Shard:
+    """Session factories of one shard; the read ones default to the primary's."""
+
+    def __init__(self, index: int, session_factory, read_session_factory=None, async_session_factory=None,
+                 async_read_session_factory=None):
+        self.index = index
+        self.SessionLocal = session_factory
+        self.ReadSessionLocal = read_session_factory or session_factory
+        self.AsyncSessionLocal = async_session_factory
+        self.AsyncReadSessionLocal = async_read_session_factory or async_session_factory
+
+    def engines(self) -> list:
+        """Distinct engines of the shard (async ones included)."""
+        engines = []
+        for factory in (self.SessionLocal, self.ReadSessionLocal, self.AsyncSessionLocal, self.AsyncReadSessionLocal):
+            bind = factory.kw["bind"] if factory is not None else None
+            if bind is not None and bind not in engines:
+                engines.append(bind)
+        return engines
+
+    def owns(self, db) -> bool:
+        """Whether the sync session ``db`` is connected to this shard."""
+        return db.get_bind() in {getattr(bind, "sync_engine", bind) for bind in self.engines()}
+
+
+def create_shard(index: int, url: str, async_url: str = None) -> Shard:
+    if DB_ASYNC and async_url is None:
+        raise ValueError("ASYNC_SHARD_DATABASE_URLS must list one URL per entry of SHARD_DATABASE_URLS")
+    engine = create_engine(url, **engine_options(url))
+    async_engine = create_async_engine(async_url, **engine_options(async_url)) if DB_ASYNC else None
+    enable_foreign_keys(engine, async_engine)
+    register_engines(engine, async_engine)
+    return Shard(
+        index,
+        sessionmaker(autocommit=False, autoflush=False, bind=engine),
+        async_session_factory=async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+        if async_engine is not None else None,
+    )
+
+
+SHARDS = [Shard(0, SessionLocal, ReadSessionLocal, AsyncSessionLocal, AsyncReadSessionLocal)] + [
+    create_shard(index, url, ASYNC_SHARD_DATABASE_URLS[index - 1] if index <= len(ASYNC_SHARD_DATABASE_URLS) else None)
+    for index, url in enumerate(SHARD_DATABASE_URLS, start=1)
+]
+SHARDED = len(SHARDS) > 1
+
+_routes = OrderedDict()
+_routes_lock = None
+_pool = None
+
+
+def _create_pool():
+    # The threads of a pool do not survive a fork: every process gets its own
+    global _pool, _routes_lock
+    _routes_lock = threading.Lock()
+    _pool = ThreadPoolExecutor(max_workers=len(SHARDS), thread_name_prefix="shard") if SHARDED else None
+
+
+_create_pool()
+os.register_at_fork(after_in_child=_create_pool)
+
+
+def home_shard(uuid: str) -> int:
+    """Shard a new user with ``uuid`` is created on."""
+    return int(hashlib.sha1(uuid.encode("utf-8")).hexdigest(), 16) % len(SHARDS)
+
+
+def _cached(user_id: int):
+    entry = _routes.get(user_id)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+
+def _remember(found: dict):
+    expires = time.monotonic() + SHARD_CACHE_SECONDS
+    with _routes_lock:
+        for user_id, entry in found.items():
+            _routes[user_id] = (expires, entry)
+            _routes.move_to_end(user_id)
+        while len(_routes) > SHARD_CACHE_SIZE:
+            _routes.popitem(last=False)
+
+
+def routes(user_ids) -> dict:
+    """``{user_id: (shard index, shard being moved to or None)}``, from the cache or the directory.
+
+    Users missing from the directory (created before sharding) are on shard 0.
+    """
+    if not SHARDED:
+        return {user_id: (0, None) for user_id in user_ids}
+    found, missing = {}, []
+    with _routes_lock:
+        for user_id in dict.fromkeys(user_ids):
+            entry = _cached(user_id)
+            if entry is not None:
+                found[user_id] = entry
+            else:
+                missing.append(user_id)
+    if not missing:
+        return found
+
+    looked_up = {user_id: (0, None) for user_id in missing}
+    session = SHARDS[0].SessionLocal()
+    try:
+        for start in range(0, len(missing), LOOKUP_CHUNK_SIZE):
+            rows = session.execute(
+                select(UserShard.user_id, UserShard.shard, UserShard.moving_to)
+                .where(UserShard.user_id.in_(missing[start:start + LOOKUP_CHUNK_SIZE]))
+            )
+            for user_id, shard, moving_to in rows:
+                looked_up[user_id] = (shard, moving_to)
+    finally:
+        session.close()
+    _remember(looked_up)
+    return {**found, **looked_up}
+
+
+def route(user_id: int):
+    """``routes`` of one user."""
+    return routes([user_id])[user_id]
+
+
+def shard_of(user_id: int) -> Shard:
+    return SHARDS[route(user_id)[0]]
+
+
+def forget(user_id: int):
+    with _routes_lock:
+        _routes.pop(user_id, None)
+
+
+def register(uuid: str):
+    """Add a new user to the directory: ``(user id, shard index)``, ``None`` if ``uuid`` is taken."""
+    session = SHARDS[0].SessionLocal()
+    try:
+        entry = UserShard(uuid=uuid, shard=home_shard(uuid))
+        session.add(entry)
+        session.commit()
+        return entry.user_id, entry.shard
+    except IntegrityError:
+        session.rollback()
+        return None
+    finally:
+        session.close()
+
+
+def unregister(user_id: int):
+    """Drop a deleted user from the directory, which frees their uuid."""
+    session = SHARDS[0].SessionLocal()
+    try:
+        session.execute(delete(UserShard).where(UserShard.user_id == user_id))
+        session.commit()
+    finally:
+        session.close()
+    forget(user_id)
+
+
+def each(fn, groups: dict, read: bool = True) -> dict:
+    """Run ``fn(session, args)`` for every ``{shard index: args}`` of ``groups`` in parallel."""
+    def run(index):
+        shard = SHARDS[index]
+        session = (shard.ReadSessionLocal if read else shard.SessionLocal)()
+        try:
+            return fn(session, groups[index])
+        finally:
+            session.close()
+
+    if not SHARDED:
+        return {index: run(index) for index in groups}
+    return dict(zip(groups, _pool.map(run, groups)))
+
+
+def scatter(fn, *args, read: bool = True) -> list:
+    """Run ``fn(session, *args)`` on every shard in parallel; returns the results in shard order."""
+    def run(shard):
+        session = (shard.ReadSessionLocal if read else shard.SessionLocal)()
+        try:
+            return fn(session, *args)
+        finally:
+            session.close()
+
+    if not SHARDED:
+        return [run(SHARDS[0])]
+    return list(_pool.map(run, SHARDS))
@@ -0,0 +1,17 @@
+"""Point the modules under test at a throwaway SQLite database before they are imported."""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_workdir = tempfile.mkdtemp(prefix="health-tracker-tests-")
+_database = os.path.join(_workdir, "health_tracker.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{_database}"
+os.environ["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{_database}"
+os.environ["ARCHIVE_DIR"] = os.path.join(_workdir, "archive")
+os.environ["LOG_FILE"] = os.path.join(_workdir, "Health_Tracker_API.log")
+for name in ("READ_DATABASE_URL", "ASYNC_READ_DATABASE_URL", "SHARD_DATABASE_URLS", "ASYNC_SHARD_DATABASE_URLS",
+             "REDIS_URL", "WEB_CONCURRENCY", "PROMETHEUS_MULTIPROC_DIR"):
+    os.environ.pop(name, None)
@@ -0,0 +1,84 @@
+"""End to end through the async API on aiosqlite: create a user, score them, delete them."""
+import pytest
+from fastapi.testclient import TestClient
+
+import create_db
+import main
+
+USER = dict(gender="female", age_group="30-40", climate_zone="Temperate", chronic_conditions="no",
+            fitness_level="intermediate", language="en", registration_status="completed", registration_source="Web")
+
+
+@pytest.fixture(scope="module")
+def client():
+    assert create_db.DB_ASYNC and create_db.async_engine.dialect.driver == "aiosqlite"
+    create_db.Base.metadata.create_all(bind=create_db.engine)
+    with TestClient(main.create_app()) as client:
+        yield client
+
+
+def create_user(client, **fields) -> int:
+    response = client.post("/users/", json={**USER, **fields})
+    assert response.status_code == 200, response.text
+    return response.json()["user_id"]
+
+
+def add_samples(client, user_id: int, steps: int, sleep: float, glucose: float):
+    for metric, body in (
+        ("physical_activity", dict(steps=steps, calories_burned=250.0, active_minutes=45)),
+        ("sleep_activity", dict(sleep_duration=sleep, sleep_quality=80)),
+        ("blood_tests", dict(glucose_level=glucose, cholesterol_level=180.0)),
+    ):
+        response = client.post(f"/user/{user_id}/{metric}/", json=body)
+        assert response.status_code == 200, response.text
+
+
+def test_ready(client):
+    assert client.get("/ready").status_code == 200
+
+
+def test_create_score_delete(client):
+    user_id = create_user(client, climate_zone="E2E")
+    other_id = create_user(client, climate_zone="E2E")
+    add_samples(client, user_id, steps=6000, sleep=7.0, glucose=95.0)
+    add_samples(client, other_id, steps=10000, sleep=8.0, glucose=105.0)
+
+    score = client.get(f"/user/{user_id}/get_health_score/").json()
+    assert score["user_group"]["group_size"] == 2
+    assert score["user_data"] == {"steps": 6000.0, "sleep": 7.0, "glucose": 95.0}
+    assert score["group_averages"] == {"steps": 8000.0, "sleep": 7.5, "glucose": 100.0}
+    assert 0 < score["health_score"] < 100
+    # Served from the cache the second time, with its own timing
+    again = client.get(f"/user/{user_id}/get_health_score/").json()
+    assert again["health_score"] == score["health_score"]
+
+    history = client.get(f"/user/{user_id}/health_score/history").json()
+    assert [point["health_score"] for point in history["points"]] == [score["health_score"]]
+
+    # A new sample invalidates the cached score
+    add_samples(client, user_id, steps=2000, sleep=7.0, glucose=95.0)
+    updated = client.get(f"/user/{user_id}/get_health_score/").json()
+    assert updated["user_data"]["steps"] == 4000.0
+
+    response = client.delete(f"/users/{user_id}")
+    assert response.status_code == 202
+    assert response.json()["rows_total"] == 6
+    # The deletion job runs as a background task once the response is sent
+    deletion = client.get(f"/user/{user_id}/deletion").json()
+    assert (deletion["status"], deletion["rows_deleted"], deletion["progress"]) == ("done", 6, 1.0)
+
+    assert client.get(f"/users/{user_id}").status_code == 404
+    assert client.get(f"/user/{user_id}/get_health_score/").status_code == 404
+    assert client.get(f"/user/{user_id}/physical_activity/").status_code == 404
+    assert client.post(f"/user/{user_id}/blood_tests/", json=dict(glucose_level=90.0, cholesterol_level=1.0)).status_code == 404
+
+    # The cohort no longer counts the deleted user
+    remaining = client.get(f"/user/{other_id}/get_health_score/").json()
+    assert remaining["user_group"]["group_size"] == 1
+    assert remaining["group_averages"]["steps"] == 10000.0
+
+
+def test_unknown_user_is_a_404(client):
+    assert client.put("/users/999999", json={"language": "fr"}).status_code == 404
+    assert client.get("/user/999999/health_score/precomputed").status_code == 404
+    assert client.get("/user/999999/deletion").status_code == 404
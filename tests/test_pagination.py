@@ -0,0 +1,54 @@
+import base64
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+from create_db import PhysicalActivity
+from pagination import PageParams, decode_cursor, encode_cursor, page_query
+
+
+def params(**values):
+    page = PageParams(since=None, until=None, cursor=None, limit=10)
+    for name, value in values.items():
+        setattr(page, name, value)
+    return page
+
+
+@pytest.mark.parametrize("recorded_at", [
+    datetime(2025, 3, 1, 12, 30),
+    datetime(2025, 3, 1, 12, 30, 5, 123456),
+])
+def test_cursor_round_trip(recorded_at):
+    cursor = encode_cursor(recorded_at, 42)
+    assert decode_cursor(cursor) == (recorded_at, 42)
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_cursor(datetime(2025, 12, 31, 23, 59, 59, 999999), 2 ** 40)
+    assert set(cursor) <= set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_=")
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"no separator").decode(),
+    base64.urlsafe_b64encode(b"yesterday|1").decode(),
+    base64.urlsafe_b64encode(b"2025-03-01T12:30:00|one").decode(),
+    base64.urlsafe_b64encode(b"2025-03-01T12:30:00|1|2").decode(),
+    base64.urlsafe_b64encode(b"\xff\xfe|1").decode(),
+])
+def test_invalid_cursor_is_a_400(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor)
+    assert error.value.status_code == 400
+
+
+def test_page_query_continues_after_the_cursor():
+    cursor = encode_cursor(datetime(2025, 3, 1, 12, 30), 7)
+    sql = str(page_query(PhysicalActivity, 1, params(cursor=cursor, limit=25)).compile(
+        compile_kwargs={"literal_binds": True}))
+    assert "physical_activity.recorded_at > '2025-03-01 12:30:00'" in sql
+    assert "physical_activity.id > 7" in sql
+    assert "ORDER BY physical_activity.recorded_at, physical_activity.id" in sql
+    # One look-ahead row tells whether there is a next page
+    assert "LIMIT 26" in sql
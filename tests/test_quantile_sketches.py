@@ -0,0 +1,84 @@
+import random
+
+import pytest
+
+from quantile_sketches import KLLSketch, RankTable
+
+K = 128
+# Rank error of a KLL sketch is about 1.7 / k; the bound leaves room for an unlucky compaction
+MAX_RANK_ERROR = 3 / K
+
+
+@pytest.fixture(autouse=True)
+def seeded():
+    random.seed(1234)
+
+
+def sketch_of(values, k=K):
+    sketch = KLLSketch(k)
+    for value in values:
+        sketch.update(value)
+    return sketch
+
+
+def max_rank_error(sketch, values):
+    ordered = sorted(values)
+    table = sketch.rank_table()
+    errors = []
+    for q in (0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99):
+        value = ordered[int(q * len(ordered))]
+        errors.append(abs(table.rank(value) - q))
+    return max(errors)
+
+
+def test_small_sketch_is_exact():
+    sketch = sketch_of([1.0, 2.0, 3.0, 4.0])
+    table = sketch.rank_table()
+    assert sketch.n == 4
+    assert table.rank(0.0) == 0.0
+    assert table.rank(5.0) == 1.0
+    assert table.rank(2.0) == pytest.approx(0.375)
+
+
+def test_empty_and_tied_ranks():
+    assert KLLSketch().rank_table().rank(42.0) == 0.5
+    assert RankTable([1.0, 1.0, 2.0], [1, 1, 2]).rank(1.0) == pytest.approx(0.25)
+
+
+def test_rank_error_is_bounded():
+    values = [random.gauss(8000, 2500) for _ in range(50_000)]
+    sketch = sketch_of(values)
+    assert sketch.n == len(values)
+    assert sum(map(len, sketch.levels)) < 4 * K
+    assert max_rank_error(sketch, values) < MAX_RANK_ERROR
+
+
+def test_merge_keeps_counts_and_error_bound():
+    low = [random.uniform(0, 100) for _ in range(20_000)]
+    high = [random.uniform(50, 150) for _ in range(30_000)]
+    merged = sketch_of(low)
+    merged.merge(sketch_of(high))
+    assert merged.n == len(low) + len(high)
+    assert merged.rank_table().total == merged.n
+    assert max_rank_error(merged, low + high) < MAX_RANK_ERROR
+
+
+def test_merge_into_empty_sketch():
+    values = [float(value) for value in range(1000)]
+    merged = KLLSketch()
+    merged.merge(sketch_of(values))
+    assert merged.n == 1000
+    assert max_rank_error(merged, values) < MAX_RANK_ERROR
+
+
+def test_bytes_round_trip():
+    sketch = sketch_of(float(value) for value in range(5000))
+    copy = KLLSketch.from_bytes(sketch.to_bytes())
+    assert (copy.k, copy.n, copy.levels) == (sketch.k, sketch.n, sketch.levels)
+
+
+def test_unknown_format_is_rejected():
+    data = bytearray(KLLSketch().to_bytes())
+    data[0] = 99
+    with pytest.raises(ValueError):
+        KLLSketch.from_bytes(bytes(data))
@@ -0,0 +1,169 @@
+import asyncio
+
+import pytest
+
+import score_cache
+from score_cache import HealthScoreCache, LRUCacheBackend, NullCacheBackend
+
+SCORE = {"health_score": 71.5}
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class Clock:
+    """Stands in for ``time`` in score_cache: wall and monotonic clock under test control."""
+
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(score_cache, "time", clock)
+    return clock
+
+
+def cache_with(entries: int = 100, **options) -> HealthScoreCache:
+    return HealthScoreCache(LRUCacheBackend(entries), **options)
+
+
+async def store_score(cache, user_id=1, cohort_key="cohort", **options):
+    generation = await cache.generation(cohort_key)
+    await cache.set_score(user_id, cohort_key, generation, SCORE, **options)
+    return generation
+
+
+def test_score_is_served_until_the_user_is_invalidated(clock):
+    async def scenario():
+        cache = cache_with()
+        await store_score(cache)
+        assert await cache.get_score(1) == SCORE
+        await cache.invalidate_user(1)
+        return await cache.get_score(1)
+
+    assert run(scenario()) is None
+
+
+def test_cohort_invalidation_drops_every_member_score(clock):
+    async def scenario():
+        cache = cache_with()
+        await store_score(cache, user_id=1)
+        await store_score(cache, user_id=2)
+        await store_score(cache, user_id=3, cohort_key="other")
+        await cache.invalidate_cohort("cohort")
+        return [await cache.get_score(user_id) for user_id in (1, 2, 3)]
+
+    assert run(scenario()) == [None, None, SCORE]
+
+
+def test_value_computed_under_an_old_generation_is_not_served(clock):
+    async def scenario():
+        cache = cache_with()
+        generation = await cache.generation("cohort")
+        # A write lands while the score is being computed
+        await cache.invalidate_user(1, "cohort")
+        await cache.set_score(1, "cohort", generation, SCORE)
+        await cache.set_cohort("cohort", generation, 10, {"steps": 5000.0})
+        return await cache.get_score(1), await cache.get_cohort("cohort", await cache.generation("cohort"))
+
+    assert run(scenario()) == (None, None)
+
+
+def test_windows_and_modes_have_their_own_entries(clock):
+    async def scenario():
+        cache = cache_with()
+        await store_score(cache, window=7)
+        return (await cache.get_score(1), await cache.get_score(1, 7), await cache.get_score(1, 7, "percentile"))
+
+    assert run(scenario()) == (None, SCORE, None)
+
+
+def test_nothing_is_cached_within_the_settle_window_of_a_write(clock):
+    async def scenario():
+        cache = cache_with(settle_seconds=10)
+        # A generation started by a read is settled at once
+        await store_score(cache)
+        first = await cache.get_score(1)
+
+        await cache.invalidate_user(1, "cohort")
+        clock.now += 9
+        await store_score(cache)
+        within = await cache.get_score(1)
+
+        clock.now += 2
+        await store_score(cache)
+        return first, within, await cache.get_score(1)
+
+    assert run(scenario()) == (SCORE, None, SCORE)
+
+
+def test_entries_expire_after_the_ttl(clock):
+    async def scenario():
+        cache = cache_with(ttl=60)
+        await store_score(cache)
+        clock.now += 59
+        kept = await cache.get_score(1)
+        clock.now += 2
+        return kept, await cache.get_score(1)
+
+    assert run(scenario()) == (SCORE, None)
+
+
+def test_lru_evicts_the_least_recently_used_entry(clock):
+    async def scenario():
+        backend = LRUCacheBackend(2)
+        await backend.set("a", 1)
+        await backend.set("b", 2)
+        await backend.get("a")
+        await backend.set("c", 3)
+        return [await backend.get(key) for key in ("a", "b", "c")]
+
+    assert run(scenario()) == [1, None, 3]
+
+
+def test_member_cohort_keys_are_forgotten(clock):
+    async def scenario():
+        cache = cache_with()
+        await cache.set_member_cohort(1, "cohort")
+        cached = await cache.get_member_cohort(1)
+        await cache.forget_member(1)
+        return cached, await cache.get_member_cohort(1)
+
+    assert run(scenario()) == ("cohort", None)
+
+
+def test_null_backend_never_serves_anything():
+    async def scenario():
+        cache = HealthScoreCache(NullCacheBackend())
+        await store_score(cache)
+        return await cache.get_score(1)
+
+    assert run(scenario()) is None
+
+
+@pytest.mark.parametrize("size, workers, backend", [
+    (10, 1, LRUCacheBackend),
+    (0, 1, NullCacheBackend),
+    (10, 4, NullCacheBackend),
+])
+def test_create_score_cache_picks_the_backend(monkeypatch, size, workers, backend):
+    monkeypatch.setattr(score_cache, "CACHE_MAX_ENTRIES", size)
+    monkeypatch.setattr(score_cache, "WORKERS", workers)
+    cache = score_cache.create_score_cache()
+    assert type(cache.backend) is backend
+    assert not cache.shared
+
+
+def test_negative_cache_size_is_rejected(monkeypatch):
+    monkeypatch.setattr(score_cache, "CACHE_MAX_ENTRIES", -1)
+    with pytest.raises(ValueError):
+        score_cache.create_score_cache()
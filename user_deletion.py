@@ -0,0 +1,203 @@
+"""Background deletion of users.
+
+``DELETE /users/{user_id}`` only marks the user deleted (``users.deleted_at``),
+takes them out of cohort_stats and queues a ``user_deletion_jobs`` row, all in
+one short transaction. The job then removes the samples ``DELETION_CHUNK_SIZE``
+rows at a time in ``(user_id, recorded_at)`` order (the ``idx_*_user_time``
+indexes), one transaction per chunk, so ingest on the metric tables is never
+blocked for long; the archived samples (archive.py), the rollups and the user
+row go last.
+
+Progress is committed with every chunk, so an interrupted job picks up where
+it stopped. The API resumes unfinished jobs at startup; from the command line:
+
+    python user_deletion.py            # run every pending, failed or stalled job
+    python user_deletion.py --user 42  # run the job of one user
+
+Existing databases need the new column first:
+``ALTER TABLE users ADD COLUMN deleted_at DATETIME NULL``.
+"""
+import argparse
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, func, or_, select, update
+from sqlalchemy.orm import Session
+
+from create_db import (
+    SessionLocal, User, UserDeletionJob, HealthScore, PhysicalActivity, SleepActivity, BloodTests,
+)
+import archive
+import cohort_stats
+import rollups
+import shards
+
+DELETION_CHUNK_SIZE = int(os.getenv("DELETION_CHUNK_SIZE", "1000"))
+# A running job that has not committed a chunk for this long is taken to have crashed
+STALLED_AFTER = timedelta(minutes=int(os.getenv("DELETION_STALLED_AFTER_MINUTES", "5")))
+
+SAMPLE_MODELS = (BloodTests, SleepActivity, PhysicalActivity)
+
+logger = logging.getLogger(__name__)
+
+
+def count_samples(db: Session, user_id: int) -> int:
+    """Samples of the user in the metric tables, summed from the daily rollups (an index range per table).
+
+    Archived days are left out: their samples are not in the tables any more.
+    """
+    columns = []
+    for model in SAMPLE_MODELS:
+        rollup = rollups.ROLLUP_BY_MODEL[model]
+        condition = rollup.user_id == user_id
+        archived_until = archive.horizon(model)
+        if archived_until is not None:
+            condition = and_(condition, rollup.day >= archived_until.date())
+        columns.append(select(func.sum(rollup.count)).where(condition).scalar_subquery())
+    return sum(count or 0 for count in db.execute(select(*columns)).one())
+
+
+def mark_deleted(db: Session, user) -> UserDeletionJob:
+    """Hide ``user`` from the API and the cohorts and queue the deletion job; the caller commits."""
+    user.deleted_at = datetime.utcnow()
+    cohort_stats.remove_user(db, user)
+    db.execute(delete(HealthScore).where(HealthScore.user_id == user.id))
+    job = UserDeletionJob(user_id=user.id, status="pending", rows_total=count_samples(db, user.id), rows_deleted=0)
+    db.add(job)
+    db.flush()
+    return job
+
+
+def latest_job(db: Session, user_id: int):
+    return db.execute(
+        select(UserDeletionJob).where(UserDeletionJob.user_id == user_id).order_by(UserDeletionJob.id.desc()).limit(1)
+    ).scalars().first()
+
+
+def sharded_latest_job(user_id: int):
+    """``latest_job`` looked up on every shard: a finished job has taken its user out of the directory."""
+    jobs = [job for job in shards.scatter(latest_job, user_id) if job is not None]
+    return max(jobs, key=lambda job: job.created_at, default=None)
+
+
+def claim(db: Session, job_id: int) -> bool:
+    """Mark a job running unless another process is already working on it."""
+    now = datetime.utcnow()
+    result = db.execute(
+        update(UserDeletionJob)
+        .where(
+            UserDeletionJob.id == job_id,
+            or_(
+                UserDeletionJob.status.in_(("pending", "failed")),
+                (UserDeletionJob.status == "running") & (UserDeletionJob.updated_at < now - STALLED_AFTER),
+            ),
+        )
+        .values(status="running", error=None, updated_at=now)
+    )
+    db.commit()
+    return result.rowcount == 1
+
+
+def delete_chunk(db: Session, model, user_id: int, chunk_size: int) -> int:
+    """Delete the user's oldest ``chunk_size`` rows of ``model``; returns how many went."""
+    ids = db.execute(
+        select(model.id).where(model.user_id == user_id).order_by(model.recorded_at, model.id).limit(chunk_size)
+    ).scalars().all()
+    if not ids:
+        return 0
+    return db.execute(delete(model).where(model.id.in_(ids)).execution_options(synchronize_session=False)).rowcount
+
+
+def run_job(db: Session, job_id: int, chunk_size: int = DELETION_CHUNK_SIZE) -> bool:
+    """Run (or resume) one job to completion; returns ``False`` if it was not claimable."""
+    if not claim(db, job_id):
+        return False
+    job = db.get(UserDeletionJob, job_id)
+    try:
+        for model in SAMPLE_MODELS:
+            while True:
+                deleted = delete_chunk(db, model, job.user_id, chunk_size)
+                if not deleted:
+                    break
+                db.execute(
+                    update(UserDeletionJob)
+                    .where(UserDeletionJob.id == job_id)
+                    .values(rows_deleted=UserDeletionJob.rows_deleted + deleted, updated_at=datetime.utcnow())
+                )
+                db.commit()
+
+        archive.delete_user(job.user_id)
+        rollups.delete_user(db, job.user_id)
+        db.execute(delete(HealthScore).where(HealthScore.user_id == job.user_id))
+        db.execute(delete(User).where(User.id == job.user_id))
+        now = datetime.utcnow()
+        db.execute(
+            update(UserDeletionJob).where(UserDeletionJob.id == job_id)
+            .values(status="done", updated_at=now, finished_at=now)
+        )
+        db.commit()
+        if shards.SHARDED:
+            shards.unregister(job.user_id)
+        logger.info(f"User {job.user_id} deleted (job {job_id})")
+        return True
+    except Exception as e:
+        db.rollback()
+        db.execute(
+            update(UserDeletionJob).where(UserDeletionJob.id == job_id)
+            .values(status="failed", error=str(e), updated_at=datetime.utcnow())
+        )
+        db.commit()
+        logger.error(f"User deletion job {job_id} failed: {e}")
+        return False
+
+
+def process_job(job_id: int, session_factory=SessionLocal):
+    """Background task entry point: run one job in its own session (``session_factory`` picks the shard)."""
+    session = session_factory()
+    try:
+        run_job(session, job_id)
+    finally:
+        session.close()
+
+
+def unfinished_jobs(db: Session):
+    return db.execute(
+        select(UserDeletionJob.id).where(UserDeletionJob.status != "done").order_by(UserDeletionJob.id)
+    ).scalars().all()
+
+
+def resume_jobs(session_factory=SessionLocal) -> int:
+    """Run every pending, failed or stalled job; returns the number completed."""
+    session = session_factory()
+    try:
+        return sum(run_job(session, job_id) for job_id in unfinished_jobs(session))
+    finally:
+        session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the queued user deletion jobs.")
+    parser.add_argument("--user", type=int, help="only run the job of this user")
+    parser.add_argument("--chunk-size", type=int, default=DELETION_CHUNK_SIZE, help="rows deleted per transaction")
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        if args.user is not None:
+            job = latest_job(session, args.user)
+            job_ids = [job.id] if job is not None and job.status != "done" else []
+        else:
+            job_ids = unfinished_jobs(session)
+        print(f"🚀 Running {len(job_ids)} user deletion jobs...")
+        done = sum(run_job(session, job_id, args.chunk_size) for job_id in job_ids)
+        print(f"✅ {done} users deleted!")
+    except Exception as e:
+        session.rollback()
+        print(f"❌ Error running user deletion jobs: {e}")
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()